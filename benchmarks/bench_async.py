@@ -0,0 +1,107 @@
+"""
+Compare async.get against the old one-thread-per-request implementation.
+
+Each variant runs in its own process against a local HTTP server with a fixed
+per-request latency, and reports throughput, peak thread count and peak
+resident memory.
+
+    python benchmarks/bench_async.py [n_requests] [latency_ms]
+"""
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from Queue import Queue
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dogbutler import api
+from dogbutler import async
+from dogbutler.defaults import get_default_cache
+
+
+class Handler(BaseHTTPRequestHandler):
+    latency = 0.01
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        body = 'x' * 512
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def legacy_get(requests):
+    """The implementation of async.get before the worker pool."""
+    queues = []
+    for url, kwargs in requests:
+        q = Queue()
+        queues.append(q)
+        call_kwargs = dict(kwargs)
+        call_kwargs.update({'url': url, 'queue': q})
+        threading.Thread(target=api.get, kwargs=call_kwargs).start()
+    return [q.get(timeout=async.DEFAULT_TIMEOUT) for q in queues]
+
+
+def run(variant, n, latency):
+    Handler.latency = latency
+    server = Server(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+    # Spread the requests over a few hosts so per-host caps apply
+    port = server.server_address[1]
+    hosts = ['127.0.0.1', 'localhost']
+    requests = [('http://%s:%d/%d' % (hosts[i % len(hosts)], port, i), {}) for i in xrange(n)]
+
+    peak_threads = [threading.active_count()]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.is_set():
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+            time.sleep(0.005)
+    sampler = threading.Thread(target=sample)
+    sampler.daemon = True
+    sampler.start()
+
+    get = legacy_get if variant == 'legacy' else async.get
+    start = time.time()
+    responses = get(requests)
+    elapsed = time.time() - start
+    stop.set()
+    get_default_cache().clear()
+
+    assert len(responses) == n
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print '%-8s %6d requests  %8.1f req/s  peak threads %5d  peak rss %8d KB' % (
+        variant, n, n / elapsed, peak_threads[0], rss)
+
+
+def main():
+    n = sys.argv[1] if len(sys.argv) > 1 else '2000'
+    latency = sys.argv[2] if len(sys.argv) > 2 else '10'
+    for variant in ('legacy', 'pool'):
+        subprocess.call([sys.executable, __file__, '--run', variant, n, latency])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        run(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]) / 1000.0)
+    else:
+        main()
@@ -0,0 +1,87 @@
+"""
+Benchmark the cookie jar with 10k cookies across 1k domains.
+
+Reports the time to store the cookies, and the time and number of cookie
+cache operations per request when reading them back.
+
+    python benchmarks/bench_cookie.py [n_domains] [cookies_per_domain] [n_requests]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dummycache.cache import Cache
+from requests.models import Response
+
+from dogbutler.cookie import CookieManager
+from dogbutler.models import Request
+
+
+class CountingCache(Cache):
+    """An in-memory cache that counts the operations made on it."""
+
+    def __init__(self):
+        super(CountingCache, self).__init__()
+        self.gets = self.sets = 0
+
+    def get(self, key, default=None):
+        self.gets += 1
+        return super(CountingCache, self).get(key, default)
+
+    def set(self, key, value, timeout=None):
+        self.sets += 1
+        return super(CountingCache, self).set(key, value, timeout)
+
+
+PATHS = ['', '/', '/account', '/account/settings', '/shop', '/shop/cart']
+
+
+def main():
+    n_domains = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    per_domain = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    n_requests = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+    random.seed(0)
+
+    cache = CountingCache()
+    manager = CookieManager(cache=cache, key_prefix='bench', max_cookies=n_domains * per_domain)
+
+    start = time.time()
+    for d in xrange(n_domains):
+        host = 'www.site%d.com' % d
+        headers = []
+        for c in xrange(per_domain):
+            attrs = ['c%d=value%d' % (c, c), 'Max-Age=3600']
+            if c % 2:
+                attrs.append('Domain=site%d.com' % d)
+            path = PATHS[c % len(PATHS)]
+            if path:
+                attrs.append('Path=%s' % path)
+            headers.append('; '.join(attrs) + ';')
+        response = Response()
+        response.headers = {'Set-Cookie': ', '.join(headers)}
+        response.url = 'http://%s/' % host
+        manager.process_response(None, response)
+    elapsed = time.time() - start
+    print 'store    %6d cookies  %8.1f us/cookie  %5.2f sets/cookie' % (
+        n_domains * per_domain, elapsed * 1e6 / (n_domains * per_domain), cache.sets / float(n_domains * per_domain))
+
+    urls = ['http://www.site%d.com%s/page' % (random.randrange(n_domains), random.choice(PATHS))
+            for i in xrange(n_requests)]
+    cache.gets = cache.sets = 0
+    start = time.time()
+    found = 0
+    for url in urls:
+        request = Request(url)
+        manager.process_request(request)
+        found += len(request.cookies)
+    elapsed = time.time() - start
+    print 'lookup   %6d requests %8.1f us/request %5.2f gets/request %5.2f sets/request %5.2f cookies/request' % (
+        n_requests, elapsed * 1e6 / n_requests, cache.gets / float(n_requests), cache.sets / float(n_requests),
+        found / float(n_requests))
+
+
+if __name__ == '__main__':
+    main()
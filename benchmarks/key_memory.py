@@ -0,0 +1,95 @@
+"""
+Compare the memory that legacy and compact keys take in a memcached-style
+backend.
+
+Each session caches a few responses, sets a few cookies and follows a few
+redirects. Every entry written is accounted for as memcached stores it: an
+item header with CAS, the key, the pickled value and the closing CRLF,
+rounded up to the chunk size of its slab class.
+
+    python benchmarks/key_memory.py [sessions]
+"""
+
+import os
+import sys
+from cPickle import dumps, HIGHEST_PROTOCOL
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dummycache.cache import Cache
+from requests.models import Response
+
+from dogbutler.cache import CacheManager
+from dogbutler.cookie import CookieManager
+from dogbutler.models import Request
+from dogbutler.redirect import RedirectManager
+from dogbutler.utils.rand import random_string
+
+
+ITEM_HEADER_SIZE = 48 + 8           # Item header and CAS on 64 bit platforms
+SLAB_MIN_CHUNK_SIZE = 96
+SLAB_GROWTH_FACTOR = 1.25
+
+
+def get_chunk_size(item_size):
+    chunk_size = SLAB_MIN_CHUNK_SIZE
+    while chunk_size < item_size:
+        chunk_size = int(chunk_size * SLAB_GROWTH_FACTOR + 7) & ~7     # Chunks are 8 byte aligned
+    return chunk_size
+
+
+class MemcachedSizeCache(Cache):
+    """
+    A cache that can tell the size of its keys and items, as memcached stores them.
+    """
+
+    def get_sizes(self):
+        """
+        Return a tuple of (number of items, bytes in keys, bytes in chunks).
+        """
+        key_bytes = chunk_bytes = 0
+        for key, (value, expires) in self._dict.items():
+            key_bytes += len(key)
+            chunk_bytes += get_chunk_size(ITEM_HEADER_SIZE + len(key) + 1 + len(dumps(value, HIGHEST_PROTOCOL)) + 2)
+        return len(self._dict), key_bytes, chunk_bytes
+
+
+def make_response(url, headers, history=()):
+    response = Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = headers
+    response._content = 'x' * 200
+    response.history = list(history)
+    return response
+
+def run_session(cache, key_prefix, legacy_keys):
+    redirect_manager = RedirectManager(cache=cache, key_prefix=key_prefix, legacy_keys=legacy_keys)
+    cookie_manager = CookieManager(cache=cache, key_prefix=key_prefix, legacy_keys=legacy_keys)
+    cache_manager = CacheManager(cache=cache, key_prefix=key_prefix, legacy_keys=legacy_keys)
+    for i in xrange(5):
+        url = 'http://www.example.com/catalogue/items/%d?page=1' % i
+        redirect = make_response('http://example.com/items/%d' % i, {'Location': url})
+        redirect.status_code = 301
+        request = Request('http://example.com/items/%d' % i, cookies={'session': key_prefix})
+        cache_manager.process_request(request)
+        response = make_response(url, {'Cache-Control': 'private, max-age=600', 'Vary': 'Accept-Encoding',
+                                       'Set-Cookie': 'seen%d=1; Domain=.example.com;, visit=%d;' % (i, i)},
+                                 history=[redirect])
+        redirect_manager.process_response(request, response)
+        cookie_manager.process_response(request, response)
+        cache_manager.process_response(request, response)
+
+def main(sessions=1000):
+    print '%-8s %8s %10s %12s %12s' % ('keys', 'items', 'key bytes', 'item bytes', 'per item')
+    for legacy_keys in (True, False):
+        cache = MemcachedSizeCache()
+        for i in xrange(sessions):
+            run_session(cache, random_string(64 if legacy_keys else 16), legacy_keys)
+        items, key_bytes, chunk_bytes = cache.get_sizes()
+        print '%-8s %8d %10d %12d %12.1f' % ('legacy' if legacy_keys else 'compact', items, key_bytes, chunk_bytes,
+                                              float(chunk_bytes) / items)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
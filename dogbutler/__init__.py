@@ -23,5 +23,5 @@ __copyright__ = 'Copyright 2012 Vichaya/Euam Sirisanthana'
 
 
 from .api import request, get, head, post, patch, put, delete, options
-from .defaults import set_default_cache, set_default_cookie_cache, set_default_redirect_cache
+from .defaults import set_default_cache, set_default_cookie_cache, set_default_redirect_cache, set_default_legacy_keys
 from .sessions import session, Session
\ No newline at end of file
@@ -1,30 +1,409 @@
-from Queue import Queue
-from threading import Thread
+from collections import deque
+from itertools import islice
+from Queue import Empty, Queue
+from threading import Event, Lock, Thread
+from time import time
+from urlparse import urlparse
 
-from . import api
+from requests.exceptions import RequestException, Timeout
 
+from .api import DEFAULT_KEY_PREFIX
+from .models import Request
+from .sessions import Session
 
-DEFAULT_TIMEOUT = 60 * 5    # in seconds
 
+DEFAULT_TIMEOUT = 60 * 5    # in seconds, for a whole batch
+DEFAULT_MAX_WORKERS = 10    # Maximum number of worker threads in a pool
+DEFAULT_MAX_PER_HOST = 4    # Maximum number of requests in flight to the same host
+DEFAULT_WINDOW = 100        # Maximum number of submitted requests not yet handed back by as_completed
 
-def get(requests):
+
+class CancelledError(RequestException):
+    """The request was cancelled before it was sent."""
+
+
+class Future(object):
+    """
+    The pending result of a request submitted to a :class:`Pool`.
+    """
+
+    def __init__(self, method, url, kwargs):
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self.index = None               # Position of the request in its batch, if any
+        self.request = None             # GET request already run through Session.process_request
+        self.host = None                # Host whose slot the request holds, as counted when it was submitted
+        self._done = Event()
+        self._lock = Lock()
+        self._callbacks = []
+        self._running = False
+        self._cancelled = False
+        self._response = None
+        self._exception = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        """
+        Cancel the request if it has not been sent yet. Return True if it was
+        cancelled.
+        """
+        with self._lock:
+            if self._running or self._cancelled or self._done.is_set():
+                return False
+            self._cancelled = True
+        self.set_exception(CancelledError('Request to %s was cancelled' % self.url))
+        return True
+
+    def start(self):
+        """
+        Mark the request as running. Return False if it was cancelled, in
+        which case it must not be sent.
+        """
+        with self._lock:
+            if self._cancelled or self._done.is_set():
+                return False
+            self._running = True
+            return True
+
+    def result(self, timeout=None):
+        """
+        Return the response, waiting up to timeout seconds for it. Re-raise the
+        exception if the request failed.
+        """
+        if not self._done.wait(timeout):
+            raise Timeout('Request to %s did not complete in time' % self.url)
+        if self._exception is not None:
+            raise self._exception
+        return self._response
+
+    def exception(self, timeout=None):
+        """
+        Return the exception raised by the request, or None if it succeeded.
+        """
+        if not self._done.wait(timeout):
+            raise Timeout('Request to %s did not complete in time' % self.url)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(future) once the request completes, or right away if it already has.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, response):
+        self._response = response
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+class Pool(object):
+    """
+    A bounded pool of worker threads.
+
+    At most max_workers requests run at once, and at most max_per_host of them
+    go to the same host. Requests over the per-host cap are parked until a
+    request to that host finishes, so they never tie up a worker.
+
+    All workers send their requests through one session, so every request in
+    the pool shares its cache, cookies, redirects and connections. Pass
+    session to use an existing one.
+
+    GET requests are looked up in the session's redirect and response caches
+    as they are submitted, in the calling thread. Cache hits complete at once
+    and never reach a worker.
+
+    request_timeout, if given, is the default socket timeout of each request.
+
+    The batch methods take an iterable of requests. Each request is a tuple of
+    (url, kwargs) using the given method, or a tuple of (method, url, kwargs).
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, max_per_host=DEFAULT_MAX_PER_HOST,
+                 key_prefix=DEFAULT_KEY_PREFIX, request_timeout=None, session=None):
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.request_timeout = request_timeout
+        self.session = session if session is not None else Session(key_prefix=key_prefix)
+        self._tasks = Queue()
+        self._threads = []
+        self._lock = Lock()             # Guards _active, _parked and _futures
+        self._active = {}               # host -> number of requests in flight
+        self._parked = {}               # host -> deque of futures waiting for a slot
+        self._futures = set()           # Futures submitted but not yet done
+        self._stops = 0                 # Workers to stop once no request is queued or in flight
+
+    def submit(self, method, url, **kwargs):
+        """
+        Schedule a request and return its :class:`Future`.
+        """
+        if self.request_timeout is not None:
+            kwargs.setdefault('timeout', self.request_timeout)
+        future = Future(str(method).upper(), url, kwargs)
+        future.add_done_callback(self._forget)
+        if future.method == 'GET':
+            future.request = Request(url, method=future.method, **kwargs)
+            response = self.session.process_request(future.request)
+            if response is not None:
+                future.set_result(response)
+                return future
+            url = future.request.url
+        host = future.host = urlparse(url).netloc
+        with self._lock:
+            self._futures.add(future)
+            if self.max_per_host and self._active.get(host, 0) >= self.max_per_host:
+                self._parked.setdefault(host, deque()).append(future)
+                return future
+            self._active[host] = self._active.get(host, 0) + 1
+        self._dispatch(future)
+        return future
+
+    def map(self, requests, method='GET', timeout=DEFAULT_TIMEOUT):
+        """
+        Return the responses to requests in the same order.
+
+        The whole batch must complete within timeout seconds. If it does not,
+        or if any request fails, the requests not yet sent are cancelled and
+        Timeout or the request's exception is raised right away.
+        """
+        responses = {}
+        for future in self.as_completed(requests, window=None, method=method, timeout=timeout):
+            responses[future.index] = future.result()
+        return [responses[i] for i in xrange(len(responses))]
+
+    def as_completed(self, requests, window=DEFAULT_WINDOW, method='GET', timeout=None):
+        """
+        requests may be any iterable, including a lazy one, and is consumed
+        only as fast as results are handed back.
+
+        Yield a :class:`Future` for each request as it completes, with
+        future.index set to the position of the request. At most window
+        requests are submitted but not yet yielded at any time, or all of them
+        if window is None.
+
+        If the batch has not completed within timeout seconds, Timeout is
+        raised. Requests not yet sent are cancelled when that happens, or when
+        the caller stops iterating early.
+        """
+        deadline = time() + timeout if timeout is not None else None
+        completed = Queue()
+        requests = enumerate(requests)
+        pending = set()
+
+        def submit(n):
+            for index, request in islice(requests, n):
+                if len(request) == 2:
+                    request = (method,) + tuple(request)
+                request_method, url, kwargs = request
+                future = self.submit(request_method, url, **kwargs)
+                future.index = index
+                pending.add(future)
+                future.add_done_callback(completed.put)
+
+        try:
+            submit(window)
+            while pending:
+                try:
+                    if deadline is None:
+                        future = completed.get()
+                    else:
+                        future = completed.get(timeout=max(deadline - time(), 0))
+                except Empty:
+                    raise Timeout('Batch did not complete within %s seconds' % timeout)
+                pending.discard(future)
+                # Refill the window before handing the result back, so requests
+                # stay in flight while the caller is busy with this one.
+                if window is not None:
+                    submit(1)
+                yield future
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def imap(self, requests, window=DEFAULT_WINDOW, method='GET', timeout=None):
+        """
+        Like as_completed, but yield a tuple of (index, response) for each
+        request. If a request failed, its exception takes the place of the
+        response.
+        """
+        for future in self.as_completed(requests, window=window, method=method, timeout=timeout):
+            yield future.index, future.exception() or future.result()
+
+    def shutdown(self, wait=False, cancel_pending=False):
+        """
+        Stop the workers once they have finished the requests already queued,
+        including those waiting for a slot of their host. If cancel_pending
+        is True, the requests not yet sent are cancelled instead.
+        """
+        if cancel_pending:
+            with self._lock:
+                futures = list(self._futures)
+            for future in futures:
+                future.cancel()
+        with self._lock:
+            threads, self._threads = self._threads, []
+            self._stops += len(threads)
+            stops = self._take_stops()
+        for i in xrange(stops):
+            self._tasks.put(None)
+        if wait:
+            for t in threads:
+                t.join()
+
+    def _forget(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _dispatch(self, future):
+        if len(self._threads) < self.max_workers:
+            t = Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        self._tasks.put(future)
+
+    def _release(self, host):
+        with self._lock:
+            parked = self._parked.get(host)
+            if parked:
+                future = parked.popleft()
+                if not parked:
+                    del self._parked[host]
+            else:
+                future = None
+                self._active[host] -= 1
+                if not self._active[host]:
+                    del self._active[host]
+            stops = self._take_stops()
+        if future is not None:
+            self._tasks.put(future)
+        for i in xrange(stops):
+            self._tasks.put(None)
+
+    def _take_stops(self):
+        """
+        Return the number of stops to queue now: all those owed once no
+        request is queued or in flight, and none before, since requests
+        parked behind the cap of their host are queued later. Call with
+        _lock held.
+        """
+        if self._active:
+            return 0
+        stops, self._stops = self._stops, 0
+        return stops
+
+    def _work(self):
+        while True:
+            future = self._tasks.get()
+            if future is None:
+                break
+            try:
+                if future.start():
+                    future.set_result(self._send(future))
+            except Exception, e:
+                future.set_exception(e)
+            finally:
+                # Not the host of future.request.url, which redirects may have changed
+                self._release(future.host)
+
+    def _send(self, future):
+        if future.request is not None:
+            kwargs = dict(future.kwargs)
+            kwargs.setdefault('allow_redirects', True)
+            return self.session.fetch(future.request, **kwargs)
+        send = getattr(self.session, future.method.lower())
+        return send(future.url, **future.kwargs)
+
+
+def request_many(requests, timeout=DEFAULT_TIMEOUT, request_timeout=None, session=None,
+                 max_workers=DEFAULT_MAX_WORKERS, max_per_host=DEFAULT_MAX_PER_HOST, method='GET'):
+    """
+    Each request in requests is a tuple of (method, url, kwargs), or of
+    (url, kwargs) to use the given method. Return the responses in the same
+    order. All requests go through one session. See Pool.map.
+    """
+    pool = Pool(max_workers=max_workers, max_per_host=max_per_host, request_timeout=request_timeout, session=session)
+    try:
+        return pool.map(requests, method=method, timeout=timeout)
+    finally:
+        pool.shutdown(cancel_pending=True)
+
+map = request_many
+
+
+def get(requests, **kwargs):
     """
-    Each request in requests is a tuple of (url, kwargs).
+    Each request in requests is a tuple of (url, kwargs). See request_many.
     """
-    queues = []         # A list of queues to hold return values
-    threads = []        # A list to hold spawned threads
-    for url, kwargs in requests:
-        q = Queue()
-        queues.append(q)
+    return request_many(requests, method='GET', **kwargs)
+
 
-        call_kwargs = dict(kwargs)
-        call_kwargs.update({
-            'url': url,
-            'queue': q,
-        })
+def options(requests, **kwargs):
+    return request_many(requests, method='OPTIONS', **kwargs)
 
-        t = Thread(target=api.get, kwargs=call_kwargs)
-        t.start()
-        threads.append(t)
 
-    return [q.get(timeout=DEFAULT_TIMEOUT) for q in queues]
\ No newline at end of file
+def head(requests, **kwargs):
+    return request_many(requests, method='HEAD', **kwargs)
+
+
+def post(requests, **kwargs):
+    return request_many(requests, method='POST', **kwargs)
+
+
+def put(requests, **kwargs):
+    return request_many(requests, method='PUT', **kwargs)
+
+
+def patch(requests, **kwargs):
+    return request_many(requests, method='PATCH', **kwargs)
+
+
+def delete(requests, **kwargs):
+    return request_many(requests, method='DELETE', **kwargs)
+
+
+def as_completed(requests, window=DEFAULT_WINDOW, timeout=None, request_timeout=None, session=None,
+                 max_workers=DEFAULT_MAX_WORKERS, max_per_host=DEFAULT_MAX_PER_HOST, method='GET'):
+    """
+    Yield a :class:`Future` for each request as it completes. See
+    Pool.as_completed.
+    """
+    pool = Pool(max_workers=max_workers, max_per_host=max_per_host, request_timeout=request_timeout, session=session)
+    try:
+        for future in pool.as_completed(requests, window=window, method=method, timeout=timeout):
+            yield future
+    finally:
+        pool.shutdown(cancel_pending=True)
+
+
+def imap(requests, window=DEFAULT_WINDOW, timeout=None, request_timeout=None, session=None,
+         max_workers=DEFAULT_MAX_WORKERS, max_per_host=DEFAULT_MAX_PER_HOST, method='GET'):
+    """
+    Yield a tuple of (index, response) for each request as it completes. See
+    Pool.imap.
+    """
+    pool = Pool(max_workers=max_workers, max_per_host=max_per_host, request_timeout=request_timeout, session=session)
+    try:
+        for result in pool.imap(requests, window=window, method=method, timeout=timeout):
+            yield result
+    finally:
+        pool.shutdown(cancel_pending=True)
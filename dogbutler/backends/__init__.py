@@ -0,0 +1,2 @@
+from .memcached import MemcachedCache
+from .sharded import ShardedCache
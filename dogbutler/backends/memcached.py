@@ -0,0 +1,273 @@
+"""
+This module talks to a memcached server over its text protocol.
+
+A MemcachedCache keeps a pool of connections to one server, which the
+threads of async and of every session share. Values are pickled, and
+compressed with zlib when compress_min_length is given and they are at
+least that long. get_many asks for all its keys with a single get, and
+set_many and delete_many pipeline their commands, i.e. send them all before
+reading the replies, so each costs one round trip rather than one per key.
+
+    from dogbutler import set_default_cache
+    from dogbutler.backends import MemcachedCache
+
+    set_default_cache(MemcachedCache('127.0.0.1:11211', compress_min_length=1024))
+
+A cache is not worth failing a request for, so a call that fails, e.g.
+because the server is down, reads as a miss and stores nothing. Its
+connection is closed rather than returned to the pool.
+"""
+
+import socket
+import zlib
+from math import ceil
+from contextlib import contextmanager
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from threading import BoundedSemaphore, Lock
+from time import time
+
+from dogbutler.utils.keys import get_digest
+
+
+DEFAULT_POOL_SIZE = 10          # Connections open at once, at most
+DEFAULT_SOCKET_TIMEOUT = 3      # Seconds
+MAX_KEY_LENGTH = 250            # As memcached allows
+MAX_RELATIVE_EXPTIME = 60 * 60 * 24 * 30    # Longer expiry times are read by memcached as Unix times
+PIPELINE_SIZE = 256             # Commands sent before their replies are read, so that neither side blocks
+HASHED_KEY_TAG = 'h'            # Of the keys that memcached would not take as they are
+
+FLAG_PICKLED = 1
+FLAG_COMPRESSED = 2
+
+
+class MemcachedError(Exception):
+    pass
+
+
+class Connection(object):
+    """
+    A connection to a memcached server, which reads its replies through a buffer.
+    """
+
+    def __init__(self, address, timeout):
+        self.socket = socket.create_connection(address, timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self.socket.makefile('rb')
+
+    def send(self, data):
+        self.socket.sendall(data)
+
+    def readline(self):
+        line = self._file.readline()
+        if not line.endswith('\r\n'):
+            raise MemcachedError('Connection closed by server')
+        return line[:-2]
+
+    def read(self, length):
+        data = self._file.read(length + 2)
+        if len(data) != length + 2:
+            raise MemcachedError('Connection closed by server')
+        return data[:-2]
+
+    def close(self):
+        self._file.close()
+        self.socket.close()
+
+
+class ConnectionPool(object):
+    """
+    The connections to a server, opened as they are needed, at most max_size
+    at once. A thread that finds them all in use waits for one to be put
+    back.
+    """
+
+    def __init__(self, address, max_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_SOCKET_TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+        self._idle = []                 # Connections put back, the last one first out
+        self._lock = Lock()             # Guards _idle
+        self._slots = BoundedSemaphore(max_size)
+
+    @contextmanager
+    def connection(self):
+        """
+        Lend a connection for the duration of a with block. The connection is
+        closed if the block raises, since its replies may be out of step.
+        """
+        with self._slots:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                connection = Connection(self.address, self.timeout)
+            try:
+                yield connection
+            except:
+                connection.close()
+                raise
+            with self._lock:
+                self._idle.append(connection)
+
+    def clear(self):
+        """
+        Close the connections not in use.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+def parse_address(server):
+    """
+    Return the (host, port) of server, either such a tuple or 'host:port'.
+    """
+    if isinstance(server, basestring):
+        host, port = server.rsplit(':', 1)
+        return host, int(port)
+    return server
+
+
+class MemcachedCache(object):
+    """
+    A cache stored in the memcached server at server, 'host:port' or
+    (host, port), with the same interface as dummycache's, plus get_many,
+    set_many and delete_many.
+    """
+
+    def __init__(self, server, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_SOCKET_TIMEOUT,
+                 compress_min_length=None, compress_level=6):
+        self.pool = ConnectionPool(parse_address(server), pool_size, timeout)
+        self.compress_min_length = compress_min_length
+        self.compress_level = compress_level
+
+    def get(self, key, default=None):
+        value = self.get_many([key]).get(key)
+        return default if value is None else value
+
+    def set(self, key, value, timeout=None):
+        self._store('set', key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        if timeout is not None and timeout <= 0:
+            return False
+        return self._store('add', key, value, timeout)
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def get_many(self, keys):
+        """
+        Return a dictionary of key: value for the keys that are found.
+        """
+        if not keys:
+            return {}
+        server_keys = dict((self._get_server_key(key), key) for key in keys)
+        found = {}
+        try:
+            with self.pool.connection() as connection:
+                connection.send('get %s\r\n' % ' '.join(server_keys))
+                line = connection.readline()
+                while line != 'END':
+                    parts = line.split(' ')
+                    if parts[0] != 'VALUE' or len(parts) < 4 or parts[1] not in server_keys:
+                        raise MemcachedError(line)
+                    data = connection.read(int(parts[3]))
+                    found[server_keys[parts[1]]] = self._decode(data, int(parts[2]))
+                    line = connection.readline()
+        except (socket.error, MemcachedError):
+            return {}
+        return found
+
+    def set_many(self, data, timeout=None):
+        if timeout is not None and timeout <= 0:
+            self.delete_many(data.keys())
+            return
+        exptime = self._get_exptime(timeout)
+        commands = []
+        for key, value in data.items():
+            value, flags = self._encode(value)
+            commands.append('set %s %d %d %d\r\n%s\r\n' % (self._get_server_key(key), flags, exptime, len(value), value))
+        self._pipeline(commands)
+
+    def delete_many(self, keys):
+        self._pipeline(['delete %s\r\n' % self._get_server_key(key) for key in keys])
+
+    def clear(self):
+        self._pipeline(['flush_all\r\n'])
+
+    def close(self):
+        self.pool.clear()
+
+    def _store(self, command, key, value, timeout):
+        """
+        Store value under key with command, set or add, and return whether it was stored.
+        """
+        if timeout is not None and timeout <= 0:
+            self.delete(key)
+            return False
+        value, flags = self._encode(value)
+        replies = self._pipeline(['%s %s %d %d %d\r\n%s\r\n' % (command, self._get_server_key(key), flags,
+                                                                  self._get_exptime(timeout), len(value), value)])
+        return replies == ['STORED']
+
+    def _pipeline(self, commands):
+        """
+        Send commands, which have one line of reply each, and return the
+        replies, or an empty list if the server could not be reached.
+        """
+        replies = []
+        if not commands:
+            return replies
+        try:
+            with self.pool.connection() as connection:
+                for start in xrange(0, len(commands), PIPELINE_SIZE):
+                    batch = commands[start:start + PIPELINE_SIZE]
+                    connection.send(''.join(batch))
+                    for command in batch:
+                        reply = connection.readline()
+                        if reply == 'ERROR':
+                            raise MemcachedError(reply)
+                        replies.append(reply)
+        except (socket.error, MemcachedError):
+            return []
+        return replies
+
+    def _get_server_key(self, key):
+        """
+        Return key as memcached stores it. Keys that are too long, or that
+        hold spaces or control characters, are replaced by their digest.
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        if len(key) > MAX_KEY_LENGTH or any(c <= ' ' or c == '\x7f' for c in key):
+            return HASHED_KEY_TAG + get_digest(key)
+        return key
+
+    def _get_exptime(self, timeout):
+        if timeout is None:
+            return 0
+        # Rounded up, since 0 would never expire
+        timeout = int(ceil(timeout))
+        if timeout > MAX_RELATIVE_EXPTIME:
+            return int(time()) + timeout
+        return timeout
+
+    def _encode(self, value):
+        """
+        Return the data and flags that value is stored with.
+        """
+        data = dumps(value, HIGHEST_PROTOCOL)
+        flags = FLAG_PICKLED
+        if self.compress_min_length is not None and len(data) >= self.compress_min_length:
+            compressed = zlib.compress(data, self.compress_level)
+            if len(compressed) < len(data):
+                data = compressed
+                flags |= FLAG_COMPRESSED
+        return data, flags
+
+    def _decode(self, data, flags):
+        if flags & FLAG_COMPRESSED:
+            data = zlib.decompress(data)
+        if flags & FLAG_PICKLED:
+            return loads(data)
+        return data
@@ -0,0 +1,164 @@
+"""
+This module spreads a cache over several cache servers.
+
+A ShardedCache takes any number of named caches, e.g. one client per
+memcached server, and stores each key in one of them, chosen by consistent
+hashing. Every cache is given replicas points on a ring of 32 bit hashes,
+and a key is stored in the cache that owns the first point at or after the
+hash of its group. Adding or removing a cache only moves the keys of the
+arcs that change hands, i.e. about one key in n for n caches.
+
+A key is placed by its group (see dogbutler.utils.keys.get_key_group), so
+that the keys dogbutler reads together, such as the cookies of a site,
+are stored in the same cache and can be read with one get_many.
+
+    from dogbutler import set_default_cache
+    from dogbutler.backends import ShardedCache
+
+    set_default_cache(ShardedCache({'cache-1': client_1, 'cache-2': client_2}))
+"""
+
+from bisect import bisect_left
+from threading import Lock
+
+from dogbutler.utils.hashcompat import md5_constructor
+from dogbutler.utils.keys import get_key_group
+
+
+DEFAULT_REPLICAS = 160          # Points per cache on the ring, as in ketama
+
+
+def get_hash(value):
+    """
+    Return the position of value on the ring, the first 32 bits of its MD5.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return int(md5_constructor(value).hexdigest()[:8], 16)
+
+
+class ShardedCache(object):
+    """
+    A cache that stores each key in one of several caches, named in caches, a
+    dictionary of name: cache. Names, rather than caches, are hashed onto the
+    ring, so a cache keeps its keys when it is replaced by another of the same
+    name, e.g. after a restart.
+
+    get_many, set_many and delete_many make one call per cache involved, with
+    the cache's own get_many, set_many or delete_many if it has them.
+    """
+
+    def __init__(self, caches, replicas=DEFAULT_REPLICAS, get_group=get_key_group):
+        self.replicas = replicas
+        self.get_group = get_group
+        self._caches = {}
+        self._ring = ([], [], {})       # Sorted points, the name of the cache owning each, and the caches by name
+        self._lock = Lock()             # Guards changes to the caches and ring
+        for name, cache in caches.items():
+            self.add_cache(name, cache)
+
+    @property
+    def caches(self):
+        return dict(self._caches)
+
+    def add_cache(self, name, cache):
+        """
+        Add cache under name, or replace the cache of that name.
+        """
+        with self._lock:
+            self._caches[name] = cache
+            self._build_ring()
+
+    def remove_cache(self, name):
+        """
+        Remove the cache of name. Its keys are lost, and are stored in the
+        other caches as they are set again.
+        """
+        with self._lock:
+            del self._caches[name]
+            self._build_ring()
+
+    def get_cache_name(self, key):
+        """
+        Return the name of the cache that stores key.
+        """
+        return self._locate(key, self._ring)[0]
+
+    def get_cache(self, key):
+        return self._locate(key, self._ring)[1]
+
+    def get(self, key, default=None):
+        return self.get_cache(key).get(key, default)
+
+    def set(self, key, value, timeout=None):
+        self.get_cache(key).set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        return self.get_cache(key).add(key, value, timeout)
+
+    def delete(self, key):
+        self.get_cache(key).delete(key)
+
+    def get_many(self, keys):
+        """
+        Return a dictionary of key: value for the keys that are found.
+        """
+        found = {}
+        for cache, cache_keys in self._split(keys):
+            get_many = getattr(cache, 'get_many', None)
+            if get_many is not None:
+                found.update(get_many(cache_keys))
+            else:
+                for key in cache_keys:
+                    value = cache.get(key)
+                    if value is not None:
+                        found[key] = value
+        return found
+
+    def set_many(self, data, timeout=None):
+        for cache, cache_keys in self._split(data):
+            set_many = getattr(cache, 'set_many', None)
+            if set_many is not None:
+                set_many(dict((key, data[key]) for key in cache_keys), timeout)
+            else:
+                for key in cache_keys:
+                    cache.set(key, data[key], timeout)
+
+    def delete_many(self, keys):
+        for cache, cache_keys in self._split(keys):
+            delete_many = getattr(cache, 'delete_many', None)
+            if delete_many is not None:
+                delete_many(cache_keys)
+            else:
+                for key in cache_keys:
+                    cache.delete(key)
+
+    def clear(self):
+        for cache in self._ring[2].values():
+            cache.clear()
+
+    def _split(self, keys):
+        """
+        Return a list of (cache, keys it stores) for keys.
+        """
+        ring = self._ring
+        by_name = {}
+        for key in keys:
+            by_name.setdefault(self._locate(key, ring)[0], []).append(key)
+        return [(ring[2][name], cache_keys) for name, cache_keys in by_name.items()]
+
+    def _locate(self, key, ring):
+        """
+        Return the name and cache that store key on ring. The ring is passed
+        in, so that a ring rebuilt meanwhile does not mix two layouts.
+        """
+        points, names, caches = ring
+        if not points:
+            raise ValueError('ShardedCache has no caches')
+        index = bisect_left(points, get_hash(self.get_group(key)))
+        name = names[index if index < len(points) else 0]
+        return name, caches[name]
+
+    def _build_ring(self):
+        ring = sorted((get_hash('%s-%d' % (name, i)), name) for name in self._caches for i in xrange(self.replicas))
+        self._ring = ([point for point, name in ring], [name for point, name in ring], dict(self._caches))
@@ -1,5 +1,9 @@
 import copy
+from dogbutler.defaults import DEFAULT_SHARED_KEY_PREFIX
 from dogbutler.utils.cache import get_cache_key, learn_cache_key, get_max_age, remove_hop_by_hop_headers
+from dogbutler.utils.cache import has_credentials, is_public, is_shareable, _generate_cache_header_key
+from dogbutler.utils.keys import CACHE_TAG, LONG_TERM_CACHE_TAG, make_key_prefix
+from dogbutler.utils.keyspace import Keyspace
 
 
 DEFAULT_CACHE_KEY_PREFIX = 'dogbutler'
@@ -8,11 +12,74 @@ LONG_TERM_CACHE_SECONDS = 60 * 60 * 24 * 365 * 10       # 10 years
 
 
 class CacheManager(object):
-
-    def __init__(self, cache, key_prefix='', cache_anonymous_only=False):
-        self.key_prefix = '.'.join([key_prefix, DEFAULT_CACHE_KEY_PREFIX])
+    """
+    Responses that any user could be given, i.e. those that are not private,
+    set no cookies, do not vary on credentials, and are either public or the
+    answer to a request without cookies or an Authorization header, are
+    cached under shared_key_prefix, where every manager with the same
+    shared_key_prefix and cache finds them. All other responses are cached
+    under the manager's own key_prefix.
+
+    A request is answered from the manager's own responses first, then from
+    the shared ones. A request with credentials is only answered from a
+    shared response if it is public, as it may otherwise be the anonymous
+    version of the page. A shared_key_prefix of None shares nothing.
+
+    A manager may have a parent, the manager of the session it was forked
+    from. The responses of the parent, and of its own parent, are looked up
+    after the manager's own and before the shared ones, but responses are
+    only ever cached under the manager's own key prefix.
+
+    The keys of the responses cached under key_prefix are remembered in
+    keyspace, so that clear() can delete them.
+
+    Keys are compact (see dogbutler.utils.keys), unless legacy_keys is True.
+    """
+
+    def __init__(self, cache, key_prefix='', cache_anonymous_only=False, shared_key_prefix=DEFAULT_SHARED_KEY_PREFIX,
+                 parent=None, legacy_keys=False):
+        self.legacy_keys = legacy_keys
+        self._key_prefixes = {False: key_prefix, True: shared_key_prefix}
+        self.key_prefix = self.get_key_prefix()
+        self.parent = parent
+        self.shared_key_prefix = None
+        if shared_key_prefix is not None:
+            self.shared_key_prefix = self.get_key_prefix(shared=True)
         self.cache = cache
         self.cache_anonymous_only = cache_anonymous_only
+        self.keyspace = Keyspace()
+
+    def clear(self):
+        """
+        Delete the responses cached under the manager's own key prefix. The
+        shared ones are left for the other managers.
+        """
+        self.keyspace.purge(self.cache)
+
+    def get_key_prefix(self, shared=False, long_term=False):
+        key_prefix = self._key_prefixes[shared]
+        if not self.legacy_keys:
+            return make_key_prefix(LONG_TERM_CACHE_TAG if long_term else CACHE_TAG, key_prefix)
+        key_prefix = '.'.join([key_prefix, DEFAULT_CACHE_KEY_PREFIX])
+        return LONG_TERM_CACHE_KEY_PREFIX+key_prefix if long_term else key_prefix
+
+    def get_cached_response(self, request, method, long_term=False):
+        """
+        Returns the response cached for request, from the manager's own
+        responses first, then from those of its parents and then from the
+        shared ones, or None.
+        """
+        for key_prefix, shared in self._get_tiers(long_term):
+            cache_key = get_cache_key(request, key_prefix, method, cache=self.cache, compact=not self.legacy_keys)
+            if cache_key is None:
+                continue
+            response = self.cache.get(cache_key, None)
+            if response is None:
+                continue
+            if shared and has_credentials(request) and not is_public(response):
+                continue
+            return response
+        return None
 
     def process_request(self, request):
         if self.cache is None:
@@ -38,15 +105,10 @@ class CacheManager(object):
             request._cache_update_cache = True
             return None
         # try and get the cached GET response
-        cache_key = get_cache_key(request, self.key_prefix, 'GET', cache=self.cache)
-        if cache_key is None:
-            request._cache_update_cache = True
-            return None # No cache information available, need to rebuild.
-        response = self.cache.get(cache_key, None)
+        response = self.get_cached_response(request, 'GET')
         # if it wasn't found and we are looking for a HEAD, try looking just for that
         if response is None and request.method == 'HEAD':
-            cache_key = get_cache_key(request, self.key_prefix, 'HEAD', cache=self.cache)
-            response = self.cache.get(cache_key, None)
+            response = self.get_cached_response(request, 'HEAD')
 
         if response is None:
             request._cache_update_cache = True
@@ -56,6 +118,20 @@ class CacheManager(object):
         request._cache_update_cache = False
         return response
 
+    def _get_tiers(self, long_term=False):
+        """
+        Returns a list of (key prefix, shared) to look responses up under, in
+        order.
+        """
+        tiers = []
+        manager = self
+        while manager is not None:
+            tiers.append((manager.get_key_prefix(long_term=long_term), False))
+            manager = manager.parent
+        if self.shared_key_prefix is not None:
+            tiers.append((self.get_key_prefix(True, long_term), True))
+        return tiers
+
     def patch_if_modified_since_header(self, request):
         """
         Add 'If-Modified-Since' header to request if:
@@ -63,12 +139,10 @@ class CacheManager(object):
         2. Previous response has 'Last-Modified' header.
         """
         if 'If-Modified-Since' not in request.headers:
-            cache_key = get_cache_key(request, LONG_TERM_CACHE_KEY_PREFIX+self.key_prefix, 'GET', cache=self.cache)
-            if cache_key is not None:
-                response = self.cache.get(cache_key, None)
-                if response is not None:
-                    if response.has_header('Last-Modified'):
-                        request.headers['If-Modified-Since'] = response['Last-Modified']
+            response = self.get_cached_response(request, 'GET', long_term=True)
+            if response is not None:
+                if response.has_header('Last-Modified'):
+                    request.headers['If-Modified-Since'] = response['Last-Modified']
 
     def patch_if_none_match_header(self, request):
         """
@@ -77,18 +151,13 @@ class CacheManager(object):
         2. Previous response has 'ETag' header.
         """
         if 'If-None-Match' not in request.headers:
-            cache_key = get_cache_key(request, LONG_TERM_CACHE_KEY_PREFIX+self.key_prefix, 'GET', cache=self.cache)
-            if cache_key is not None:
-                response = self.cache.get(cache_key, None)
-                if response is not None:
-                    if response.has_header('ETag'):
-                        request.headers['If-None-Match'] = response['ETag']
+            response = self.get_cached_response(request, 'GET', long_term=True)
+            if response is not None:
+                if response.has_header('ETag'):
+                    request.headers['If-None-Match'] = response['ETag']
 
     def process_304_response(self, request, response):
-        cache_key = get_cache_key(request, LONG_TERM_CACHE_KEY_PREFIX+self.key_prefix, 'GET', cache=self.cache)
-        if cache_key is None:
-            return None
-        cached_response = self.cache.get(cache_key, None)
+        cached_response = self.get_cached_response(request, 'GET', long_term=True)
         if cached_response is None:
             return None
         else:
@@ -137,8 +206,15 @@ class CacheManager(object):
         if timeout:
             # ignore hop-by-hop headers, they must not be stored by caches
             cached_response = remove_hop_by_hop_headers(copy.deepcopy(response))
-            cache_key = learn_cache_key(request, cached_response, timeout, self.key_prefix, cache=self.cache)
-            long_term_cache_key = learn_cache_key(request, cached_response, LONG_TERM_CACHE_SECONDS, LONG_TERM_CACHE_KEY_PREFIX+self.key_prefix, cache=self.cache)
+            shared = self.shared_key_prefix is not None and is_shareable(request, response)
+            compact = not self.legacy_keys
+            cache_key = learn_cache_key(request, cached_response, timeout, self.get_key_prefix(shared), cache=self.cache, compact=compact)
+            long_term_cache_key = learn_cache_key(request, cached_response, LONG_TERM_CACHE_SECONDS, self.get_key_prefix(shared, long_term=True), cache=self.cache, compact=compact)
+            if not shared:
+                for key_prefix in (self.get_key_prefix(), self.get_key_prefix(long_term=True)):
+                    self.keyspace.add(_generate_cache_header_key(key_prefix, request, compact))
+                self.keyspace.add(cache_key)
+                self.keyspace.add(long_term_cache_key)
             if hasattr(cached_response, 'render') and callable(cached_response.render):
 
                 # TODO: Investigate 'post_render_callback'
@@ -1,63 +1,203 @@
-from Cookie import SimpleCookie
-from datetime import datetime
-import re
+from heapq import heapify, heappop, heappush
+from random import getrandbits
+from threading import Lock, RLock
+from time import time
 from urlparse import urlparse
 
+from dogbutler.utils.cookie import (get_cookie_site, is_ip_address, normalize_domain, pack_cookie, parse_cookies,
+                                    strip_port, unpack_cookie)
+from dogbutler.utils.keys import COOKIE_TAG, make_key_prefix
+from dogbutler.utils.keyspace import Keyspace
+from dogbutler.utils.publicsuffix import get_registrable_domain, is_public_suffix
+
 
 DEFAULT_COOKIE_KEY_PREFIX = 'cookie'
 ORIGIN_COOKIE_KEY_PREFIX = 'origin'
-DEFAULT_COOKIE_MAX_AGE = 60 * 60 * 24 * 365 * 10       # 10 years
-
-
-def _make_cookie(cookie_headers):
-    def _add_dash(match_obj):
-        return match_obj.group(0).replace(' ', '-')
-
-    cookie = SimpleCookie()
-    set_cookie_str = re.sub(r'\d{2}\s\w+\s\d{4}', _add_dash, cookie_headers)
-    cookie.load(set_cookie_str)
-
-    return  cookie
-
-def get_max_age(cookie):
-    max_age = None
-    # convert expires to seconds, so we use take advantage of cache expiry feature,
-    # no need to clear cookie ourselves
-    if cookie['expires']:
-        fmt = '%a, %d-%b-%Y %H:%M:%S GMT'
-        try:
-            expired  = datetime.strptime(cookie['expires'], fmt)
-            now = datetime.utcnow()
-            max_age = (expired - now).total_seconds()
-        except ValueError:
-            # if cookie has wrong date format we ignore the expires
-            cookie['expires'] = ''
-            max_age = None
-
-    # max-age has higher priority than  expires
-    if cookie['max-age']:
-        max_age = int(cookie['max-age'])
-    return max_age if max_age is not None else DEFAULT_COOKIE_MAX_AGE
+COOKIE_VERSION_KEY = 'version'
+USAGE_KEY_PREFIX = '_usage'                             # Not a valid host name label, so no domain can clash with it
+DEFAULT_COOKIE_MAX_AGE = 60 * 60 * 24 * 365 * 10       # 10 years, for cookies that last for the session
+DEFAULT_SWEEP_INTERVAL = 60                             # in seconds
+DEFAULT_SWEEP_BATCH = 100                               # Maximum number of expired cookies removed per sweep
+RESOLVED_CACHE_SIZE = 1024                              # Maximum number of (host, path) resolutions memoized
+LAST_USED_CACHE_SIZE = 10000                            # Maximum number of cookie read times kept in memory
+MIN_EXPIRY_HEAP_REBUILD = 64                            # Stale expiry entries tolerated before the heap is rebuilt
+DEFAULT_MAX_COOKIES_PER_DOMAIN = 50                     # RFC 6265 section 6.1 minimums
+DEFAULT_MAX_COOKIES = 3000
+DEFAULT_MAX_COOKIE_SIZE = 4096                          # in bytes, of name, value and attributes
+COOKIE_LOCK_STRIPES = 64
+
+# Jar updates read, modify and write back records in the cache. They are
+# serialized per site with a fixed set of locks shared by every manager in the
+# process, so that managers with the same key prefix, e.g. one per api call,
+# do not lose each other's updates, while updates to other sites go ahead.
+# The jar totals are shared by all sites and have a lock of their own, which
+# is only ever taken last.
+_cookie_locks = [RLock() for i in xrange(COOKIE_LOCK_STRIPES)]
+_totals_lock = Lock()
+
+
+def get_expiry(cookie, now):
+    """
+    Return the UTC timestamp at which the cookie expires, or None if it lasts
+    for the session. Max-Age has priority over Expires.
+    """
+    if cookie.max_age is not None:
+        return now + cookie.max_age
+    return cookie.expires
+
+def is_live(packed, now):
+    """
+    Return True if the packed cookie has not expired at now.
+    """
+    return packed[4] is None or packed[4] > now
 
 def is_domain_valid(domain):
-    if domain.endswith('.'):
+    if domain.endswith('.') or '' in normalize_domain(domain).split('.'):
         return False
-    else:
+    # A cookie for a public suffix, e.g. Domain=.co.uk, would be sent to every
+    # site under it
+    return not is_public_suffix(normalize_domain(domain))
+
+def is_public_host_domain(domain, host):
+    """
+    Return True if domain is a public suffix naming host itself. Such a cookie
+    is kept for host only (RFC 6265 section 5.3 step 5).
+    """
+    domain = normalize_domain(domain).lower()
+    return domain == host.lower() and is_public_suffix(domain)
+
+def domain_match(host, domain):
+    """
+    Return True if host domain-matches domain (RFC 6265 section 5.1.3), i.e.
+    is domain itself or a subdomain of it. An IP address only matches itself.
+    """
+    host, domain = host.lower(), normalize_domain(domain).lower()
+    if host == domain:
         return True
-
-def normalize_domain(domain):
-    return domain.lstrip('.')
-
-# Not used
-#def normalize_path(path):
-#    return path.rstip('/') if path != '/' else path
+    return host.endswith('.' + domain) and not is_ip_address(host)
+
+def normalize_path(path):
+    """
+    Return the path a cookie is indexed under. A trailing slash is ignored, and
+    a cookie without a path applies to the whole site.
+    """
+    return path.rstrip('/') or '/'
+
+def domain_suffixes(host):
+    """
+    Return the domains whose cookies apply to host, from its registrable
+    domain down to host itself, without its port. Public suffixes cannot
+    hold cookies, so they are left out, and an IP address only matches
+    itself.
+    """
+    host = strip_port(host)
+    labels = host.split('.')
+    if is_ip_address(host):
+        return [host]
+    registrable_domain = get_registrable_domain(host)
+    if registrable_domain is None:
+        return []
+    first = len(labels) - len(registrable_domain.split('.'))
+    return ['.'.join(labels[i:]) for i in reversed(range(first + 1))]
+
+def get_cookie_size(cookie):
+    return len(cookie.name) + len(cookie.value) + len(cookie.domain or '') + len(cookie.path or '')
+
+def path_prefixes(path):
+    """
+    Return the normalized cookie paths that match the request path, i.e. '/'
+    and every path made of leading segments of path.
+    """
+    prefixes = ['/']
+    end = path.find('/', 1)
+    while end != -1:
+        prefixes.append(path[:end])
+        end = path.find('/', end + 1)
+    if len(path) > 1 and not path.endswith('/'):
+        prefixes.append(path)
+    return prefixes
 
 
 class CookieManager(object):
-
-    def __init__(self, cache, key_prefix=''):
-        self.key_prefix = '.'.join([key_prefix, DEFAULT_COOKIE_KEY_PREFIX])
+    """
+    The cookies of a domain, or of an origin for cookies without a Domain
+    attribute, are packed into a single value kept in the cache under a
+    lookup key. Each cookie is packed as a compact tuple holding the time it
+    expires, so finding the cookies of a domain costs one get, and expired
+    cookies are skipped as they are read. A pack is kept in the cache until
+    its last cookie expires.
+
+    A cookie is identified by its lookup key, normalized path and name. The
+    manager keeps the expiry times of the cookies it has set in a min-heap.
+    Every sweep_interval seconds, up to sweep_batch expired cookies are
+    removed from their packs and usage records.
+
+    Every change to a pack also changes the jar version, kept in the cache
+    next to the cookies. The cookies that apply to a host and path are
+    memoized along with the version they were resolved at and the time the
+    first of them expires. Until either is reached, a request to the same
+    host and path gets its cookies from the memo with a single get.
+
+    The jar is bounded as suggested by RFC 6265 section 6.1. A cookie larger
+    than max_cookie_size bytes is ignored. Each site, i.e. registrable domain,
+    holds at most max_cookies_per_domain cookies, and the jar at most
+    max_cookies. When a new cookie goes over a limit, expired cookies are
+    dropped first, then the least recently used ones, from the site that
+    holds the most cookies in the case of the global limit. The cookies of a
+    site are accounted for in a usage record kept in the cache, and the
+    number and size of cookies per site are available from get_stats().
+
+    A cookie's last use is the later of when it was last set, as recorded in
+    the cache, and when this manager last sent it or was sent it again
+    unchanged. A cookie set again unchanged, as many sites do on every
+    response, writes nothing to the cache.
+
+    The packs and usage records of a site are only updated while holding the
+    lock returned by get_lock(site), so concurrent updates are not lost.
+
+    If a journal is given (see dogbutler.journal), every pack written is also
+    appended to it, and the live packs in the journal are loaded into the
+    cache when the manager is created. The usage records and expiry times of
+    the restored cookies are rebuilt from the packs.
+
+    A manager may have a parent, the manager of the session it was forked
+    from. A pack the manager has never written is read from the parent, so
+    the manager starts with the parent's cookies. The first time a cookie is
+    set or removed, the pack is copied, and from then on only the manager's
+    own copy is read. A pack emptied this way is kept as an empty tuple, so
+    that the parent's pack does not show through again. The parent's jar is
+    never written, and the limits only count the manager's own cookies.
+
+    Keys are compact, unless legacy_keys is True: packs are keyed by domain
+    after a '.', or by origin after a '/', and the version and usage records
+    after a ':', which no domain holds (see dogbutler.utils.keys). Packs
+    restored from a journal written with the other kind of keys are moved to
+    this manager's keys, in the cache and in the journal.
+    """
+
+    def __init__(self, cache, key_prefix='', sweep_interval=DEFAULT_SWEEP_INTERVAL, sweep_batch=DEFAULT_SWEEP_BATCH,
+                 max_cookies_per_domain=DEFAULT_MAX_COOKIES_PER_DOMAIN, max_cookies=DEFAULT_MAX_COOKIES,
+                 max_cookie_size=DEFAULT_MAX_COOKIE_SIZE, journal=None, parent=None, legacy_keys=False):
+        self.legacy_keys = legacy_keys
+        self._session_key_prefix = key_prefix
+        self.key_prefix = self._make_key_prefix(legacy_keys)
         self.cache = cache
+        self.parent = parent
+        self.keyspace = Keyspace()      # Packs written by a fork, which may hide the parent's, deleted by clear()
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self.max_cookies_per_domain = max_cookies_per_domain
+        self.max_cookies = max_cookies
+        self.max_cookie_size = max_cookie_size
+        self._expiry_heap = []          # (deadline, site, cookie id), including stale entries
+        self._deadlines = {}            # cookie id -> its live deadline in the heap
+        self._expiry_lock = Lock()
+        self._next_sweep = time() + sweep_interval
+        self._resolved = {}             # (host, path) -> (jar version, valid until, cookie ids, cookies)
+        self._last_used = {}            # cookie id -> when the cookie was last sent
+        self.journal = journal
+        if journal is not None and cache is not None:
+            self.restore()
 
     def process_request(self, request):
         """
@@ -66,6 +206,9 @@ class CookieManager(object):
         if self.cache is None:
             return
 
+        if time() >= self._next_sweep:
+            self.sweep()
+
         for key, value in self.get_cookies(request.url).items():
             request.cookies.setdefault(key, value)
 
@@ -78,124 +221,514 @@ class CookieManager(object):
 
         if response and response.has_header('Set-Cookie'):
             origin = urlparse(response.url).netloc
-            cookies = _make_cookie(response.headers['Set-Cookie'])
-            for name, cookie in cookies.items():
-                domain = cookie['domain']
-                if not domain:
+            host = strip_port(origin)
+            for cookie in parse_cookies(response):
+                if not cookie.domain or is_public_host_domain(cookie.domain, host):
                     self.set_origin_cookie(origin, cookie)
-                else:
+                elif domain_match(host, cookie.domain):
+                    # A site cannot set cookies for another (RFC 6265 section 5.3 step 6)
                     self.set_domain_cookie(cookie)
 
-    def get_domain_cookie_key(self, domain, path, name):
-        return '.'.join([self.key_prefix, normalize_domain(domain), path, name])
-
     def get_domain_cookie_lookup_key(self, domain):
         return '.'.join([self.key_prefix, normalize_domain(domain)])
 
-    def get_origin_cookie_key(self, origin, path, name):
-        return '.'.join([self.key_prefix, ORIGIN_COOKIE_KEY_PREFIX, normalize_domain(origin), path, name])
-
     def get_origin_cookie_lookup_key(self, origin):
-        return '.'.join([self.key_prefix, ORIGIN_COOKIE_KEY_PREFIX, normalize_domain(origin)])
+        return self._get_origin_key_prefix(self.legacy_keys) + normalize_domain(origin)
+
+    def get_version_key(self):
+        if not self.legacy_keys:
+            return self.key_prefix + ':v'
+        return '.'.join([self.key_prefix, COOKIE_VERSION_KEY])
+
+    def get_usage_key(self, site=None):
+        """
+        Return the key of the usage record of site, or of the jar totals if
+        site is None.
+        """
+        usage_key = self.key_prefix + ':u' if not self.legacy_keys else '.'.join([self.key_prefix, USAGE_KEY_PREFIX])
+        if site is None:
+            return usage_key
+        return '.'.join([usage_key, site])
+
+    def get_lock(self, site):
+        return _cookie_locks[hash((self.key_prefix, site)) % COOKIE_LOCK_STRIPES]
+
+    def get_stats(self):
+        """
+        Return a dictionary of site: (number of cookies, size in bytes) for
+        the sites that hold cookies. Cookies that have expired but have not
+        been swept yet are still counted.
+        """
+        count, sites = self.cache.get(self.get_usage_key()) or (0, {})
+        return dict(sites)
+
+    def clear(self):
+        """
+        Delete the packs, usage records and version of the jar from the
+        cache, and forget the expiry times and memos of its cookies. The
+        journal is left as it is, so its cookies are restored by the next
+        manager created with it.
+        """
+        if self.cache is None:
+            return
+        count, sites = self.cache.get(self.get_usage_key()) or (0, {})
+        for site in sites:
+            with self.get_lock(site):
+                usage = self.cache.get(self.get_usage_key(site)) or {}
+                for lookup_key in set(lookup_key for lookup_key, path, name in usage):
+                    self.cache.delete(lookup_key)
+                self.cache.delete(self.get_usage_key(site))
+        with _totals_lock:
+            self.cache.delete(self.get_usage_key())
+        self.cache.delete(self.get_version_key())
+        self.keyspace.purge(self.cache)
+        with self._expiry_lock:
+            self._expiry_heap = []
+            self._deadlines.clear()
+        self._resolved.clear()
+        self._last_used.clear()
+
+    def restore(self):
+        """
+        Load the live packs of the journal into the cache, along with their
+        usage records and expiry times.
+        """
+        now = time()
+        usages = {}
+        for lookup_key, site, written, pack in self.journal.items(now):
+            migrated_key = self._migrate_lookup_key(lookup_key)
+            if migrated_key != lookup_key:
+                self.journal.append(lookup_key, site, (), now)
+                self.journal.append(migrated_key, site, pack, written)
+                lookup_key = migrated_key
+            self._store_pack(lookup_key, pack, now)
+            usage = usages.setdefault(site, {})
+            for packed in pack:
+                cookie_id = (lookup_key, normalize_path(packed[3]), packed[0])
+                usage[cookie_id] = (written, get_cookie_size(unpack_cookie(packed)))
+                self._schedule_expiry(site, cookie_id, packed[4])
+        for site, usage in usages.items():
+            with self.get_lock(site):
+                self._write_usage(site, usage)
+        self._bump_version()
 
     def get_cookies(self, url):
         """
         Return a dictionary (key:value) of cookies for the given URL
         """
-        domain = urlparse(url).netloc
-        domain_parts = domain.split('.')
-        path = urlparse(url).path
-        cookies = self.get_origin_cookies(domain, path)
-        for i in reversed(range(len(domain_parts))):
-            d = '.'.join(domain_parts[i:])
-            c = self.get_domain_cookies(d, path)
-            cookies.update(c)
-        return cookies
+        url = urlparse(url)
+        paths = path_prefixes(url.path)
+        resolved_key = (url.netloc, paths[-1])
+        now = time()
+        version = self._get_version()
+        if version is not None:
+            resolved = self._resolved.get(resolved_key)
+            if resolved is not None and resolved[0] == version and now < resolved[1]:
+                self._touch(resolved[2], now)
+                return dict(resolved[3])
+
+        lookup_keys = [self.get_origin_cookie_lookup_key(url.netloc)]
+        lookup_keys.extend(self.get_domain_cookie_lookup_key(domain) for domain in domain_suffixes(url.netloc))
+        found = self._find_cookies(lookup_keys, paths, now)
+        cookies = dict((packed[0], packed[1]) for cookie_id, packed in found)
+        cookie_ids = [cookie_id for cookie_id, packed in found]
+
+        # The version was read before the packs, so a pack changed meanwhile
+        # leaves a memo that will not match the new version
+        if version is not None:
+            if len(self._resolved) >= RESOLVED_CACHE_SIZE:
+                self._resolved.clear()
+            expiries = [packed[4] for cookie_id, packed in found if packed[4] is not None]
+            self._resolved[resolved_key] = (version, min(expiries or [float('inf')]), cookie_ids, cookies)
+        self._touch(cookie_ids, now)
+        return dict(cookies)
+
+    def has_cookies(self, url):
+        """
+        Return True if the jar holds cookies for the given URL
+        """
+        if self.cache is None:
+            return False
+        return bool(self.get_cookies(url))
 
-    def get_domain_cookies(self, domain, path):
+    def get_domain_cookies(self, domain, paths):
         """
         Return a dictionary (key:value) of domain cookies
         """
-        return self.get_xxx_cookies(self.get_domain_cookie_lookup_key, domain, path)
+        return self.get_xxx_cookies(self.get_domain_cookie_lookup_key, domain, paths)
 
-    def get_origin_cookies(self, domain, path):
+    def get_origin_cookies(self, domain, paths):
         """
         Return a dictionary (key:value) of origin cookies
         """
-        return self.get_xxx_cookies(self.get_origin_cookie_lookup_key, domain, path)
+        return self.get_xxx_cookies(self.get_origin_cookie_lookup_key, domain, paths)
 
-    def get_xxx_cookies(self, get_lookup_key_fn, domain, path):
+    def get_xxx_cookies(self, get_lookup_key_fn, domain, paths):
         """
-        Return a dictionary (key:value) of xxx cookies
+        Return a dictionary (key:value) of xxx cookies whose path is in paths.
         """
-        lookup_key = get_lookup_key_fn(domain)
-        cookie_keys_set = self.cache.get(lookup_key) or set()
-        cookies = {}
-        expired_cookie_keys_set = set()
-        if cookie_keys_set:
-            for cookie_key in cookie_keys_set:
-                cookie = self.cache.get(cookie_key)
-                if cookie:
-                    if self._path_ok(cookie, path):
-                        cookies[cookie.key] = cookie.value
-                else:
-                    expired_cookie_keys_set.add(cookie_key)
-        self.cache.set(lookup_key, cookie_keys_set.difference(expired_cookie_keys_set))
-        return cookies
-
-    def _path_ok(self, cookie, url):
-        if not cookie['path']:
-            return True
-
-        if cookie['path'] and cookie['path'] == '/':
-            return True
-        request_path = urlparse(url).path
-
-        # This never happens in real system. request_path always starts with /.
-#        if not request_path.startswith('/'):
-#            request_path = '/' + request_path
-
-        if request_path == cookie['path']:
-            return True
-        elif cookie['path'].endswith('/') and request_path.startswith(cookie['path'][:-1]):
-            return True
-        elif request_path.startswith(cookie['path']) and request_path[len(cookie['path'])] == '/':
-            return True
-        else:
-            return False
+        found = self._find_cookies([get_lookup_key_fn(domain)], paths, time())
+        return dict((packed[0], packed[1]) for cookie_id, packed in found)
+
+    def get_domain_cookie(self, domain, path, name):
+        """
+        Return the domain cookie with the given path and name, or None.
+        """
+        return self.get_xxx_cookie(self.get_domain_cookie_lookup_key, domain, path, name)
+
+    def get_origin_cookie(self, origin, path, name):
+        """
+        Return the origin cookie with the given path and name, or None.
+        """
+        return self.get_xxx_cookie(self.get_origin_cookie_lookup_key, origin, path, name)
+
+    def get_xxx_cookie(self, get_lookup_key_fn, domain, path, name):
+        path = normalize_path(path)
+        now = time()
+        for packed in self._load_pack(get_lookup_key_fn(domain)) or ():
+            if packed[0] == name and normalize_path(packed[3]) == path and is_live(packed, now):
+                return unpack_cookie(packed)
+        return None
 
     def set_domain_cookie(self, cookie):
         """
         Set domain cookie (i.e. cookie that has Domain attribute) in cache.
         """
-        domain = cookie['domain']
+        domain = cookie.domain
         if not is_domain_valid(domain):
             return
 
-        max_age = get_max_age(cookie)
-        name = cookie.key
-        path = cookie['path']
-
-        cookie_key = self.get_domain_cookie_key(domain, path, name)
         lookup_key = self.get_domain_cookie_lookup_key(domain)
-        self.cache.set(cookie_key, cookie, max_age)
-
-        cookie_keys_set = self.cache.get(lookup_key) or set()
-        cookie_keys_set.add(cookie_key)
-        self.cache.set(lookup_key, cookie_keys_set, DEFAULT_COOKIE_MAX_AGE)
+        self._set_cookie(get_cookie_site(domain), lookup_key, cookie)
 
     def set_origin_cookie(self, origin, cookie):
         """
         Set origin cookie (i.e. cookie that does not have Domain attribute) in cache.
         """
-        max_age = get_max_age(cookie)
-        name = cookie.key
-        path = cookie['path']
-
-        cookie_key = self.get_origin_cookie_key(origin, path, name)
         lookup_key = self.get_origin_cookie_lookup_key(origin)
-        self.cache.set(cookie_key, cookie, max_age)
+        self._set_cookie(get_cookie_site(origin), lookup_key, cookie)
+
+    def sweep(self, now=None):
+        """
+        Remove up to sweep_batch expired cookies from their packs and usage
+        records. Each pack and usage record is written at most once per
+        sweep, and only if it changed, and the jar version is changed once
+        for all of them.
+        """
+        now = time() if now is None else now
+        expired = {}
+        with self._expiry_lock:
+            while self._expiry_heap and self._expiry_heap[0][0] <= now and len(expired) < self.sweep_batch:
+                deadline, site, cookie_id = heappop(self._expiry_heap)
+                if self._deadlines.get(cookie_id) != deadline:
+                    continue            # Stale, the cookie was set again or removed since
+                del self._deadlines[cookie_id]
+                expired[cookie_id] = site
+            self._next_sweep = now + self.sweep_interval
+
+        by_site = {}
+        for cookie_id, site in expired.items():
+            by_site.setdefault(site, []).append(cookie_id)
+        changed = False
+        for site, cookie_ids in by_site.items():
+            with self.get_lock(site):
+                changed = self._sweep_site(site, cookie_ids, now) or changed
+        if changed:
+            self._bump_version()
+
+    def _sweep_site(self, site, cookie_ids, now):
+        """
+        Remove the expired cookies of site from their packs and its usage
+        record. Return True if any pack changed.
+        """
+        packs = self._load_packs(set(lookup_key for lookup_key, path, name in cookie_ids))
+        changed = False
+        for lookup_key, pack in packs.items():
+            live = [packed for packed in pack if is_live(packed, now)]
+            if len(live) != len(pack):
+                packs[lookup_key] = live
+                self._write_pack(site, lookup_key, live, now, bump_version=False)
+                changed = True
+
+        usage = self.cache.get(self.get_usage_key(site)) or {}
+        usage_changed = False
+        for cookie_id in cookie_ids:
+            # The cookie may have been set again since, with a later expiry
+            if self._find_packed(packs, cookie_id) is None:
+                usage_changed = usage.pop(cookie_id, None) is not None or usage_changed
+        if usage_changed:
+            self._write_usage(site, usage)
+        return changed
+
+    def _set_cookie(self, site, lookup_key, cookie):
+        """
+        Pack the cookie, replacing the one with the same name and path, and
+        account for it in the usage record of site, which may evict other
+        cookies. A cookie that has already expired is removed instead.
+        """
+        size = get_cookie_size(cookie)
+        if size > self.max_cookie_size:
+            return
 
-        cookie_keys_set = self.cache.get(lookup_key) or set()
-        cookie_keys_set.add(cookie_key)
-        self.cache.set(lookup_key, cookie_keys_set, DEFAULT_COOKIE_MAX_AGE)
\ No newline at end of file
+        now = time()
+        expires = get_expiry(cookie, now)
+        path = normalize_path(cookie.path)
+        cookie_id = (lookup_key, path, cookie.name)
+        packed = pack_cookie(cookie._replace(expires=expires, max_age=None))
+        is_new = False
+
+        with self.get_lock(site):
+            current = self._load_pack(lookup_key) or ()
+            if packed in current and is_live(packed, now):
+                self._touch([cookie_id], now)
+                return
+            pack = [p for p in current
+                    if is_live(p, now) and not (p[0] == cookie.name and normalize_path(p[3]) == path)]
+            if is_live(packed, now):
+                pack.append(packed)
+                self._write_pack(site, lookup_key, pack, now)
+                self._schedule_expiry(site, cookie_id, expires)
+                is_new, count = self._record_usage(site, cookie_id, size, now)
+            else:
+                self._write_pack(site, lookup_key, pack, now)
+                self._schedule_expiry(site, cookie_id, None)
+                usage = self.cache.get(self.get_usage_key(site)) or {}
+                if usage.pop(cookie_id, None) is not None:
+                    self._write_usage(site, usage)
+
+        # Other sites are evicted from outside the lock of this site, so that
+        # no thread ever waits for a site lock while holding another
+        if is_new and count > self.max_cookies:
+            self._evict_from_jar(keep=cookie_id)
+
+    def _schedule_expiry(self, site, cookie_id, expires):
+        """
+        Make expires, or no expiry if it is None, the deadline at which the
+        cookie is swept. Entries of earlier deadlines are left in the heap
+        and skipped, until it holds about twice as many entries as there are
+        deadlines, when it is rebuilt without them.
+        """
+        with self._expiry_lock:
+            if expires is None:
+                self._deadlines.pop(cookie_id, None)
+            elif self._deadlines.get(cookie_id) != expires:
+                self._deadlines[cookie_id] = expires
+                heappush(self._expiry_heap, (expires, site, cookie_id))
+            if len(self._expiry_heap) > 2 * len(self._deadlines) + MIN_EXPIRY_HEAP_REBUILD:
+                self._expiry_heap = list(set(entry for entry in self._expiry_heap
+                                             if self._deadlines.get(entry[2]) == entry[0]))
+                heapify(self._expiry_heap)
+
+    def _record_usage(self, site, cookie_id, size, now):
+        """
+        Record the cookie in the usage record of site, and evict cookies
+        while site holds too many. Return a tuple of (whether the cookie is
+        new, number of cookies in the jar).
+        """
+        usage = self.cache.get(self.get_usage_key(site)) or {}
+        is_new = cookie_id not in usage
+        usage[cookie_id] = (now, size)
+        if is_new and len(usage) > self.max_cookies_per_domain:
+            self._evict(site, usage, len(usage) - self.max_cookies_per_domain, now, keep=cookie_id)
+        count, sites = self._write_usage(site, usage)
+        return is_new, count
+
+    def _evict_from_jar(self, keep=None):
+        """
+        Evict cookies from the sites that hold the most until the jar holds
+        no more than max_cookies.
+        """
+        count, sites = self.cache.get(self.get_usage_key()) or (0, {})
+        while count > self.max_cookies and sites:
+            largest = max(sites, key=lambda s: sites[s][0])
+            with self.get_lock(largest):
+                usage = self.cache.get(self.get_usage_key(largest)) or {}
+                evicted = self._evict(largest, usage, 1, time(), keep=keep)
+                count, sites = self._write_usage(largest, usage)
+            if not evicted and usage:
+                break
+
+    def _evict(self, site, usage, n, now, keep=None):
+        """
+        Remove at least n cookies from usage, the usage record of site, and
+        the jar, other than keep.
+        Expired cookies go first, then the least recently used ones. Return
+        the number of cookies removed.
+        """
+        packs = self._load_packs(set(lookup_key for lookup_key, path, name in usage))
+        victims = []
+        candidates = []
+        for cookie_id, (set_time, size) in usage.items():
+            if cookie_id == keep:
+                continue
+            packed = self._find_packed(packs, cookie_id)
+            if packed is None or not is_live(packed, now):
+                victims.append(cookie_id)
+            else:
+                candidates.append((max(set_time, self._last_used.get(cookie_id, 0)), cookie_id))
+        candidates.sort()
+        victims.extend(cookie_id for last_used, cookie_id in candidates[:max(n - len(victims), 0)])
+
+        changed = set()
+        for cookie_id in victims:
+            lookup_key, path, name = cookie_id
+            del usage[cookie_id]
+            self._last_used.pop(cookie_id, None)
+            self._schedule_expiry(site, cookie_id, None)
+            pack = packs.get(lookup_key) or []
+            packs[lookup_key] = [p for p in pack if not (p[0] == name and normalize_path(p[3]) == path)]
+            if len(packs[lookup_key]) != len(pack):
+                changed.add(lookup_key)
+        for lookup_key in changed:
+            self._write_pack(site, lookup_key, packs[lookup_key], now)
+        return len(victims)
+
+    def _write_usage(self, site, usage):
+        """
+        Store the usage record of site, and its number and size of cookies in
+        the jar totals. Return the totals, a tuple of (number of cookies in
+        the jar, dictionary of site: (number of cookies, size in bytes)).
+        """
+        if usage:
+            self.cache.set(self.get_usage_key(site), usage, DEFAULT_COOKIE_MAX_AGE)
+            summary = (len(usage), sum(size for set_time, size in usage.values()))
+        else:
+            self.cache.delete(self.get_usage_key(site))
+            summary = None
+        with _totals_lock:
+            count, sites = self.cache.get(self.get_usage_key()) or (0, {})
+            previous = sites.get(site)
+            if previous != summary:
+                count += (summary[0] if summary else 0) - (previous[0] if previous else 0)
+                if summary is None:
+                    del sites[site]
+                else:
+                    sites[site] = summary
+                self.cache.set(self.get_usage_key(), (count, sites), DEFAULT_COOKIE_MAX_AGE)
+        return count, sites
+
+    def _touch(self, cookie_ids, now):
+        if len(self._last_used) >= LAST_USED_CACHE_SIZE:
+            self._last_used.clear()
+        for cookie_id in cookie_ids:
+            self._last_used[cookie_id] = now
+
+    def _find_cookies(self, lookup_keys, paths, now):
+        """
+        Return a list of (cookie id, packed cookie) for the live cookies
+        packed at lookup_keys whose path is in paths. Later cookies take
+        priority over earlier ones with the same name: those of later lookup
+        keys, and within a lookup key those with a longer path.
+        """
+        paths = set(paths)
+        packs = self._load_packs(lookup_keys)
+        found = []
+        for lookup_key in lookup_keys:
+            matches = []
+            for packed in packs.get(lookup_key) or ():
+                path = normalize_path(packed[3])
+                if path in paths and is_live(packed, now):
+                    matches.append(((lookup_key, path, packed[0]), packed))
+            matches.sort(key=lambda match: len(match[0][1]))
+            found.extend(matches)
+        return found
+
+    def _find_packed(self, packs, cookie_id):
+        lookup_key, path, name = cookie_id
+        for packed in packs.get(lookup_key) or ():
+            if packed[0] == name and normalize_path(packed[3]) == path:
+                return packed
+        return None
+
+    def _load_packs(self, lookup_keys):
+        """
+        Return a dictionary of lookup key: pack, fetched with a single
+        get_many if the cache supports it.
+        """
+        get_many = getattr(self.cache, 'get_many', None)
+        if get_many is not None:
+            packs = get_many(list(lookup_keys))
+        else:
+            packs = dict((lookup_key, self.cache.get(lookup_key)) for lookup_key in lookup_keys)
+        if self.parent is not None:
+            missing = dict((self._get_parent_lookup_key(lookup_key), lookup_key)
+                           for lookup_key in lookup_keys if packs.get(lookup_key) is None)
+            if missing:
+                for parent_key, pack in self.parent._load_packs(missing.keys()).items():
+                    if pack is not None:
+                        packs[missing[parent_key]] = pack
+        return packs
+
+    def _load_pack(self, lookup_key):
+        return self._load_packs([lookup_key]).get(lookup_key)
+
+    def _make_key_prefix(self, legacy_keys):
+        if not legacy_keys:
+            return make_key_prefix(COOKIE_TAG, self._session_key_prefix)
+        return '.'.join([self._session_key_prefix, DEFAULT_COOKIE_KEY_PREFIX])
+
+    def _get_origin_key_prefix(self, legacy_keys):
+        if not legacy_keys:
+            return self._make_key_prefix(legacy_keys) + '/'
+        return '.'.join([self._make_key_prefix(legacy_keys), ORIGIN_COOKIE_KEY_PREFIX, ''])
+
+    def _migrate_lookup_key(self, lookup_key):
+        """
+        Return this manager's lookup key for the pack at lookup_key, which
+        may have been made with the other kind of keys.
+        """
+        for legacy_keys in (self.legacy_keys, not self.legacy_keys):
+            origin_key_prefix = self._get_origin_key_prefix(legacy_keys)
+            if lookup_key.startswith(origin_key_prefix):
+                return self.get_origin_cookie_lookup_key(lookup_key[len(origin_key_prefix):])
+            domain_key_prefix = self._make_key_prefix(legacy_keys) + '.'
+            if lookup_key.startswith(domain_key_prefix):
+                return self.get_domain_cookie_lookup_key(lookup_key[len(domain_key_prefix):])
+        return lookup_key
+
+    def _get_parent_lookup_key(self, lookup_key):
+        return self.parent.key_prefix + lookup_key[len(self.key_prefix):]
+
+    def _write_pack(self, site, lookup_key, pack, now, bump_version=True):
+        """
+        Store pack at lookup_key, append it to the journal, and move the jar
+        to a new version.
+        """
+        self._store_pack(lookup_key, pack, now)
+        if self.journal is not None:
+            self.journal.append(lookup_key, site, pack, now)
+        if bump_version:
+            self._bump_version()
+
+    def _store_pack(self, lookup_key, pack, now):
+        """
+        Store pack at lookup_key until its last cookie expires.
+        """
+        if self.parent is not None:
+            # The copy of a parent's pack holds cookies that are in none of
+            # the fork's usage records
+            self.keyspace.add(lookup_key)
+        if pack:
+            expiries = [packed[4] for packed in pack]
+            timeout = DEFAULT_COOKIE_MAX_AGE if None in expiries else max(expiries) - now
+            self.cache.set(lookup_key, tuple(pack), timeout)
+        elif self.parent is not None:
+            self.cache.set(lookup_key, (), DEFAULT_COOKIE_MAX_AGE)
+        else:
+            self.cache.delete(lookup_key)
+
+    def _get_version(self):
+        """
+        Return the version of the jar, along with those of its parents if it
+        has any, or None if none is known.
+        """
+        version = self.cache.get(self.get_version_key())
+        if self.parent is None:
+            return version
+        parent_version = self.parent._get_version()
+        if version is None and parent_version is None:
+            return None
+        return (version, parent_version)
+
+    def _bump_version(self):
+        self.cache.set(self.get_version_key(), '%016x' % getrandbits(64), DEFAULT_COOKIE_MAX_AGE)
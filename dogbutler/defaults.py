@@ -1,8 +1,11 @@
 from dummycache.cache import Cache
 
+DEFAULT_SHARED_KEY_PREFIX = 'shared'    # Key prefix of what the managers of all sessions share
+
 DEFAULT_CACHE = Cache()
 DEFAULT_COOKIE_CACHE = Cache()
 DEFAULT_REDIRECT_CACHE = Cache()
+LEGACY_KEYS = False
 
 def get_default_cache():
     return DEFAULT_CACHE
@@ -23,4 +26,15 @@ def get_default_redirect_cache():
 
 def set_default_redirect_cache(cache):
     global DEFAULT_REDIRECT_CACHE
-    DEFAULT_REDIRECT_CACHE = cache
\ No newline at end of file
+    DEFAULT_REDIRECT_CACHE = cache
+
+def get_default_legacy_keys():
+    return LEGACY_KEYS
+
+def set_default_legacy_keys(legacy_keys):
+    """
+    Make the sessions created from now on use the keys of earlier versions,
+    while the entries they left in a cache are still needed.
+    """
+    global LEGACY_KEYS
+    LEGACY_KEYS = legacy_keys
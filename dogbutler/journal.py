@@ -0,0 +1,195 @@
+"""
+This module keeps a cookie jar on disk as an append-only journal, so that the
+cookies of a session survive a restart.
+
+Every time the cookie manager writes the pack of a domain or origin, the new
+pack is appended to the journal as a single line. Replaying the journal keeps
+the last pack of each lookup key, so a restart restores the jar as it was.
+Packs that have become empty and cookies that have expired are dropped.
+
+The journal only grows, so once it holds more than compact_ratio lines per
+live pack, it is rewritten in the background with one line per live pack. The
+rewrite goes to a temporary file that replaces the journal when it is complete,
+so the journal on disk is always whole.
+
+A journal belongs to one key prefix, and so to one session:
+
+    s = Session(key_prefix='account-1', journal_dir='/var/lib/scraper/cookies')
+"""
+
+import os
+from ast import literal_eval
+from threading import Lock, Thread
+from time import time
+from urllib import quote
+
+from dogbutler.cookie import is_live
+
+
+JOURNAL_SUFFIX = '.cookies'
+DEFAULT_COMPACT_MIN_RECORDS = 1000  # Never compact a journal of fewer lines
+DEFAULT_COMPACT_RATIO = 2           # Compact when there are more lines than this many per live pack
+
+# Managers with the same key prefix must append to the same journal, or their
+# records would interleave and compaction would drop the other's, so journals
+# are shared by path within the process
+_journals = {}
+_journals_lock = Lock()
+
+
+def get_journal_path(directory, key_prefix):
+    return os.path.join(directory, quote(key_prefix, safe='') + JOURNAL_SUFFIX)
+
+def get_cookie_journal(directory, key_prefix):
+    """
+    Return the journal of key_prefix in directory, opened once per process.
+    """
+    path = os.path.abspath(get_journal_path(directory, key_prefix))
+    with _journals_lock:
+        journal = _journals.get(path)
+        if journal is None or journal.closed:
+            journal = _journals[path] = CookieJournal(path)
+        return journal
+
+def get_live_cookies(pack, now):
+    return tuple(packed for packed in pack if is_live(packed, now))
+
+
+class CookieJournal(object):
+    """
+    An append-only journal of cookie packs. Each line is the repr of a tuple
+    of (lookup key, site, time written, pack), where pack is a tuple of
+    packed cookies, or empty if the pack was deleted.
+
+    The journal is read once, when it is opened, and the last pack of each
+    lookup key is kept in memory to be replayed and compacted. A line torn by
+    a crash is skipped.
+
+    Lines are flushed as they are written, but not synced to disk.
+    """
+
+    def __init__(self, path, compact_min_records=DEFAULT_COMPACT_MIN_RECORDS, compact_ratio=DEFAULT_COMPACT_RATIO):
+        self.path = path
+        self.compact_min_records = compact_min_records
+        self.compact_ratio = compact_ratio
+        self._lock = Lock()             # Guards _packs, _records, _pending and _file
+        self._packs = {}                # lookup key -> (site, time written, pack)
+        self._records = 0               # Number of lines in the journal
+        self._pending = None            # Lines appended during a compaction, to carry over to the new journal
+        self._compactor = None
+        self._file = None
+        self._load()
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    def items(self, now=None):
+        """
+        Return a list of (lookup key, site, time written, pack) for the packs
+        that still hold live cookies, with their expired cookies left out.
+        """
+        now = time() if now is None else now
+        with self._lock:
+            packs = self._packs.items()
+        items = []
+        for lookup_key, (site, written, pack) in packs:
+            pack = get_live_cookies(pack, now)
+            if pack:
+                items.append((lookup_key, site, written, pack))
+        return items
+
+    def append(self, lookup_key, site, pack, now):
+        """
+        Record that the pack at lookup_key is now pack.
+        """
+        record = (lookup_key, site, now, tuple(pack))
+        line = repr(record) + '\n'
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line)
+            self._file.flush()
+            self._records += 1
+            if pack:
+                self._packs[lookup_key] = record[1:]
+            else:
+                self._packs.pop(lookup_key, None)
+            if self._pending is not None:
+                self._pending.append(line)
+            elif self._should_compact():
+                self._pending = []
+                self._compactor = Thread(target=self._compact)
+                self._compactor.daemon = True
+                self._compactor.start()
+
+    def compact(self, now=None):
+        """
+        Rewrite the journal with one line per live pack, unless it is already
+        being compacted.
+        """
+        with self._lock:
+            if self._file is None or self._pending is not None:
+                return
+            self._pending = []
+        self._compact(now)
+
+    def _compact(self, now=None):
+        """
+        Write the live packs to a new journal, then swap it in along with the
+        lines appended meanwhile.
+        """
+        now = time() if now is None else now
+        tmp_path = self.path + '.tmp'
+        items = self.items(now)
+        try:
+            with open(tmp_path, 'w') as f:
+                for lookup_key, site, written, pack in items:
+                    f.write(repr((lookup_key, site, written, pack)) + '\n')
+                with self._lock:
+                    f.writelines(self._pending)
+                    f.close()
+                    if self._file is not None:
+                        os.rename(tmp_path, self.path)
+                        self._file.close()
+                        self._file = open(self.path, 'a')
+                        self._records = len(items) + len(self._pending)
+                        self._pending = None
+                        for lookup_key, (site, written, pack) in self._packs.items():
+                            if not get_live_cookies(pack, now):
+                                del self._packs[lookup_key]
+        finally:
+            with self._lock:
+                self._pending = None
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _should_compact(self):
+        return self._records >= self.compact_min_records and self._records > self.compact_ratio * len(self._packs)
+
+    def _load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                content = f.read()
+            # Cut off a line torn by a crash, so the next line starts afresh
+            end = content.rfind('\n') + 1
+            if end < len(content):
+                with open(self.path, 'r+b') as f:
+                    f.truncate(end)
+            for line in content[:end].splitlines():
+                try:
+                    lookup_key, site, written, pack = literal_eval(line)
+                except (SyntaxError, ValueError):
+                    continue
+                self._records += 1
+                if pack:
+                    self._packs[lookup_key] = (site, written, pack)
+                else:
+                    self._packs.pop(lookup_key, None)
+        self._file = open(self.path, 'a')
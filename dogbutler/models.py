@@ -8,6 +8,8 @@ class Request(object):
         self.method = method
         self.cookies = kwargs.get('cookies', {})
         self.headers = CaseInsensitiveDict(kwargs.get('headers', {}))
+        self.auth = kwargs.get('auth')
+        self.credentials = False        # Set by the session if it adds credentials of its own
 
     @property
     def path(self):
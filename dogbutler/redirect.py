@@ -1,43 +1,455 @@
+from random import getrandbits
+from time import time
+from urlparse import urlsplit, urlunsplit
+
 from requests.exceptions import TooManyRedirects
 
+from dogbutler.defaults import DEFAULT_SHARED_KEY_PREFIX
+from dogbutler.utils.cache import get_max_age, has_credentials
+from dogbutler.utils.keys import REDIRECT_TAG, get_digest, make_key_prefix
+from dogbutler.utils.keyspace import Keyspace
+
 
 DEFAULT_REDIRECT_KEY_PREFIX = 'redirect'
 DEFAULT_REDIRECT_MAX_AGE = 60 * 60 * 24 * 365 * 10       # 10 years
+REDIRECT_VERSION_KEY = 'version'                        # Not a URL, so no redirect can clash with it
+REDIRECT_RULE_KEY_PREFIX = 'rule'
+DEFAULT_RULE_CONFIDENCE = 3                             # Number of paths seen redirected before a rule applies
+PERMANENT_REDIRECT_STATI = (301, 308)
+TEMPORARY_REDIRECT_STATI = (302, 303, 307)
+
+
+def get_redirect_timeout(response):
+    """
+    Return the number of seconds a redirect response can be cached for, or
+    None if it cannot be cached. Permanent redirects are cached for good,
+    and temporary ones for their max-age.
+    """
+    if response.status_code in PERMANENT_REDIRECT_STATI:
+        return DEFAULT_REDIRECT_MAX_AGE
+    if response.status_code in TEMPORARY_REDIRECT_STATI:
+        cache_control = response.headers.get('Cache-Control') or ''
+        if 'no-cache' in cache_control or 'no-store' in cache_control:
+            return None
+        max_age = get_max_age(response)
+        if max_age > 0:
+            return max_age
+    return None
+
+def get_origin(url):
+    """
+    Return the scheme and host of url, e.g. 'http://www.test.com'.
+    """
+    parts = urlsplit(url)
+    return '%s://%s' % (parts.scheme.lower(), parts.netloc.lower())
+
+def get_origin_redirect(url, redirect_to):
+    """
+    Return the origin url is moved to, if redirect_to is url with only its
+    scheme or host changed, e.g. from http://test.com/path to
+    https://www.test.com/path. Return None otherwise.
+    """
+    source, target = urlsplit(url), urlsplit(redirect_to)
+    if not target.scheme or not target.netloc or (source.path or '/', source.query) != (target.path or '/', target.query):
+        return None
+    origin = '%s://%s' % (target.scheme.lower(), target.netloc.lower())
+    return origin if origin != get_origin(url) else None
+
+def rewrite_origin(url, origin):
+    parts = urlsplit(url)
+    return origin + urlunsplit(('', '', parts.path, parts.query, parts.fragment))
+
+def earliest(*times):
+    """
+    Return the earliest of times, where None means never.
+    """
+    times = [t for t in times if t is not None]
+    return min(times) if times else None
+
+def has_userinfo(url):
+    return '@' in urlsplit(url).netloc
 
 
 class RedirectManager(object):
+    """
+    Redirects are kept in the cache as one entry per URL, holding a tuple of
+    (Location, expires, final target, version, valid until). Location is the
+    next hop, and expires is when the redirect itself expires, or None for a
+    permanent one. 301 and 308 are permanent. 302, 303 and 307 are cached
+    only if they have a max-age, and only for as long. Only GET requests are
+    redirected, so whether a redirect preserves the method does not matter.
+
+    Permanent redirects that cannot depend on who asked, i.e. those of
+    requests without cookies or an Authorization header that do not set
+    cookies themselves, are kept under shared_key_prefix, where every
+    manager with the same shared_key_prefix and cache learns from them. All
+    other redirects are kept under the manager's own key_prefix, and
+    override the shared ones. A shared_key_prefix of None shares nothing.
+    Requests with credentials only follow the manager's own redirects and
+    rules, since a shared redirect was learned without them.
+
+    The final target is where the whole chain of cached redirects from the
+    URL ends. It is valid while the redirect versions are the ones stored
+    with it, and until the first temporary redirect in the chain expires.
+    Every change to the stored redirects moves them to a new version. A
+    shared entry holds the shared version and only ever points along shared
+    entries, while an entry of the manager's own holds both versions.
+
+    Permanent redirects that only change the scheme or host of a URL, e.g.
+    http to https or test.com to www.test.com, are also generalized into a
+    rule for the whole origin. Once rule_confidence different paths of an
+    origin have been seen moved to the same new origin, and none of them
+    to another, any other URL of the origin is rewritten before it is first
+    requested. The URL is then given an entry of its own.
 
-    def __init__(self, cache, key_prefix=''):
-        self.key_prefix = '.'.join([key_prefix, DEFAULT_REDIRECT_KEY_PREFIX])
+    Resolving a URL whose final target is still valid costs one round trip
+    for the versions and the URL, whatever the length of its chain.
+    Otherwise the chain is followed hop by hop, and every URL in it is
+    pointed at the final target again.
+
+    Keys are compact, unless legacy_keys is True: a URL is keyed by its
+    digest, and the version and rules by a character that no digest holds
+    (see dogbutler.utils.keys).
+    """
+
+    def __init__(self, cache, key_prefix='', rule_confidence=DEFAULT_RULE_CONFIDENCE,
+                 shared_key_prefix=DEFAULT_SHARED_KEY_PREFIX, legacy_keys=False):
+        self.legacy_keys = legacy_keys
+        self.key_prefix = self._make_key_prefix(key_prefix)
+        self.shared_key_prefix = None
+        if shared_key_prefix is not None:
+            self.shared_key_prefix = self._make_key_prefix(shared_key_prefix)
         self.cache = cache
+        self.rule_confidence = rule_confidence
+        self.keyspace = Keyspace()      # Keys written under key_prefix, deleted by clear()
+
+    def get_cache_key(self, url, shared=False):
+        if not self.legacy_keys:
+            return '.'.join([self._get_key_prefix(shared), get_digest(url)])
+        return '.'.join([self._get_key_prefix(shared), url])
+
+    def get_version_key(self, shared=False):
+        if not self.legacy_keys:
+            return self._get_key_prefix(shared) + ':v'
+        return '.'.join([self._get_key_prefix(shared), REDIRECT_VERSION_KEY])
+
+    def get_rule_key(self, url, shared=False):
+        if not self.legacy_keys:
+            return '/'.join([self._get_key_prefix(shared), get_origin(url)])
+        return '.'.join([self._get_key_prefix(shared), REDIRECT_RULE_KEY_PREFIX, get_origin(url)])
+
+    def clear(self):
+        """
+        Delete the redirects learned under the manager's own key prefix. The
+        shared ones are left for the other managers.
+        """
+        self.keyspace.purge(self.cache)
 
-    def get_cache_key(self, url):
-        return '.'.join([self.key_prefix, url])
+    def get_rule(self, url, shared_only=False, own_only=False):
+        """
+        Return the origin that the origin of url is moved to, or None if no
+        rule applies to it. A rule of the manager's own takes priority over
+        a shared one, unless shared_only is True. Shared rules are ignored if
+        own_only is True.
+        """
+        rule = None
+        if not shared_only:
+            rule = self.cache.get(self.get_rule_key(url))
+        if rule is None and self.shared_key_prefix is not None and not own_only:
+            rule = self.cache.get(self.get_rule_key(url, shared=True))
+        return self._get_rule_target(rule)
 
     def process_request(self, request):
         if self.cache is None:
             return
 
-        url = request.url
-        history = []
+        request.url = self.resolve([request.url], credentials=has_credentials(request))[0]
+
+    def process_response(self, request, response, allow_redirects=True):
+        """
+        Record the redirects response went through. A redirect response that
+        was not followed although it could have been, e.g. a 308 to an older
+        requests, is recorded as well, but not if the caller asked for
+        redirects not to be followed.
+        """
+        if self.cache is None:
+            return
+
+        hops = list(response.history)
+        final = response.url
+        if response.status_code in PERMANENT_REDIRECT_STATI + TEMPORARY_REDIRECT_STATI:
+            if not allow_redirects:
+                return
+            hops.append(response)
+            final = None
+        if not hops:
+            return
+
+        request.url = response.url
+        now = time()
+        can_share = self.shared_key_prefix is not None and not has_credentials(request)
+
+        # Walk the chain backwards, so each redirect can point straight at the
+        # end of the run of cached redirects after it. The target is only
+        # known to be final if the run ends at the URL that answered.
+        writes = []
+        targets = {}
+        for r in reversed(hops):
+            timeout = get_redirect_timeout(r)
+            redirect_to = r.headers.get('Location')
+            if timeout is None or redirect_to is None:
+                continue
+            expires = now + timeout if r.status_code in TEMPORARY_REDIRECT_STATI else None
+            shared = (can_share and r.status_code in PERMANENT_REDIRECT_STATI and 'Set-Cookie' not in r.headers
+                      and not has_userinfo(r.url) and not has_userinfo(redirect_to))
+            if redirect_to in targets:
+                target, valid_until, shared_run = targets[redirect_to]
+                valid_until = earliest(valid_until, expires)
+                shared_run = shared_run and shared
+            elif redirect_to == final:
+                target, valid_until, shared_run = redirect_to, expires, shared
+            else:
+                target = valid_until = None
+            if target is not None:
+                targets[r.url] = (target, valid_until, shared_run)
+                if shared and not shared_run:
+                    target = None
+            writes.append((shared, r.url, redirect_to, expires, timeout, target, valid_until))
+
+        # Entries are only written, and versions only moved, if they change,
+        # so that seeing the same shared redirect again does not undo the
+        # compression of every other manager, and a manager only gets a
+        # version of its own once it has redirects of its own
+        own_writes = [write for write in writes if not write[0]]
+        shared_writes = [write for write in writes if write[0]]
+        keys = [self.get_cache_key(write[1], shared=True) for write in shared_writes]
+        if final is not None:
+            keys.append(self.get_cache_key(final))
+            if can_share:
+                keys.append(self.get_cache_key(final, shared=True))
+        found = self._get_many(keys)
+        shared_writes = [write for write in shared_writes
+                         if self._get_location(found.get(self.get_cache_key(write[1], shared=True))) != write[2]]
+        own_changed, shared_changed = bool(own_writes), bool(shared_writes)
+        if final is not None:
+            # The URL that answered does not redirect any more, if it ever did
+            if found.get(self.get_cache_key(final)) is not None:
+                self.cache.delete(self.get_cache_key(final))
+                own_changed = True
+            if can_share and found.get(self.get_cache_key(final, shared=True)) is not None:
+                self.cache.delete(self.get_cache_key(final, shared=True))
+                shared_changed = True
+        for shared, url, redirect_to, expires, timeout, target, valid_until in writes:
+            if expires is None and self._learn_rule(url, redirect_to, shared):
+                if shared:
+                    shared_changed = True
+                else:
+                    own_changed = True
+
+        shared_version = None
+        if shared_changed:
+            shared_version = self._bump_version(shared=True)
+        elif own_writes:
+            shared_version = self._get_shared_version()
+        if own_changed:
+            version = (self._bump_version(), shared_version)
+        for shared, url, redirect_to, expires, timeout, target, valid_until in own_writes:
+            self._set_entry(url, (redirect_to, expires, target, version if target else None, valid_until), timeout)
+        for shared, url, redirect_to, expires, timeout, target, valid_until in shared_writes:
+            entry = (redirect_to, expires, target, shared_version if target else None, valid_until)
+            self._set_entry(url, entry, timeout, shared=True)
+
+    def resolve(self, urls, credentials=False):
+        """
+        Return the URLs that urls redirect to, in the same order. If
+        credentials is True, i.e. the requests carry cookies or an
+        Authorization header, only the manager's own redirects and rules
+        are followed.
+
+        The entries of all urls, both the manager's own and the shared ones,
+        are fetched in a single round trip, with get_many if the cache
+        supports it, along with the rules of their origins. Without get_many,
+        rules are only fetched for URLs without an entry. Only the chains
+        that changed since they were last resolved are followed hop by hop.
+        Raise TooManyRedirects if any of urls is in a redirect loop.
+        """
+        urls = list(urls)
+        if self.cache is None:
+            return urls
+
+        now = time()
+        sharing = self.shared_key_prefix is not None and not credentials
+        namespaces = [False, True] if sharing else [False]
+        keys = [self.get_version_key(shared) for shared in namespaces]
+        keys.extend(self.get_cache_key(url, shared) for url in urls for shared in namespaces)
+        prefetch_rules = self.rule_confidence and hasattr(self.cache, 'get_many')
+        if prefetch_rules:
+            keys.extend(set(self.get_rule_key(url, shared) for url in urls for shared in namespaces))
+        found = self._get_many(keys)
+        own_version = found.get(self.get_version_key())
+        shared_version = found.get(self.get_version_key(shared=True)) if sharing else None
+        version = (own_version, shared_version)
+        # A manager that has learned nothing of its own sees the shared
+        # redirects as they are
+        shared_only = sharing and own_version is None
+
+        resolved = {}
+        for url in urls:
+            if url in resolved:
+                continue
+            entry = found.get(self.get_cache_key(url))
+            if entry is not None:
+                if self._is_valid(entry, version, now):
+                    resolved[url] = entry[2]
+                else:
+                    resolved[url] = self._follow(url, entry, version, now, False, not sharing)
+                continue
+
+            entry = found.get(self.get_cache_key(url, shared=True)) if sharing else None
+            if entry is not None:
+                if shared_only and self._is_valid(entry, shared_version, now):
+                    resolved[url] = entry[2]
+                else:
+                    resolved[url] = self._follow(url, entry, version, now, shared_only)
+                continue
+
+            target = None
+            if prefetch_rules:
+                rule = found.get(self.get_rule_key(url))
+                if rule is None and sharing:
+                    rule = found.get(self.get_rule_key(url, shared=True))
+                target = self._get_rule_target(rule)
+            elif self.rule_confidence:
+                target = self.get_rule(url, own_only=not sharing)
+            if target is None:
+                resolved[url] = url
+            else:
+                resolved[url] = self._follow(url, (rewrite_origin(url, target), None), version, now, shared_only,
+                                             not sharing)
+        return [resolved[url] for url in urls]
+
+    def _is_valid(self, entry, version, now):
+        if isinstance(entry, basestring) or entry[3] is None or entry[3] != version:
+            return False
+        return entry[4] is None or now < entry[4]
+
+    def _follow(self, url, entry, version, now, shared_only, own_only=False):
+        """
+        Follow the chain of redirects and rules from url, whose entry is
+        entry, and point every URL in it at the end of the chain. If
+        shared_only is True, only shared redirects are followed, and the
+        chain is stored as shared entries. If own_only is True, shared
+        redirects are not followed.
+        """
+        chain = []
+        seen = set()
         while True:
-            if url in history:
+            if url in seen:
                 raise TooManyRedirects()
-            redirect_to = self.cache.get(self.get_cache_key(url))
-            if redirect_to is None:
+            seen.add(url)
+            if entry is None:
+                target = self.get_rule(url, shared_only, own_only) if self.rule_confidence else None
+                if target is None:
+                    break
+                entry = (rewrite_origin(url, target), None)
+            elif isinstance(entry, basestring):
+                # Entries stored before chains were compressed hold the Location only
+                entry = (entry, None)
+            elif entry[1] is not None and entry[1] <= now:
+                # A temporary redirect that has expired, although the cache still holds it
                 break
-            history.append(url)
-            url = redirect_to
-        request.url = url
+            chain.append((url, entry[0], entry[1]))
+            url = entry[0]
+            entry = self._get_entry(url, shared_only, own_only)
 
-    def process_response(self, request, response):
-        if self.cache is None:
-            return
+        own_version, shared_version = version
+        if shared_only:
+            if shared_version is None:
+                shared_version = self._bump_version(shared=True)
+            version = shared_version
+        elif own_version is None:
+            version = (self._bump_version(), shared_version)
+        valid_until = None
+        for source, redirect_to, expires in reversed(chain):
+            valid_until = earliest(valid_until, expires)
+            timeout = DEFAULT_REDIRECT_MAX_AGE if expires is None else expires - now
+            if timeout > 0:
+                self._set_entry(source, (redirect_to, expires, url, version, valid_until), timeout, shared=shared_only)
+        return url
+
+    def _get_entry(self, url, shared_only=False, own_only=False):
+        entry = None
+        if not shared_only:
+            entry = self.cache.get(self.get_cache_key(url))
+        if entry is None and self.shared_key_prefix is not None and not own_only:
+            entry = self.cache.get(self.get_cache_key(url, shared=True))
+        return entry
+
+    def _set_entry(self, url, entry, timeout, shared=False):
+        self._set(self.get_cache_key(url, shared), entry, timeout, shared)
+
+    def _set(self, key, value, timeout, shared=False):
+        if not shared:
+            self.keyspace.add(key)
+        self.cache.set(key, value, timeout)
+
+    def _get_location(self, entry):
+        if entry is None or isinstance(entry, basestring):
+            return entry
+        return entry[0]
+
+    def _get_rule_target(self, rule):
+        """
+        Return the origin a rule moves to, if it has been seen often enough.
+        A rule is a tuple of (origin, paths seen moved to it).
+        """
+        if rule is None or rule[0] is None or len(rule[1]) < self.rule_confidence:
+            return None
+        return rule[0]
+
+    def _learn_rule(self, url, redirect_to, shared=False):
+        """
+        Count a permanent redirect towards the rule for the origin of url. A
+        redirect of the origin to another origin starts the count again.
+        Return True if the rule changed.
+        """
+        if not self.rule_confidence:
+            return False
+        target = get_origin_redirect(url, redirect_to)
+        if target is None:
+            return False
+        rule_key = self.get_rule_key(url, shared)
+        rule = self.cache.get(rule_key)
+        path = urlsplit(url).path or '/'
+        if rule is None or rule[0] != target:
+            rule = (target, (path,))
+        elif path not in rule[1] and len(rule[1]) < self.rule_confidence:
+            rule = (target, rule[1] + (path,))
+        else:
+            return False
+        self._set(rule_key, rule, DEFAULT_REDIRECT_MAX_AGE, shared)
+        return True
+
+    def _get_key_prefix(self, shared):
+        return self.shared_key_prefix if shared else self.key_prefix
+
+    def _make_key_prefix(self, key_prefix):
+        if not self.legacy_keys:
+            return make_key_prefix(REDIRECT_TAG, key_prefix)
+        return '.'.join([key_prefix, DEFAULT_REDIRECT_KEY_PREFIX])
+
+    def _get_shared_version(self):
+        if self.shared_key_prefix is None:
+            return None
+        return self.cache.get(self.get_version_key(shared=True))
+
+    def _get_many(self, keys):
+        get_many = getattr(self.cache, 'get_many', None)
+        if get_many is not None:
+            return get_many(keys)
+        return dict((key, self.cache.get(key)) for key in keys)
 
-        if response.history:
-            request.url = response.url
-            for r in response.history:
-                if r.status_code == 301:
-                    #TODO: handle case of no Location header
-                    redirect_to = r.headers.get('Location')
-                    self.cache.set(self.get_cache_key(r.url), redirect_to, DEFAULT_REDIRECT_MAX_AGE)
+    def _bump_version(self, shared=False):
+        version = '%016x' % getrandbits(64)
+        self._set(self.get_version_key(shared), version, DEFAULT_REDIRECT_MAX_AGE, shared)
+        return version
@@ -1,65 +1,254 @@
+from itertools import count
+from random import getrandbits
+from threading import Lock
+from time import time
+
+from requests.cookies import cookiejar_from_dict
 from requests.sessions import Session as requests_Session
 
 from .cache import CacheManager
 from .cookie import CookieManager
-from .defaults import get_default_cache, get_default_cookie_cache, get_default_redirect_cache
+from .defaults import get_default_cache, get_default_cookie_cache, get_default_redirect_cache, get_default_legacy_keys
+from .journal import get_cookie_journal
 from .models import Request
 from .redirect import RedirectManager
 from .utils.rand import random_string
 
 
+DEFAULT_REAP_INTERVAL = 60      # in seconds, between looks for idle sessions
+KEY_PREFIX_LENGTH = 16          # Of the random key prefix of a session, about 82 bits
+LEGACY_KEY_PREFIX_LENGTH = 64
+
+# The sessions that have an idle timeout, as session id -> (managers, last
+# used, idle timeout). The managers are held rather than the session, so that
+# a session discarded without being closed is still purged once idle
+_idle_sessions = {}
+_idle_lock = Lock()
+_next_reap = 0
+_session_ids = count()
+
+
+def reap_idle_sessions(now=None):
+    """
+    Purge the keyspace of every session that has not been used for longer
+    than its idle timeout. Return the number of sessions purged.
+    """
+    global _next_reap
+    now = time() if now is None else now
+    with _idle_lock:
+        _next_reap = now + DEFAULT_REAP_INTERVAL
+        idle = [session_id for session_id, (managers, last_used, idle_timeout) in _idle_sessions.items()
+                if now - last_used >= idle_timeout]
+        idle = [_idle_sessions.pop(session_id)[0] for session_id in idle]
+    for managers in idle:
+        for manager in managers:
+            manager.clear()
+    return len(idle)
+
+
 class Session(requests_Session):
+    """
+    A session keeps its responses, cookies and redirects in the caches under
+    its own key prefix, its keyspace. close() purges the keyspace and closes
+    the connections of the session, and so does leaving a with block:
+
+        with Session() as s:
+            s.get('http://www.google.com')
+
+    A session given an idle_timeout, in seconds, is purged once it has not
+    been used for that long, even if it was never closed. Idle sessions are
+    looked for at most every DEFAULT_REAP_INTERVAL seconds, as requests are
+    made. A purged session can still be used, and starts afresh.
+
+    fork() returns a child session that starts with the cached responses and
+    cookies of its parent, without copying them.
+
+    A session given legacy_keys=True keeps its data under the keys of earlier
+    versions. It defaults to what set_default_legacy_keys() was last given.
+    """
 
     def __init__(self, **kwargs):
-        self.key_prefix = kwargs.pop('key_prefix') if 'key_prefix' in kwargs else random_string(64)
+        self.legacy_keys = kwargs.pop('legacy_keys', get_default_legacy_keys())
+        if 'key_prefix' in kwargs:
+            self.key_prefix = kwargs.pop('key_prefix')
+        else:
+            self.key_prefix = random_string(LEGACY_KEY_PREFIX_LENGTH if self.legacy_keys else KEY_PREFIX_LENGTH)
+        self.journal_dir = kwargs.pop('journal_dir', None)
+        self.idle_timeout = kwargs.pop('idle_timeout', None)
+        self._managers = None
+        self._parent = None
+        self._id = next(_session_ids)
         super(Session, self).__init__(**kwargs)
 
+    def fork(self):
+        """
+        Return a child session that reads through to the cached responses and
+        cookies of this session until it writes its own. The responses the
+        child caches and the cookies it sets or removes are its own, and this
+        session never sees them. The child learns its redirects afresh, apart
+        from the shared ones, keeps no journal, and shares the connections
+        of this session.
+
+        A fork neither makes a new random key prefix nor a new pool of
+        connections, so it is cheap to create, and holds little until it is used.
+        """
+        child = object.__new__(type(self))
+        child.__dict__.update(self.__dict__)
+        # A random suffix, since a parent with a fixed key prefix must not get
+        # the same children in another process or after a restart
+        child.key_prefix = '%s-%016x' % (self.key_prefix, getrandbits(64))
+        child.journal_dir = None
+        child._managers = None
+        child._parent = self
+        child._id = next(_session_ids)
+        for attr in ('headers', 'proxies', 'hooks', 'params', 'config'):
+            setattr(child, attr, dict(getattr(self, attr)))
+        child.cookies = cookiejar_from_dict({})
+        for cookie in self.cookies:
+            child.cookies.set_cookie(cookie)
+        return child
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Purge the responses, cookies and redirects the session keeps under
+        its own key prefix, and close its connections. The responses and
+        redirects it shares with other sessions, and its journal, are left.
+        """
+        with _idle_lock:
+            _idle_sessions.pop(self._id, None)
+        if self._managers is not None:
+            for manager in self._managers:
+                manager.clear()
+        # Older pool managers cannot close their connections, which are then
+        # closed as the pool manager is dropped. A fork leaves the connections
+        # to the session it was forked from.
+        clear = getattr(self.poolmanager, 'clear', None)
+        if clear is not None and self._parent is None:
+            clear()
+        self.init_poolmanager()
+
+    def touch(self):
+        """
+        Record that the session is in use, and purge the sessions that are
+        idle if it is time to look for them.
+        """
+        now = time()
+        if self.idle_timeout is not None:
+            managers = self.get_managers()
+            with _idle_lock:
+                _idle_sessions[self._id] = (managers, now, self.idle_timeout)
+        if now >= _next_reap:
+            reap_idle_sessions(now)
+
     def request(self, method, url, queue=None, **kwargs):
 
         method = str(method).upper()
         if method == 'GET':
 
-            # Create managers
-            cache_manager = CacheManager(cache=get_default_cache(), key_prefix=self.key_prefix)
-            cookie_manager = CookieManager(cache=get_default_cookie_cache(), key_prefix=self.key_prefix)
-            redirect_manager = RedirectManager(cache=get_default_redirect_cache(), key_prefix=self.key_prefix)
-
             # Convert to Request object
             request = Request(url, method=method, **kwargs)
 
-            # Process request
-            redirect_manager.process_request(request)                   # Redirect if previously got 301
-            cookie_manager.process_request(request)                     # Set cookies
-            response = cache_manager.process_request(request)           # Get from cache if conditions are met
-            if response is not None:
-                if queue: queue.put(response)
-                return response
+            response = self.process_request(request)
+            if response is None:
+                response = self.fetch(request, **kwargs)
+
+        else:
+            # Other methods are never answered from cache, but they share the cookie jar
+            request = Request(url, method=method, **kwargs)
+            self.touch()
+            redirect_manager, cookie_manager, cache_manager = self.get_managers()
+            cookie_manager.process_request(request)
+            if request.cookies: kwargs['cookies'] = request.cookies
+            response = super(Session, self).request(method, url, **kwargs)
+            cookie_manager.process_response(request, response)
+
+        if queue: queue.put(response)
+        return response
 
-            # Update kwargs
-            if request.headers: kwargs['headers'] = request.headers     # Update kwargs with new headers
-            if request.cookies: kwargs['cookies'] = request.cookies     # Update kwargs with new cookies
+    def get_managers(self):
+        """
+        Return the (redirect, cookie, cache) managers for this session. The
+        managers live as long as the session, and are replaced only when the
+        default caches change.
 
-            # Make a request
-            response = super(Session, self).request(method, request.url, **kwargs)
+        If the session has a journal_dir, its cookies are journaled there and
+        restored from there, under its key prefix. The cookie and cache
+        managers of a fork read through to those of its parent.
+        """
+        caches = (get_default_redirect_cache(), get_default_cookie_cache(), get_default_cache())
+        managers = self._managers
+        if managers is None or any(m.cache is not c for m, c in zip(managers, caches)):
+            journal = get_cookie_journal(self.journal_dir, self.key_prefix) if self.journal_dir else None
+            parents = self._parent.get_managers() if self._parent is not None else (None, None, None)
+            managers = self._managers = (
+                RedirectManager(cache=caches[0], key_prefix=self.key_prefix, legacy_keys=self.legacy_keys),
+                CookieManager(cache=caches[1], key_prefix=self.key_prefix, journal=journal, parent=parents[1],
+                              legacy_keys=self.legacy_keys),
+                CacheManager(cache=caches[2], key_prefix=self.key_prefix, parent=parents[2],
+                             legacy_keys=self.legacy_keys),
+            )
+        return managers
 
-            # Process response
-            redirect_manager.process_response(request, response)        # Save redirect info
+    def has_credentials(self):
+        """
+        Return True if the session adds credentials to the requests it sends,
+        i.e. auth, an Authorization or Cookie header, or the cookies of its
+        own jar, which requests merges in after the managers have run.
+        """
+        if self.auth or len(self.cookies):
+            return True
+        return any(header.lower() in ('authorization', 'cookie') and value is not None
+                   for header, value in (self.headers or {}).items())
 
-            # Handle 304
-            if response.status_code == 304:
-                response = cache_manager.process_304_response(request, response)
-                if response is None:
-                    if kwargs.has_key('If-Modified-Since'): del kwargs['If-Modified-Since']
-                    if kwargs.has_key('If-None-Match'): del kwargs['If-None-Match']
-                    response = super(Session, self).get(request.url, **kwargs)
+    def process_request(self, request):
+        """
+        Run a GET request through the redirect, cookie and cache managers.
+        Return the cached response, or None if the request has to be sent.
+        """
+        self.touch()
+        redirect_manager, cookie_manager, cache_manager = self.get_managers()
+        # The cookies of the jar are only added once redirects are resolved,
+        # but whether the request carries any decides which redirects apply
+        request.credentials = self.has_credentials() or cookie_manager.has_cookies(request.url)
+        redirect_manager.process_request(request)                   # Redirect if previously got 301
+        cookie_manager.process_request(request)                     # Set cookies
+        return cache_manager.process_request(request)               # Get from cache if conditions are met
 
-            cookie_manager.process_response(request, response)          # Handle cookie
-            cache_manager.process_response(request, response)           # Update cache as necessary
+    def fetch(self, request, **kwargs):
+        """
+        Send a GET request that process_request could not answer from cache,
+        and run the response through process_response.
+        """
+        # Update kwargs
+        if request.headers: kwargs['headers'] = request.headers         # Update kwargs with new headers
+        if request.cookies: kwargs['cookies'] = request.cookies         # Update kwargs with new cookies
 
-        else:
-            response = super(Session, self).request(method, url, **kwargs)
+        # Make a request
+        response = super(Session, self).request(request.method, request.url, **kwargs)
+        return self.process_response(request, response, **kwargs)
 
-        if queue: queue.put(response)
+    def process_response(self, request, response, **kwargs):
+        """
+        Run the response to a GET request through the redirect, cookie and
+        cache managers, and return the response to hand back to the caller.
+        """
+        redirect_manager, cookie_manager, cache_manager = self.get_managers()
+        redirect_manager.process_response(request, response,        # Save redirect info
+                                          allow_redirects=kwargs.get('allow_redirects', True))
+
+        # Handle 304
+        if response.status_code == 304:
+            response = cache_manager.process_304_response(request, response)
+            if response is None:
+                if kwargs.has_key('If-Modified-Since'): del kwargs['If-Modified-Since']
+                if kwargs.has_key('If-None-Match'): del kwargs['If-None-Match']
+                response = super(Session, self).get(request.url, **kwargs)
+
+        cookie_manager.process_response(request, response)          # Handle cookie
+        cache_manager.process_response(request, response)           # Update cache as necessary
         return response
 
 
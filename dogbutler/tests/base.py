@@ -1,17 +1,59 @@
 from datetime import datetime
+from time import mktime
 
 from dummycache import cache as dummycache_cache
+from dummycache.cache import Cache
+from mock import patch
 from unittest import TestCase
 
 from dogbutler.defaults import get_default_cache, get_default_cookie_cache, get_default_redirect_cache
 from dogbutler.tests.datetimestub import DatetimeStub
 
 
+def dummycache_time():
+    """
+    Return the time on the clock of dummycache, which tests move forward to expire cache entries.
+    """
+    now = dummycache_cache.datetime.now()
+    return mktime(now.timetuple()) + now.microsecond / 1e6
+
+
+class GetManyCache(Cache):
+    """
+    A cache that can fetch several keys in one call, like memcached, and
+    counts its reads, i.e. its calls to get and get_many
+    """
+
+    def __init__(self):
+        super(GetManyCache, self).__init__()
+        self.reads = 0
+
+    def get(self, key, default=None):
+        self.reads += 1
+        return Cache.get(self, key, default)
+
+    def get_many(self, keys):
+        self.reads += 1
+        found = {}
+        for key in keys:
+            value = Cache.get(self, key)
+            if value is not None:
+                found[key] = value
+        return found
+
+
 class BaseTestCase(TestCase):
 
     def setUp(self):
         super(BaseTestCase, self).setUp()
         dummycache_cache.datetime = DatetimeStub()
+        # Cookies, redirects and sessions expire on the same clock as the cache
+        self.cookie_clock = patch('dogbutler.cookie.time', dummycache_time)
+        self.cookie_clock.start()
+        self.redirect_clock = patch('dogbutler.redirect.time', dummycache_time)
+        self.redirect_clock.start()
+        self.session_clock = patch('dogbutler.sessions.time', dummycache_time)
+        self.session_clock.start()
         self.cache = get_default_cache()
         self.cache.clear()
         self.cookie_cache = get_default_cookie_cache()
@@ -23,5 +65,8 @@ class BaseTestCase(TestCase):
         self.redirect_cache.clear()
         self.cookie_cache.clear()
         self.cache.clear()
+        self.session_clock.stop()
+        self.redirect_clock.stop()
+        self.cookie_clock.stop()
         dummycache_cache.datetime = datetime
         super(BaseTestCase, self).tearDown()
\ No newline at end of file
@@ -0,0 +1,97 @@
+from SocketServer import StreamRequestHandler, ThreadingTCPServer
+from threading import Lock, Thread
+from time import time
+
+
+MAX_RELATIVE_EXPTIME = 60 * 60 * 24 * 30
+
+
+class MemcachedStubHandler(StreamRequestHandler):
+    """
+    Serve the commands of one connection, the subset of the memcached text protocol that dogbutler uses.
+    """
+
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                self.wfile.write('ERROR\r\n')
+                continue
+            command, args = parts[0], parts[1:]
+            server.commands.append(command)
+            if any(len(key) > 250 for key in args):
+                self.wfile.write('CLIENT_ERROR line format\r\n')
+            elif command in ('get', 'gets'):
+                for key in args:
+                    item = server.get_item(key)
+                    if item is not None:
+                        flags, data, exptime = item
+                        self.wfile.write('VALUE %s %d %d\r\n%s\r\n' % (key, flags, len(data), data))
+                self.wfile.write('END\r\n')
+            elif command in ('set', 'add'):
+                key, flags, exptime, length = args[0], int(args[1]), int(args[2]), int(args[3])
+                data = self.rfile.read(length + 2)[:-2]
+                with server.lock:
+                    if command == 'add' and server.get_item(key) is not None:
+                        self.wfile.write('NOT_STORED\r\n')
+                        continue
+                    server.items[key] = (flags, data, exptime)
+                self.wfile.write('STORED\r\n')
+            elif command == 'delete':
+                with server.lock:
+                    found = server.get_item(args[0]) is not None
+                    server.items.pop(args[0], None)
+                self.wfile.write('DELETED\r\n' if found else 'NOT_FOUND\r\n')
+            elif command == 'flush_all':
+                server.items.clear()
+                self.wfile.write('OK\r\n')
+            else:
+                self.wfile.write('ERROR\r\n')
+
+
+class MemcachedStub(ThreadingTCPServer):
+    """
+    A memcached server to test against, which keeps its items in items as key: (flags, data, exptime), serves
+    each connection on a thread of its own, and counts its connections and the commands it is sent.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), MemcachedStubHandler)
+        self.items = {}
+        self.commands = []
+        self.connections = 0
+        self.lock = Lock()
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address
+
+    def get_item(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        exptime = item[2]
+        if exptime < 0 or (exptime > MAX_RELATIVE_EXPTIME and exptime <= time()):
+            # Relative expiry times are not run down, tests check the exptime sent instead
+            return None
+        return item
+
+    def start(self):
+        thread = Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -947,7 +947,7 @@ class TestCookie(BaseTestCase):
             'Set-Cookie': 'a=apple; Domain=fruits.com;, ' +
                           'b=banana; Domain=fruits.com;, ' +
                           'c=citrus; Domain=mediterranean.fruits.com;, ' +
-                          'm=mango; Domain=tropical.fruits.com;'
+                          'm=mango; Domain=tropical.fruits.com;'          # Not for this host to set, so ignored
         }
         response0.url = 'http://mediterranean.fruits.com/path0'
         mock_request.return_value = response0
@@ -959,6 +959,12 @@ class TestCookie(BaseTestCase):
         mock_request.assert_called_with('GET', 'http://mediterranean.fruits.com/path1', allow_redirects=True,
             cookies={'a': 'apple', 'b': 'banana', 'c': 'citrus'})
 
+        get('http://tropical.fruits.com/path2')         # 'a' and 'b' cookies should be present.
+        mock_request.assert_called_with('GET', 'http://tropical.fruits.com/path2', allow_redirects=True,
+            cookies={'a': 'apple', 'b': 'banana'})
+
+        response0.url = 'http://tropical.fruits.com/path2'
+        get('http://tropical.fruits.com/path2')         # 'm' is set by its own host this time
         get('http://tropical.fruits.com/path2')         # 'a', 'b', and 'm' cookies should be present.
         mock_request.assert_called_with('GET', 'http://tropical.fruits.com/path2', allow_redirects=True,
             cookies={'a': 'apple', 'b': 'banana', 'm': 'mango'})
@@ -1,10 +1,13 @@
 from datetime import datetime, timedelta
+from threading import Lock
+from time import sleep, time
 
 from mock import patch
+from requests.exceptions import ConnectionError, Timeout
 from requests.models import Response
 from dummycache import cache as dummycache_cache
 
-from dogbutler import async
+from dogbutler import Session, async
 from dogbutler.tests.base import BaseTestCase
 
 
@@ -77,4 +80,361 @@ class TestAsync(BaseTestCase):
         responses = async.get(requests[:1])
         self.assertEqual(mock_request.call_count, 5)
 
-        mock_request.assert_called_with('GET', 'http://www.test.com/path/1', headers={'If-None-Match': '"fdcd6016cf6059cbbf418d66a51a6b0a"'}, allow_redirects=True)
\ No newline at end of file
+        mock_request.assert_called_with('GET', 'http://www.test.com/path/1', headers={'If-None-Match': '"fdcd6016cf6059cbbf418d66a51a6b0a"'}, allow_redirects=True)
+
+    def test_get_max_workers(self, mock_request):
+        """
+        Test that no more than max_workers requests are in flight at once
+        """
+        lock = Lock()
+        in_flight = [0, 0]      # [current, peak]
+        calls = [0]             # mock's own call count is not thread-safe
+
+        def side_effect(method, url, *args, **kwargs):
+            with lock:
+                calls[0] += 1
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+            response = Response()
+            response.status_code = 200
+            response._content = url
+            return response
+        mock_request.side_effect = side_effect
+
+        requests = [('http://www%d.test.com/path' % i, {}) for i in range(20)]
+        responses = async.get(requests, max_workers=3)
+        self.assertEqual(calls[0], 20)
+        self.assertLessEqual(in_flight[1], 3)
+
+        # Responses come back in the order of the requests
+        self.assertEqual([r.content for r in responses], [url for url, kwargs in requests])
+
+    def test_get_max_per_host(self, mock_request):
+        """
+        Test that no more than max_per_host requests to the same host are in flight at once
+        """
+        lock = Lock()
+        in_flight = {}          # host -> [current, peak]
+        calls = [0]             # mock's own call count is not thread-safe
+
+        def side_effect(method, url, *args, **kwargs):
+            host = url.split('/')[2]
+            with lock:
+                calls[0] += 1
+                counts = in_flight.setdefault(host, [0, 0])
+                counts[0] += 1
+                counts[1] = max(counts)
+            sleep(0.01)
+            with lock:
+                counts[0] -= 1
+            response = Response()
+            response.status_code = 200
+            response._content = url
+            return response
+        mock_request.side_effect = side_effect
+
+        requests = [('http://www.test.com/path/%d' % i, {}) for i in range(10)]
+        requests += [('http://www.other.com/path/%d' % i, {}) for i in range(10)]
+        responses = async.get(requests, max_workers=8, max_per_host=2)
+        self.assertEqual(calls[0], 20)
+        self.assertLessEqual(in_flight['www.test.com'][1], 2)
+        self.assertLessEqual(in_flight['www.other.com'][1], 2)
+        self.assertEqual([r.content for r in responses], [url for url, kwargs in requests])
+
+    def test_get_max_per_host_redirect(self, mock_request):
+        """
+        Test that a request redirected to another host frees the slot of the host it was sent to
+        """
+        def side_effect(method, url, *args, **kwargs):
+            response = Response()
+            response.status_code = 200
+            response._content = url
+            if url.startswith('http://a.com/'):
+                redirect = Response()
+                redirect.status_code = 302
+                redirect.url = url
+                redirect.headers = {'Location': url.replace('a.com', 'b.com')}
+                response.history = [redirect]
+                url = url.replace('a.com', 'b.com')
+            response.url = url
+            return response
+        mock_request.side_effect = side_effect
+
+        requests = [('http://a.com/path/%d' % i, {}) for i in range(6)]
+        responses = async.get(requests, max_workers=4, max_per_host=2, timeout=5)
+        self.assertEqual([r.url for r in responses], ['http://b.com/path/%d' % i for i in range(6)])
+
+    def test_get_exception(self, mock_request):
+        """
+        Test that an exception raised by a request is re-raised to the caller
+        """
+        mock_request.side_effect = ConnectionError('Mocked connection error')
+
+        with self.assertRaises(ConnectionError):
+            async.get([('http://www.test.com/path', {})])
+
+    def test_as_completed_order(self, mock_request):
+        """
+        Test that results are handed back as they complete, not in request order
+        """
+        def side_effect(method, url, *args, **kwargs):
+            if '/slow' in url:
+                sleep(0.2)
+            response = Response()
+            response.status_code = 200
+            response._content = url
+            return response
+        mock_request.side_effect = side_effect
+
+        requests = [('http://www.test.com/slow', {})]
+        requests += [('http://www.test.com/path/%d' % i, {}) for i in range(3)]
+        futures = list(async.as_completed(requests))
+        self.assertEqual(len(futures), 4)
+        self.assertEqual(futures[-1].index, 0)
+        self.assertEqual(futures[-1].result().content, 'http://www.test.com/slow')
+        self.assertEqual(sorted(f.index for f in futures), [0, 1, 2, 3])
+
+    def test_as_completed_window(self, mock_request):
+        """
+        Test that a lazy input is consumed no faster than the in-flight window allows
+        """
+        response = Response()
+        response.status_code = 200
+        mock_request.return_value = response
+
+        consumed = [0]
+
+        def requests():
+            for i in xrange(1000):
+                consumed[0] += 1
+                yield ('http://www%d.test.com/path' % i, {})
+
+        results = async.as_completed(requests(), window=5)
+        for i in range(10):
+            results.next()
+            self.assertLessEqual(consumed[0], 5 + i + 1)
+        results.close()
+
+    def test_imap_errors(self, mock_request):
+        """
+        Test that a failed request yields its exception without stopping the others
+        """
+        def side_effect(method, url, *args, **kwargs):
+            if '/error' in url:
+                raise ConnectionError('Mocked connection error')
+            response = Response()
+            response.status_code = 200
+            response._content = url
+            return response
+        mock_request.side_effect = side_effect
+
+        requests = [
+            ('http://www.test.com/path/1', {}),
+            ('http://www.test.com/error', {}),
+            ('http://www.test.com/path/2', {}),
+        ]
+        results = dict(async.imap(iter(requests)))
+        self.assertEqual(results[0].content, 'http://www.test.com/path/1')
+        self.assertIsInstance(results[1], ConnectionError)
+        self.assertEqual(results[2].content, 'http://www.test.com/path/2')
+
+    def test_get_fail_fast(self, mock_request):
+        """
+        Test that a failed request is raised without waiting for the rest of the batch,
+        and that the requests not yet sent are cancelled
+        """
+        def side_effect(method, url, *args, **kwargs):
+            if '/error' in url:
+                raise ConnectionError('Mocked connection error')
+            sleep(0.2)
+            response = Response()
+            response.status_code = 200
+            return response
+        mock_request.side_effect = side_effect
+
+        requests = [('http://www.test.com/slow/%d' % i, {}) for i in range(3)]
+        requests.append(('http://www.test.com/error', {}))
+        requests += [('http://www.test.com/never/%d' % i, {}) for i in range(5)]
+
+        start = time()
+        with self.assertRaises(ConnectionError):
+            async.get(requests, max_workers=4, max_per_host=4)
+        self.assertLess(time() - start, 0.2)
+
+        # Let the slow requests finish. At most the one request that took the
+        # failed request's slot was sent, the other parked requests never were.
+        sleep(0.5)
+        self.assertLessEqual(mock_request.call_count, 5)
+
+    def test_get_deadline(self, mock_request):
+        """
+        Test that the whole batch is bounded by a single deadline
+        """
+        def side_effect(method, url, *args, **kwargs):
+            sleep(0.2)
+            response = Response()
+            response.status_code = 200
+            return response
+        mock_request.side_effect = side_effect
+
+        requests = [('http://www.test.com/path/%d' % i, {}) for i in range(10)]
+
+        start = time()
+        with self.assertRaises(Timeout):
+            async.get(requests, timeout=0.1, max_workers=2)
+        self.assertLess(time() - start, 0.2)
+
+        sleep(0.3)
+        self.assertEqual(mock_request.call_count, 2)
+
+    def test_get_request_timeout(self, mock_request):
+        """
+        Test that request_timeout is passed on to each request that does not set its own
+        """
+        response = Response()
+        response.status_code = 200
+        mock_request.return_value = response
+
+        async.get([('http://www.test.com/path/1', {})], request_timeout=5)
+        mock_request.assert_called_with('GET', 'http://www.test.com/path/1', allow_redirects=True, timeout=5)
+
+        async.get([('http://www.test.com/path/2', {'timeout': 1})], request_timeout=5)
+        mock_request.assert_called_with('GET', 'http://www.test.com/path/2', allow_redirects=True, timeout=1)
+
+    def test_cancel(self, mock_request):
+        """
+        Test that a request that has not been sent can be cancelled
+        """
+        def side_effect(method, url, *args, **kwargs):
+            sleep(0.1)
+            response = Response()
+            response.status_code = 200
+            return response
+        mock_request.side_effect = side_effect
+
+        pool = async.Pool(max_workers=1)
+        running = pool.submit('GET', 'http://www.test.com/path/1')
+        waiting = pool.submit('GET', 'http://www.test.com/path/2')
+        sleep(0.05)
+        self.assertFalse(running.cancel())
+        self.assertTrue(waiting.cancel())
+        self.assertTrue(waiting.cancelled())
+        self.assertIsInstance(waiting.exception(), async.CancelledError)
+        self.assertEqual(running.result(timeout=1).status_code, 200)
+        pool.shutdown(wait=True)
+        self.assertEqual(mock_request.call_count, 1)
+
+    def test_shutdown(self, mock_request):
+        """
+        Test that shutting down finishes the requests parked behind the cap of their host
+        """
+        def side_effect(method, url, *args, **kwargs):
+            sleep(0.02)
+            response = Response()
+            response.status_code = 200
+            response._content = url
+            return response
+        mock_request.side_effect = side_effect
+
+        pool = async.Pool(max_workers=2, max_per_host=1)
+        futures = [pool.submit('GET', 'http://www.test.com/path/%d' % i) for i in range(3)]
+        pool.shutdown(wait=True)
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual([f.result().content for f in futures], ['http://www.test.com/path/%d' % i for i in range(3)])
+
+    def test_request_many(self, mock_request):
+        """
+        Test a batch that mixes HTTP methods
+        """
+        def side_effect(method, url, *args, **kwargs):
+            response = Response()
+            response.status_code = 201 if method == 'POST' else 200
+            response._content = '%s %s' % (method, url)
+            return response
+        mock_request.side_effect = side_effect
+
+        requests = [
+            ('GET', 'http://www.test.com/path', {}),
+            ('POST', 'http://www.test.com/path', {'data': {'a': 'apple'}}),
+            ('PUT', 'http://www.test.com/path/1', {'data': {'b': 'banana'}}),
+            ('HEAD', 'http://www.test.com/path/1', {}),
+            ('DELETE', 'http://www.test.com/path/1', {}),
+        ]
+        responses = async.request_many(requests)
+        self.assertEqual([r.content for r in responses], ['%s %s' % (method, url) for method, url, kwargs in requests])
+        self.assertEqual(responses[1].status_code, 201)
+        mock_request.assert_any_call('POST', 'http://www.test.com/path', data={'a': 'apple'})
+        mock_request.assert_any_call('PUT', 'http://www.test.com/path/1', data={'b': 'banana'})
+        mock_request.assert_any_call('HEAD', 'http://www.test.com/path/1', allow_redirects=False)
+
+        # Requests without a method use the default one
+        async.post([('http://www.test.com/path/2', {'data': {'c': 'citrus'}})])
+        mock_request.assert_called_with('POST', 'http://www.test.com/path/2', data={'c': 'citrus'})
+
+    def test_request_many_shared_session(self, mock_request):
+        """
+        Test that every request in a batch shares the given session's cookies
+        """
+        def side_effect(method, url, *args, **kwargs):
+            response = Response()
+            response.status_code = 200
+            response.url = url
+            if method == 'POST':
+                response.headers = {'Set-Cookie': 'session=abc'}
+            return response
+        mock_request.side_effect = side_effect
+
+        s = Session()
+        async.request_many([('POST', 'http://www.test.com/login', {'data': {'user': 'u'}})], session=s)
+        async.request_many([('GET', 'http://www.test.com/path/%d' % i, {}) for i in range(3)], session=s)
+        for i in range(3):
+            mock_request.assert_any_call('GET', 'http://www.test.com/path/%d' % i, allow_redirects=True,
+                                         cookies={'session': 'abc'})
+
+        # Another session does not see the cookie
+        async.request_many([('GET', 'http://www.test.com/path/4', {})], session=Session())
+        mock_request.assert_called_with('GET', 'http://www.test.com/path/4', allow_redirects=True)
+
+    def test_get_cache_hits_skip_workers(self, mock_request):
+        """
+        Test that cache hits and cached redirects are resolved before any worker is started
+        """
+        def side_effect(method, url, *args, **kwargs):
+            response = Response()
+            response.status_code = 200
+            response._content = url
+            response.url = url
+            response.headers = {'Cache-Control': 'max-age=10'}
+            if '/old' in url:
+                redirect = Response()
+                redirect.status_code = 301
+                redirect.url = url
+                redirect.headers = {'Location': 'http://www.test.com/new'}
+                response.url = 'http://www.test.com/new'
+                response._content = 'http://www.test.com/new'
+                response.history = [redirect]
+            return response
+        mock_request.side_effect = side_effect
+
+        requests = [('http://www.test.com/path/%d' % i, {}) for i in range(3)]
+        requests.append(('http://www.test.com/old', {}))
+        async.get(requests)
+        self.assertEqual(mock_request.call_count, 4)
+
+        # Every request is answered from cache in the calling thread
+        pool = async.Pool()
+        responses = pool.map(requests)
+        self.assertEqual(mock_request.call_count, 4)
+        self.assertEqual(pool._threads, [])
+        self.assertEqual(responses[3].content, 'http://www.test.com/new')
+
+        # Only the misses reach the workers, with cached redirects already followed
+        requests.append(('http://www.test.com/path/4', {}))
+        responses = pool.map(requests)
+        self.assertEqual(mock_request.call_count, 5)
+        self.assertEqual(len(pool._threads), 1)
+        mock_request.assert_called_with('GET', 'http://www.test.com/path/4', allow_redirects=True)
+        pool.shutdown()
@@ -1,3 +1,5 @@
+from requests.models import Response
+
 from base import BaseTestCase
 from dogbutler import cache
 from dogbutler.cache import CacheManager
@@ -46,4 +48,52 @@ class TestCache(BaseTestCase):
         request = Request('http://www.test.com/path', method='DELETE')
         response = self.cache_manager.check_cache(request)
         self.assertIsNone(response)
-        self.assertFalse(request._cache_update_cache)
\ No newline at end of file
+        self.assertFalse(request._cache_update_cache)
+
+    def test_shared_key_prefix(self):
+        """
+        Responses any user could be given are cached under the shared key prefix, unless it is None
+        """
+        response = Response()
+        response.status_code = 200
+        response.headers = {'Cache-Control': 'max-age=10'}
+        other_manager = CacheManager(key_prefix='other', cache=self.cache)
+        private_manager = CacheManager(key_prefix='private', cache=self.cache, shared_key_prefix=None)
+
+        request = Request('http://www.test.com/path')
+        self.assertIsNone(private_manager.process_request(request))
+        private_manager.process_response(request, response)
+        self.assertIsNone(other_manager.process_request(Request('http://www.test.com/path')))
+
+        request = Request('http://www.test.com/path')
+        self.assertIsNone(self.cache_manager.process_request(request))
+        self.cache_manager.process_response(request, response)
+        self.assertIsNotNone(other_manager.process_request(Request('http://www.test.com/path')))
+
+        request = Request('http://www.test.com/other')
+        self.assertIsNone(self.cache_manager.process_request(request))
+        self.cache_manager.process_response(request, response)
+        self.assertIsNotNone(other_manager.process_request(Request('http://www.test.com/other')))
+        self.assertIsNone(private_manager.process_request(Request('http://www.test.com/other')))
+
+    def test_compact_keys(self):
+        """
+        Keys are compact unless legacy keys are asked for, and each kind of keys finds its own entries
+        """
+        response = Response()
+        response.status_code = 200
+        response.headers = {'Cache-Control': 'private, max-age=10'}
+        legacy_manager = CacheManager(key_prefix='test_cache', cache=self.cache, legacy_keys=True)
+        for cache_manager in (self.cache_manager, legacy_manager):
+            request = Request('http://www.test.com/path')
+            cache_manager.process_request(request)
+            cache_manager.process_response(request, response)
+
+        self.assertEqual(sorted(len(key) for key in self.cache._dict if key.startswith('views')),
+                         [89, 97, 124, 132])
+        self.assertEqual(sorted(key[:16] for key in self.cache._dict if not key.startswith('views')),
+                         ['ctest_cache.GET.', 'ctest_cache.v0Te', 'ltest_cache.GET.', 'ltest_cache.v0Te'])
+        self.assertEqual(sorted(len(key) for key in self.cache._dict if not key.startswith('views')),
+                         [34, 34, 60, 60])
+        for cache_manager in (self.cache_manager, legacy_manager):
+            self.assertIsNotNone(cache_manager.process_request(Request('http://www.test.com/path')))
@@ -1,12 +1,24 @@
+import os
+import pickle
+from calendar import timegm
 from Cookie import _getdate
 from datetime import datetime, timedelta
+from tempfile import NamedTemporaryFile
+from threading import Event, Thread
+from time import sleep, time
+from unittest import TestCase
 
 from dummycache import cache as dummycache_cache
+from dummycache.cache import Cache
+from mock import Mock, patch
 from requests.models import Response
 
-from dogbutler.cookie import CookieManager
+from dogbutler.cookie import CookieManager, domain_suffixes, is_live, normalize_path, path_prefixes
 from dogbutler.models import Request
-from dogbutler.tests.base import BaseTestCase
+from dogbutler.tests.base import BaseTestCase, dummycache_time
+from dogbutler.utils.cookie import parse_cookies, parse_http_date, parse_set_cookie
+from dogbutler.utils.publicsuffix import (PublicSuffixList, get_default_public_suffix_list, get_registrable_domain,
+                                          set_default_public_suffix_list)
 
 
 class TestCookie(BaseTestCase):
@@ -15,18 +27,28 @@ class TestCookie(BaseTestCase):
         super(TestCookie, self).setUp()
         self.cookie_manager = CookieManager(key_prefix='test_cookie', cache=self.cookie_cache)
 
+    def get_index(self, lookup_key):
+        """
+        Return the names of the live cookies packed at lookup_key by normalized path, or None if there are none
+        """
+        index = {}
+        for packed in self.cookie_cache.get(lookup_key) or ():
+            if is_live(packed, dummycache_time()):
+                index.setdefault(normalize_path(packed[3]), set()).add(packed[0])
+        return index or None
+
+    def get_packed_names(self, lookup_key):
+        """
+        Return the names of the cookies packed at lookup_key, including the expired ones
+        """
+        return set(packed[0] for packed in self.cookie_cache.get(lookup_key) or ())
+
 
     def test_domain_cookies(self):
         """
         Test setting and getting domain cookies
         """
 
-        # Cookie cache keys for convenience
-        chipsahoy_key   = self.cookie_manager.get_domain_cookie_key('sweet.test.com', '', 'chipsahoy')
-        cadbury_key     = self.cookie_manager.get_domain_cookie_key('sweet.test.com', '', 'cadbury')
-        kfc_key         = self.cookie_manager.get_domain_cookie_key('food.test.com', '', 'kfc')
-        happymeal_key   = self.cookie_manager.get_domain_cookie_key('test.com', '', 'happymeal')
-
         # Prepare test response
         response = Response()
         response.headers = {
@@ -40,20 +62,24 @@ class TestCookie(BaseTestCase):
 
         ##### Process response cookies #####
         self.cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
+        # www.test.com only sets the cookie for test.com, the others are set by their own hosts
+        for url in ('http://sweet.test.com/path', 'http://food.test.com/path'):
+            response.url = url
+            self.cookie_manager.process_response(None, response)
 
         # Test sweet.test.com cache
-        sweet_test_com_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_domain_cookie_lookup_key('sweet.test.com'))
-        self.assertIsNotNone(sweet_test_com_cookie_keys_set)
-        self.assertEqual(sweet_test_com_cookie_keys_set, set([chipsahoy_key, cadbury_key]))
+        sweet_test_com_cookie_names = self.get_index(self.cookie_manager.get_domain_cookie_lookup_key('sweet.test.com'))
+        self.assertIsNotNone(sweet_test_com_cookie_names)
+        self.assertEqual(sweet_test_com_cookie_names, {'/': set(['chipsahoy', 'cadbury'])})
 
-        chipsahoy_cookie = self.cookie_cache.get(chipsahoy_key)
+        chipsahoy_cookie = self.cookie_manager.get_domain_cookie('sweet.test.com', '', 'chipsahoy')
         self.assertIsNotNone(chipsahoy_cookie)
         self.assertEqual(chipsahoy_cookie.key, 'chipsahoy')
         self.assertEqual(chipsahoy_cookie.value, 'cookie')
         self.assertEqual(chipsahoy_cookie['domain'], 'sweet.test.com')
         self.assertEqual(chipsahoy_cookie['path'], '')
 
-        cadbury_cookie = self.cookie_cache.get(cadbury_key)
+        cadbury_cookie = self.cookie_manager.get_domain_cookie('sweet.test.com', '', 'cadbury')
         self.assertIsNotNone(cadbury_cookie)
         self.assertEqual(cadbury_cookie.key, 'cadbury')
         self.assertEqual(cadbury_cookie.value, 'chocolate')
@@ -61,11 +87,11 @@ class TestCookie(BaseTestCase):
         self.assertEqual(cadbury_cookie['path'], '')
 
         # Test food.test.com cache
-        food_test_com_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_domain_cookie_lookup_key('food.test.com'))
-        self.assertIsNotNone(food_test_com_cookie_keys_set)
-        self.assertEqual(food_test_com_cookie_keys_set, set([kfc_key]))
+        food_test_com_cookie_names = self.get_index(self.cookie_manager.get_domain_cookie_lookup_key('food.test.com'))
+        self.assertIsNotNone(food_test_com_cookie_names)
+        self.assertEqual(food_test_com_cookie_names, {'/': set(['kfc'])})
 
-        kfc_cookie = self.cookie_cache.get(kfc_key)
+        kfc_cookie = self.cookie_manager.get_domain_cookie('food.test.com', '', 'kfc')
         self.assertIsNotNone(kfc_cookie)
         self.assertEqual(kfc_cookie.key, 'kfc')
         self.assertEqual(kfc_cookie.value, 'chicken')
@@ -73,11 +99,11 @@ class TestCookie(BaseTestCase):
         self.assertEqual(kfc_cookie['path'], '')
 
         # Test test.com cache
-        test_com_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_domain_cookie_lookup_key('test.com'))
-        self.assertIsNotNone(test_com_cookie_keys_set)
-        self.assertEqual(test_com_cookie_keys_set, set([happymeal_key]))
+        test_com_cookie_names = self.get_index(self.cookie_manager.get_domain_cookie_lookup_key('test.com'))
+        self.assertIsNotNone(test_com_cookie_names)
+        self.assertEqual(test_com_cookie_names, {'/': set(['happymeal'])})
 
-        happymeal_cookie = self.cookie_cache.get(happymeal_key)
+        happymeal_cookie = self.cookie_manager.get_domain_cookie('test.com', '', 'happymeal')
         self.assertIsNotNone(happymeal_cookie)
         self.assertEqual(happymeal_cookie.key, 'happymeal')
         self.assertEqual(happymeal_cookie.value, 'meal')
@@ -104,12 +130,6 @@ class TestCookie(BaseTestCase):
         Test setting and getting domain cookies with weird domain
         """
 
-        # Cookie cache keys for convenience
-        chipsahoy_key   = self.cookie_manager.get_domain_cookie_key('.sweet.test.com', '', 'chipsahoy')
-        cadbury_key     = self.cookie_manager.get_domain_cookie_key('sweet.test.com', '', 'cadbury')
-        kfc_key         = self.cookie_manager.get_domain_cookie_key('..food.test.com', '', 'kfc')
-        happymeal_key   = self.cookie_manager.get_domain_cookie_key('.test.com', '', 'happymeal')
-
         # Prepare test response
         response = Response()
         response.headers = {
@@ -124,20 +144,24 @@ class TestCookie(BaseTestCase):
 
         ##### Process response cookies #####
         self.cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
+        # www.test.com only sets the cookie for test.com, the others are set by their own hosts
+        for url in ('http://sweet.test.com/path', 'http://food.test.com/path'):
+            response.url = url
+            self.cookie_manager.process_response(None, response)
 
         # Test sweet.test.com cache
-        sweet_test_com_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_domain_cookie_lookup_key('sweet.test.com'))
-        self.assertIsNotNone(sweet_test_com_cookie_keys_set)
-        self.assertEqual(sweet_test_com_cookie_keys_set, set([chipsahoy_key, cadbury_key]))
+        sweet_test_com_cookie_names = self.get_index(self.cookie_manager.get_domain_cookie_lookup_key('sweet.test.com'))
+        self.assertIsNotNone(sweet_test_com_cookie_names)
+        self.assertEqual(sweet_test_com_cookie_names, {'/': set(['chipsahoy', 'cadbury'])})
 
-        chipsahoy_cookie = self.cookie_cache.get(chipsahoy_key)
+        chipsahoy_cookie = self.cookie_manager.get_domain_cookie('.sweet.test.com', '', 'chipsahoy')
         self.assertIsNotNone(chipsahoy_cookie)
         self.assertEqual(chipsahoy_cookie.key, 'chipsahoy')
         self.assertEqual(chipsahoy_cookie.value, 'cookie')
         self.assertEqual(chipsahoy_cookie['domain'], '.sweet.test.com')
         self.assertEqual(chipsahoy_cookie['path'], '')
 
-        cadbury_cookie = self.cookie_cache.get(cadbury_key)
+        cadbury_cookie = self.cookie_manager.get_domain_cookie('sweet.test.com', '', 'cadbury')
         self.assertIsNotNone(cadbury_cookie)
         self.assertEqual(cadbury_cookie.key, 'cadbury')
         self.assertEqual(cadbury_cookie.value, 'chocolate')
@@ -145,11 +169,11 @@ class TestCookie(BaseTestCase):
         self.assertEqual(cadbury_cookie['path'], '')
 
         # Test food.test.com cache
-        food_test_com_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_domain_cookie_lookup_key('food.test.com'))
-        self.assertIsNotNone(food_test_com_cookie_keys_set)
-        self.assertEqual(food_test_com_cookie_keys_set, set([kfc_key]))
+        food_test_com_cookie_names = self.get_index(self.cookie_manager.get_domain_cookie_lookup_key('food.test.com'))
+        self.assertIsNotNone(food_test_com_cookie_names)
+        self.assertEqual(food_test_com_cookie_names, {'/': set(['kfc'])})
 
-        kfc_cookie = self.cookie_cache.get(kfc_key)
+        kfc_cookie = self.cookie_manager.get_domain_cookie('..food.test.com', '', 'kfc')
         self.assertIsNotNone(kfc_cookie)
         self.assertEqual(kfc_cookie.key, 'kfc')
         self.assertEqual(kfc_cookie.value, 'chicken')
@@ -157,11 +181,11 @@ class TestCookie(BaseTestCase):
         self.assertEqual(kfc_cookie['path'], '')
 
         # Test test.com cache
-        test_com_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_domain_cookie_lookup_key('test.com'))
-        self.assertIsNotNone(test_com_cookie_keys_set)
-        self.assertEqual(test_com_cookie_keys_set, set([happymeal_key]))
+        test_com_cookie_names = self.get_index(self.cookie_manager.get_domain_cookie_lookup_key('test.com'))
+        self.assertIsNotNone(test_com_cookie_names)
+        self.assertEqual(test_com_cookie_names, {'/': set(['happymeal'])})
 
-        happymeal_cookie = self.cookie_cache.get(happymeal_key)
+        happymeal_cookie = self.cookie_manager.get_domain_cookie('.test.com', '', 'happymeal')
         self.assertIsNotNone(happymeal_cookie)
         self.assertEqual(happymeal_cookie.key, 'happymeal')
         self.assertEqual(happymeal_cookie.value, 'meal')
@@ -169,8 +193,8 @@ class TestCookie(BaseTestCase):
         self.assertEqual(happymeal_cookie['path'], '')
 
         # Test food.test.com. cache. There should be no cache.
-        food_test_com_dot_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_domain_cookie_lookup_key('food.test.com.'))
-        self.assertIsNone(food_test_com_dot_cookie_keys_set)
+        food_test_com_dot_cookie_names = self.get_index(self.cookie_manager.get_domain_cookie_lookup_key('food.test.com.'))
+        self.assertIsNone(food_test_com_dot_cookie_names)
 
 
         ##### Process request #####
@@ -194,10 +218,6 @@ class TestCookie(BaseTestCase):
 
         # Cache keys for convenience
         lookup_key      = self.cookie_manager.get_domain_cookie_lookup_key('sweet.test.com')
-        chipsahoy_key   = self.cookie_manager.get_domain_cookie_key('sweet.test.com', '', 'chipsahoy')
-        cadbury_key     = self.cookie_manager.get_domain_cookie_key('sweet.test.com', '', 'cadbury')
-        kfc_key         = self.cookie_manager.get_domain_cookie_key('sweet.test.com', '', 'kfc')
-        happymeal_key   = self.cookie_manager.get_domain_cookie_key('sweet.test.com', '', 'happymeal')
 
         # Prepare test response
         response = Response()
@@ -218,8 +238,8 @@ class TestCookie(BaseTestCase):
         request = Request('http://sweet.test.com/help')
         self.cookie_manager.process_request(request)
         self.assertEqual(request.cookies, {'chipsahoy': 'cookie', 'cadbury': 'chocolate', 'kfc': 'chicken', 'happymeal': 'meal'})
-        cookie_keys_set = self.cookie_cache.get(lookup_key)
-        self.assertEqual(cookie_keys_set, set([chipsahoy_key, cadbury_key, kfc_key, happymeal_key]))
+        cookie_names = self.get_index(lookup_key)
+        self.assertEqual(cookie_names, {'/': set(['chipsahoy', 'cadbury', 'kfc', 'happymeal'])})
 
         # 3 seconds pass by
         dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=3)
@@ -227,8 +247,8 @@ class TestCookie(BaseTestCase):
         request = Request('http://sweet.test.com/help')
         self.cookie_manager.process_request(request)
         self.assertEqual(request.cookies, {'cadbury': 'chocolate', 'happymeal': 'meal'})
-        cookie_keys_set = self.cookie_cache.get(lookup_key)
-        self.assertEqual(cookie_keys_set, set([cadbury_key, happymeal_key]))
+        cookie_names = self.get_index(lookup_key)
+        self.assertEqual(cookie_names, {'/': set(['cadbury', 'happymeal'])})
 
         # 3 more seconds pass by
         dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=6)
@@ -236,8 +256,8 @@ class TestCookie(BaseTestCase):
         request = Request('http://sweet.test.com/help')
         self.cookie_manager.process_request(request)
         self.assertEqual(request.cookies, {'happymeal': 'meal'})
-        cookie_keys_set = self.cookie_cache.get(lookup_key)
-        self.assertEqual(cookie_keys_set, set([happymeal_key]))
+        cookie_names = self.get_index(lookup_key)
+        self.assertEqual(cookie_names, {'/': set(['happymeal'])})
 
 
     def test_domain_cookies_with_path(self):
@@ -247,10 +267,6 @@ class TestCookie(BaseTestCase):
 
         # Cache keys for convenience
         lookup_key      = self.cookie_manager.get_domain_cookie_lookup_key('sweet.test.com')
-        chipsahoy_key   = self.cookie_manager.get_domain_cookie_key('sweet.test.com', '/', 'chipsahoy')
-        cadbury_key     = self.cookie_manager.get_domain_cookie_key('sweet.test.com', '/help', 'cadbury')
-        kfc_key         = self.cookie_manager.get_domain_cookie_key('sweet.test.com', '/help/me', 'kfc')
-        happymeal_key   = self.cookie_manager.get_domain_cookie_key('sweet.test.com', '', 'happymeal')
 
         # Prepare test response
         response = Response()
@@ -267,32 +283,36 @@ class TestCookie(BaseTestCase):
         self.cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
 
         # Test sweet.test.com cache
-        sweet_test_com_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_domain_cookie_lookup_key('sweet.test.com'))
-        self.assertIsNotNone(sweet_test_com_cookie_keys_set)
-        self.assertEqual(sweet_test_com_cookie_keys_set, set([chipsahoy_key, cadbury_key, kfc_key, happymeal_key]))
-
-        chipsahoy_cookie = self.cookie_cache.get(chipsahoy_key)
+        sweet_test_com_cookie_names = self.get_index(self.cookie_manager.get_domain_cookie_lookup_key('sweet.test.com'))
+        self.assertIsNotNone(sweet_test_com_cookie_names)
+        self.assertEqual(sweet_test_com_cookie_names, {
+            '/': set(['chipsahoy', 'happymeal']),
+            '/help': set(['cadbury']),
+            '/help/me': set(['kfc']),
+        })
+
+        chipsahoy_cookie = self.cookie_manager.get_domain_cookie('sweet.test.com', '/', 'chipsahoy')
         self.assertIsNotNone(chipsahoy_cookie)
         self.assertEqual(chipsahoy_cookie.key, 'chipsahoy')
         self.assertEqual(chipsahoy_cookie.value, 'cookie')
         self.assertEqual(chipsahoy_cookie['domain'], 'sweet.test.com')
         self.assertEqual(chipsahoy_cookie['path'], '/')
 
-        cadbury_cookie = self.cookie_cache.get(cadbury_key)
+        cadbury_cookie = self.cookie_manager.get_domain_cookie('sweet.test.com', '/help', 'cadbury')
         self.assertIsNotNone(cadbury_cookie)
         self.assertEqual(cadbury_cookie.key, 'cadbury')
         self.assertEqual(cadbury_cookie.value, 'chocolate')
         self.assertEqual(cadbury_cookie['domain'], 'sweet.test.com')
         self.assertEqual(cadbury_cookie['path'], '/help')
 
-        kfc_cookie = self.cookie_cache.get(kfc_key)
+        kfc_cookie = self.cookie_manager.get_domain_cookie('sweet.test.com', '/help/me', 'kfc')
         self.assertIsNotNone(kfc_cookie)
         self.assertEqual(kfc_cookie.key, 'kfc')
         self.assertEqual(kfc_cookie.value, 'chicken')
         self.assertEqual(kfc_cookie['domain'], 'sweet.test.com')
         self.assertEqual(kfc_cookie['path'], '/help/me')
 
-        happymeal_cookie = self.cookie_cache.get(happymeal_key)
+        happymeal_cookie = self.cookie_manager.get_domain_cookie('sweet.test.com', '', 'happymeal')
         self.assertIsNotNone(happymeal_cookie)
         self.assertEqual(happymeal_cookie.key, 'happymeal')
         self.assertEqual(happymeal_cookie.value, 'meal')
@@ -319,11 +339,6 @@ class TestCookie(BaseTestCase):
         Test setting and getting origin cookies
         """
 
-        # Cookie cache keys for convenience
-        chipsahoy_key   = self.cookie_manager.get_origin_cookie_key('sweet.test.com', '', 'chipsahoy')
-        coke_key        = self.cookie_manager.get_origin_cookie_key('pop.test.com', '', 'coke')
-        squeeze_key     = self.cookie_manager.get_origin_cookie_key('test.com', '', 'squeeze')
-
         # Prepare test responses
         response0 = Response()
         response0.headers = {
@@ -350,11 +365,11 @@ class TestCookie(BaseTestCase):
         self.cookie_manager.process_response(None, response2)
 
         # Test sweet.test.com cache
-        sweet_test_com_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_origin_cookie_lookup_key('sweet.test.com'))
-        self.assertIsNotNone(sweet_test_com_cookie_keys_set)
-        self.assertEqual(sweet_test_com_cookie_keys_set, set([chipsahoy_key]))
+        sweet_test_com_cookie_names = self.get_index(self.cookie_manager.get_origin_cookie_lookup_key('sweet.test.com'))
+        self.assertIsNotNone(sweet_test_com_cookie_names)
+        self.assertEqual(sweet_test_com_cookie_names, {'/': set(['chipsahoy'])})
 
-        chipsahoy_cookie = self.cookie_cache.get(chipsahoy_key)
+        chipsahoy_cookie = self.cookie_manager.get_origin_cookie('sweet.test.com', '', 'chipsahoy')
         self.assertIsNotNone(chipsahoy_cookie)
         self.assertEqual(chipsahoy_cookie.key, 'chipsahoy')
         self.assertEqual(chipsahoy_cookie.value, 'cookie')
@@ -362,11 +377,11 @@ class TestCookie(BaseTestCase):
         self.assertEqual(chipsahoy_cookie['path'], '')
 
         # Test pop.test.com cache
-        pop_test_com_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_origin_cookie_lookup_key('pop.test.com'))
-        self.assertIsNotNone(pop_test_com_cookie_keys_set)
-        self.assertEqual(pop_test_com_cookie_keys_set, set([coke_key]))
+        pop_test_com_cookie_names = self.get_index(self.cookie_manager.get_origin_cookie_lookup_key('pop.test.com'))
+        self.assertIsNotNone(pop_test_com_cookie_names)
+        self.assertEqual(pop_test_com_cookie_names, {'/': set(['coke'])})
 
-        coke_cookie = self.cookie_cache.get(coke_key)
+        coke_cookie = self.cookie_manager.get_origin_cookie('pop.test.com', '', 'coke')
         self.assertIsNotNone(coke_cookie)
         self.assertEqual(coke_cookie.key, 'coke')
         self.assertEqual(coke_cookie.value, 'soda')
@@ -374,11 +389,11 @@ class TestCookie(BaseTestCase):
         self.assertEqual(coke_cookie['path'], '')
 
         # Test test.com cache
-        test_com_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_origin_cookie_lookup_key('test.com'))
-        self.assertIsNotNone(test_com_cookie_keys_set)
-        self.assertEqual(test_com_cookie_keys_set, set([squeeze_key]))
+        test_com_cookie_names = self.get_index(self.cookie_manager.get_origin_cookie_lookup_key('test.com'))
+        self.assertIsNotNone(test_com_cookie_names)
+        self.assertEqual(test_com_cookie_names, {'/': set(['squeeze'])})
 
-        squeeze_cookie = self.cookie_cache.get(squeeze_key)
+        squeeze_cookie = self.cookie_manager.get_origin_cookie('test.com', '', 'squeeze')
         self.assertIsNotNone(squeeze_cookie)
         self.assertEqual(squeeze_cookie.key, 'squeeze')
         self.assertEqual(squeeze_cookie.value, 'juice')
@@ -405,12 +420,8 @@ class TestCookie(BaseTestCase):
         Test setting and getting origin cookies with 'Max-Age' and/or 'Expires' attribute
         """
 
-        # Cookie cache keys for convenience
+        # Cache keys for convenience
         lookup_key      = self.cookie_manager.get_origin_cookie_lookup_key('sweet.test.com')
-        chipsahoy_key   = self.cookie_manager.get_origin_cookie_key('sweet.test.com', '', 'chipsahoy')
-        coke_key        = self.cookie_manager.get_origin_cookie_key('sweet.test.com', '', 'coke')
-        squeeze_key     = self.cookie_manager.get_origin_cookie_key('sweet.test.com', '', 'squeeze')
-        kitkat_key      = self.cookie_manager.get_origin_cookie_key('sweet.test.com', '', 'kitkat')
 
         # Prepare test responses
         response0 = Response()
@@ -431,8 +442,8 @@ class TestCookie(BaseTestCase):
         request = Request('http://sweet.test.com/help')
         self.cookie_manager.process_request(request)
         self.assertEqual(request.cookies, {'chipsahoy': 'cookie', 'coke': 'soda', 'squeeze': 'juice', 'kitkat': 'chocolate'})
-        cookie_keys_set = self.cookie_cache.get(lookup_key)
-        self.assertEqual(cookie_keys_set, set([chipsahoy_key, coke_key, squeeze_key, kitkat_key]))
+        cookie_names = self.get_index(lookup_key)
+        self.assertEqual(cookie_names, {'/': set(['chipsahoy', 'coke', 'squeeze', 'kitkat'])})
 
         # 3 seconds pass by
         dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=3)
@@ -440,8 +451,8 @@ class TestCookie(BaseTestCase):
         request = Request('http://sweet.test.com/help')
         self.cookie_manager.process_request(request)
         self.assertEqual(request.cookies, {'coke': 'soda', 'kitkat': 'chocolate'})
-        cookie_keys_set = self.cookie_cache.get(lookup_key)
-        self.assertEqual(cookie_keys_set, set([coke_key, kitkat_key]))
+        cookie_names = self.get_index(lookup_key)
+        self.assertEqual(cookie_names, {'/': set(['coke', 'kitkat'])})
 
         # 3 more seconds pass by
         dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=6)
@@ -449,8 +460,8 @@ class TestCookie(BaseTestCase):
         request = Request('http://sweet.test.com/help')
         self.cookie_manager.process_request(request)
         self.assertEqual(request.cookies, {'kitkat': 'chocolate'})
-        cookie_keys_set = self.cookie_cache.get(lookup_key)
-        self.assertEqual(cookie_keys_set, set([kitkat_key]))
+        cookie_names = self.get_index(lookup_key)
+        self.assertEqual(cookie_names, {'/': set(['kitkat'])})
 
 
     def test_domain_and_origin_cookies(self):
@@ -458,14 +469,6 @@ class TestCookie(BaseTestCase):
         Test setting and getting domain and origin cookies
         """
 
-        # Cookie cache keys for convenience
-        chipsahoy_key  = self.cookie_manager.get_domain_cookie_key('sweet.test.com', '', 'chipsahoy')
-        cadbury_key    = self.cookie_manager.get_domain_cookie_key('sweet.test.com', '', 'cadbury')
-        kfc_key        = self.cookie_manager.get_domain_cookie_key('food.test.com', '', 'kfc')
-        happymeal_key  = self.cookie_manager.get_domain_cookie_key('test.com', '', 'happymeal')
-
-        coke_key       = self.cookie_manager.get_origin_cookie_key('www.test.com', '', 'coke')
-        squeeze_key    = self.cookie_manager.get_origin_cookie_key('test.com', '', 'squeeze')
 
         # Prepare test responses
         response0 = Response()
@@ -478,6 +481,14 @@ class TestCookie(BaseTestCase):
         }
         response0.url = 'http://www.test.com/path'
 
+        # Only sweet.test.com and food.test.com set the cookies of their domains
+        response2 = Response()
+        response2.headers = {
+            'Set-Cookie': 'chipsahoy=cookie; Domain=sweet.test.com;, ' +
+                          'cadbury=chocolate; Domain=sweet.test.com;, ' +
+                          'kfc=chicken; Domain=food.test.com;'
+        }
+
         response1 = Response()
         response1.headers = {
             'Set-Cookie': 'squeeze=juice;'
@@ -488,20 +499,23 @@ class TestCookie(BaseTestCase):
         ##### Process response cookie #####
         self.cookie_manager.process_response(None, response0)    # Note that 'request' is not used (thus None param)
         self.cookie_manager.process_response(None, response1)
+        for url in ('http://sweet.test.com/path', 'http://food.test.com/path'):
+            response2.url = url
+            self.cookie_manager.process_response(None, response2)
 
         # Test sweet.test.com cache
-        sweet_test_com_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_domain_cookie_lookup_key('sweet.test.com'))
-        self.assertIsNotNone(sweet_test_com_cookie_keys_set)
-        self.assertEqual(sweet_test_com_cookie_keys_set, set([chipsahoy_key, cadbury_key]))
+        sweet_test_com_cookie_names = self.get_index(self.cookie_manager.get_domain_cookie_lookup_key('sweet.test.com'))
+        self.assertIsNotNone(sweet_test_com_cookie_names)
+        self.assertEqual(sweet_test_com_cookie_names, {'/': set(['chipsahoy', 'cadbury'])})
 
-        chipsahoy_cookie = self.cookie_cache.get(chipsahoy_key)
+        chipsahoy_cookie = self.cookie_manager.get_domain_cookie('sweet.test.com', '', 'chipsahoy')
         self.assertIsNotNone(chipsahoy_cookie)
         self.assertEqual(chipsahoy_cookie.key, 'chipsahoy')
         self.assertEqual(chipsahoy_cookie.value, 'cookie')
         self.assertEqual(chipsahoy_cookie['domain'], 'sweet.test.com')
         self.assertEqual(chipsahoy_cookie['path'], '')
 
-        cadbury_cookie = self.cookie_cache.get(cadbury_key)
+        cadbury_cookie = self.cookie_manager.get_domain_cookie('sweet.test.com', '', 'cadbury')
         self.assertIsNotNone(cadbury_cookie)
         self.assertEqual(cadbury_cookie.key, 'cadbury')
         self.assertEqual(cadbury_cookie.value, 'chocolate')
@@ -509,11 +523,11 @@ class TestCookie(BaseTestCase):
         self.assertEqual(cadbury_cookie['path'], '')
 
         # Test food.test.com cache
-        food_test_com_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_domain_cookie_lookup_key('food.test.com'))
-        self.assertIsNotNone(food_test_com_cookie_keys_set)
-        self.assertEqual(food_test_com_cookie_keys_set, set([kfc_key]))
+        food_test_com_cookie_names = self.get_index(self.cookie_manager.get_domain_cookie_lookup_key('food.test.com'))
+        self.assertIsNotNone(food_test_com_cookie_names)
+        self.assertEqual(food_test_com_cookie_names, {'/': set(['kfc'])})
 
-        kfc_cookie = self.cookie_cache.get(kfc_key)
+        kfc_cookie = self.cookie_manager.get_domain_cookie('food.test.com', '', 'kfc')
         self.assertIsNotNone(kfc_cookie)
         self.assertEqual(kfc_cookie.key, 'kfc')
         self.assertEqual(kfc_cookie.value, 'chicken')
@@ -521,11 +535,11 @@ class TestCookie(BaseTestCase):
         self.assertEqual(kfc_cookie['path'], '')
 
         # Test www.test.com cache
-        www_test_com_origin_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_origin_cookie_lookup_key('www.test.com'))
-        self.assertIsNotNone(www_test_com_origin_cookie_keys_set)
-        self.assertEqual(www_test_com_origin_cookie_keys_set, set([coke_key]))
+        www_test_com_origin_cookie_names = self.get_index(self.cookie_manager.get_origin_cookie_lookup_key('www.test.com'))
+        self.assertIsNotNone(www_test_com_origin_cookie_names)
+        self.assertEqual(www_test_com_origin_cookie_names, {'/': set(['coke'])})
 
-        coke_cookie = self.cookie_cache.get(coke_key)
+        coke_cookie = self.cookie_manager.get_origin_cookie('www.test.com', '', 'coke')
         self.assertIsNotNone(coke_cookie)
         self.assertEqual(coke_cookie.key, 'coke')
         self.assertEqual(coke_cookie.value, 'soda')
@@ -533,22 +547,22 @@ class TestCookie(BaseTestCase):
         self.assertEqual(coke_cookie['path'], '')
 
         # Test test.com cache
-        test_com_origin_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_domain_cookie_lookup_key('test.com'))
-        self.assertIsNotNone(test_com_origin_cookie_keys_set)
-        self.assertEqual(test_com_origin_cookie_keys_set, set([happymeal_key]))
+        test_com_origin_cookie_names = self.get_index(self.cookie_manager.get_domain_cookie_lookup_key('test.com'))
+        self.assertIsNotNone(test_com_origin_cookie_names)
+        self.assertEqual(test_com_origin_cookie_names, {'/': set(['happymeal'])})
 
-        squeeze_cookie = self.cookie_cache.get(happymeal_key)
+        squeeze_cookie = self.cookie_manager.get_domain_cookie('test.com', '', 'happymeal')
         self.assertIsNotNone(squeeze_cookie)
         self.assertEqual(squeeze_cookie.key, 'happymeal')
         self.assertEqual(squeeze_cookie.value, 'meal')
         self.assertEqual(squeeze_cookie['domain'], 'test.com')
         self.assertEqual(squeeze_cookie['path'], '')
 
-        test_com_origin_cookie_keys_set = self.cookie_cache.get(self.cookie_manager.get_origin_cookie_lookup_key('test.com'))
-        self.assertIsNotNone(test_com_origin_cookie_keys_set)
-        self.assertEqual(test_com_origin_cookie_keys_set, set([squeeze_key]))
+        test_com_origin_cookie_names = self.get_index(self.cookie_manager.get_origin_cookie_lookup_key('test.com'))
+        self.assertIsNotNone(test_com_origin_cookie_names)
+        self.assertEqual(test_com_origin_cookie_names, {'/': set(['squeeze'])})
 
-        squeeze_cookie = self.cookie_cache.get(squeeze_key)
+        squeeze_cookie = self.cookie_manager.get_origin_cookie('test.com', '', 'squeeze')
         self.assertIsNotNone(squeeze_cookie)
         self.assertEqual(squeeze_cookie.key, 'squeeze')
         self.assertEqual(squeeze_cookie.value, 'juice')
@@ -580,16 +594,11 @@ class TestCookie(BaseTestCase):
         format
         """
 
-        # Cookie cache keys for convenience
-        chipsahoy_key  = self.cookie_manager.get_origin_cookie_key('www.test.com', '', 'chipsahoy')
-        cadbury_key     = self.cookie_manager.get_origin_cookie_key('www.test.com', '', 'cadbury')
-        coke_key        = self.cookie_manager.get_origin_cookie_key('www.test.com', '', 'coke')
-
         # Prepare test response
         response = Response()
         response.headers = {
-            'Set-Cookie': 'chipsahoy=cookie; expires=Thu, 12 Jan 2013 12:34:22 GMT;, '
-                          'cadbury=chocolate; Expires=Wed, 20-Feb-2014 08:23:55 GMT;, '
+            'Set-Cookie': 'chipsahoy=cookie; expires=Thu, 12 Jan 2040 12:34:22 GMT;, '
+                          'cadbury=chocolate; Expires=Wed, 20-Feb-2041 08:23:55 GMT;, '
                           'coke=soda; Expires = Fri, 02 Jan 2021 GMT;'
         }
         response.url = 'http://www.test.com/'
@@ -598,21 +607,574 @@ class TestCookie(BaseTestCase):
         ##### Process response cookie #####
         self.cookie_manager.process_response(None, response)    # Note that 'request' is not used (thus None param)
 
-        chipsahoy_cookie = self.cookie_cache.get(chipsahoy_key)
+        chipsahoy_cookie = self.cookie_manager.get_origin_cookie('www.test.com', '', 'chipsahoy')
         self.assertIsNotNone(chipsahoy_cookie)
         self.assertEqual('chipsahoy', chipsahoy_cookie.key)
         self.assertEqual('cookie', chipsahoy_cookie.value)
-        self.assertEqual('Thu, 12-Jan-2013 12:34:22 GMT', chipsahoy_cookie['expires'])
+        self.assertEqual('Thu, 12-Jan-2040 12:34:22 GMT', chipsahoy_cookie['expires'])
 
-        cadbury_cookie = self.cookie_cache.get(cadbury_key)
+        cadbury_cookie = self.cookie_manager.get_origin_cookie('www.test.com', '', 'cadbury')
         self.assertIsNotNone(cadbury_cookie)
         self.assertEqual('cadbury', cadbury_cookie.key)
         self.assertEqual('chocolate', cadbury_cookie.value)
-        self.assertEqual('Wed, 20-Feb-2014 08:23:55 GMT', cadbury_cookie['expires'])
+        self.assertEqual('Wed, 20-Feb-2041 08:23:55 GMT', cadbury_cookie['expires'])
 
         # cookie with wrong expires format won't get stored!
-        coke_cookie = self.cookie_cache.get(coke_key)
+        coke_cookie = self.cookie_manager.get_origin_cookie('www.test.com', '', 'coke')
         self.assertIsNotNone(coke_cookie)
         self.assertEqual('coke', coke_cookie.key)
         self.assertEqual('soda', coke_cookie.value)
         self.assertEqual('', coke_cookie['expires'])
+
+
+    def test_path_prefixes(self):
+        """
+        Test the cookie paths that match a request path
+        """
+        self.assertEqual(path_prefixes(''), ['/'])
+        self.assertEqual(path_prefixes('/'), ['/'])
+        self.assertEqual(path_prefixes('/help'), ['/', '/help'])
+        self.assertEqual(path_prefixes('/help/'), ['/', '/help'])
+        self.assertEqual(path_prefixes('/help/me'), ['/', '/help', '/help/me'])
+
+
+    def test_cookie_path_prefix_only_matches_whole_segments(self):
+        """
+        Test that a cookie path matches whole path segments only
+        """
+        response = Response()
+        response.headers = {'Set-Cookie': 'a=apple; Path=/help/;, b=banana; Path=/help;'}
+        response.url = 'http://www.test.com/help'
+        self.cookie_manager.process_response(None, response)
+
+        request = Request('http://www.test.com/help/me')
+        self.cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'a': 'apple', 'b': 'banana'})
+
+        request = Request('http://www.test.com/helpme')
+        self.cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {})
+
+
+    def test_get_cookies_does_not_write(self):
+        """
+        Test that reading cookies never writes to the cookie cache, even when a cookie has expired
+        """
+        response = Response()
+        response.headers = {'Set-Cookie': 'a=apple; Domain=test.com;, b=banana; Max-Age=3;'}
+        response.url = 'http://www.test.com/path'
+        self.cookie_manager.process_response(None, response)
+
+        with patch.object(self.cookie_cache, 'set') as mock_set:
+            request = Request('http://www.test.com/path')
+            self.cookie_manager.process_request(request)
+            self.assertEqual(request.cookies, {'a': 'apple', 'b': 'banana'})
+            self.assertEqual(mock_set.call_count, 0)
+
+        # 3 seconds pass by. The expired cookie is skipped as its pack is read.
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=3)
+        with patch.object(self.cookie_cache, 'set') as mock_set:
+            request = Request('http://www.test.com/path')
+            self.cookie_manager.process_request(request)
+            self.assertEqual(request.cookies, {'a': 'apple'})
+            self.assertEqual(mock_set.call_count, 0)
+
+    def test_resolved_cookies_are_memoized(self):
+        """
+        Test that repeated requests to the same host and path skip the pack lookups
+        until the jar version changes
+        """
+        response = Response()
+        response.headers = {'Set-Cookie': 'a=apple; Domain=test.com;, b=banana; Path=/path;'}
+        response.url = 'http://www.test.com/path'
+        self.cookie_manager.process_response(None, response)
+
+        request = Request('http://www.test.com/path/page')
+        self.cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'a': 'apple', 'b': 'banana'})
+
+        # The jar version only
+        with patch.object(self.cookie_cache, 'get', wraps=self.cookie_cache.get) as mock_get:
+            request = Request('http://www.test.com/path/page')
+            self.cookie_manager.process_request(request)
+            self.assertEqual(request.cookies, {'a': 'apple', 'b': 'banana'})
+            self.assertEqual(mock_get.call_count, 1)
+
+        # The same cookies set again write nothing, and leave the memo as it is
+        with patch.object(self.cookie_cache, 'set') as mock_set:
+            self.cookie_manager.process_response(None, response)
+            self.assertEqual(mock_set.call_count, 0)
+        with patch.object(self.cookie_cache, 'get', wraps=self.cookie_cache.get) as mock_get:
+            request = Request('http://www.test.com/path/page')
+            self.cookie_manager.process_request(request)
+            self.assertEqual(request.cookies, {'a': 'apple', 'b': 'banana'})
+            self.assertEqual(mock_get.call_count, 1)
+
+        # A changed value changes the jar version
+        response.headers = {'Set-Cookie': 'b=blueberry; Path=/path;'}
+        self.cookie_manager.process_response(None, response)
+        request = Request('http://www.test.com/path/page')
+        self.cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'a': 'apple', 'b': 'blueberry'})
+
+        # A new cookie changes the jar version
+        response.headers = {'Set-Cookie': 'c=cherry; Domain=www.test.com;'}
+        self.cookie_manager.process_response(None, response)
+        request = Request('http://www.test.com/path/page')
+        self.cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'a': 'apple', 'b': 'blueberry', 'c': 'cherry'})
+
+        # So does a deleted one
+        response.headers = {'Set-Cookie': 'a=; Domain=test.com; Max-Age=0;'}
+        self.cookie_manager.process_response(None, response)
+        request = Request('http://www.test.com/path/page')
+        self.cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'b': 'blueberry', 'c': 'cherry'})
+
+    def test_memoized_cookies_expire(self):
+        """
+        Test that an expired cookie is not served from the memoized resolution
+        """
+        response = Response()
+        response.headers = {'Set-Cookie': 'a=apple; Domain=test.com;, b=banana; Max-Age=3;'}
+        response.url = 'http://www.test.com/'
+        self.cookie_manager.process_response(None, response)
+
+        request = Request('http://www.test.com/')
+        self.cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'a': 'apple', 'b': 'banana'})
+
+        # 3 seconds pass by
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=3)
+        request = Request('http://www.test.com/')
+        self.cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'a': 'apple'})
+
+
+    def test_sweep(self):
+        """
+        Test that expired cookies are swept from their packs and usage records in bounded batches
+        """
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=self.cookie_cache, sweep_batch=2)
+        lookup_key = cookie_manager.get_origin_cookie_lookup_key('www.test.com')
+
+        response = Response()
+        response.headers = {'Set-Cookie': 'a=apple; Max-Age=1;, b=banana; Max-Age=2;, c=cherry; Max-Age=3;, d=date;'}
+        response.url = 'http://www.test.com/path'
+        cookie_manager.process_response(None, response)
+        self.assertEqual(self.get_packed_names(lookup_key), set(['a', 'b', 'c', 'd']))
+
+        # Nothing has expired yet
+        cookie_manager.sweep()
+        self.assertEqual(self.get_packed_names(lookup_key), set(['a', 'b', 'c', 'd']))
+        self.assertEqual(cookie_manager.get_stats(), {'test.com': (4, 25)})
+
+        # 3 seconds pass by. Nothing is sent, but the expired cookies are still packed.
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=3)
+        request = Request('http://www.test.com/path')
+        cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'d': 'date'})
+        self.assertEqual(self.get_packed_names(lookup_key), set(['a', 'b', 'c', 'd']))
+
+        # The sweep drops every expired cookie of the pack, but only the first two leave the usage record
+        with patch.object(self.cookie_cache, 'set', wraps=self.cookie_cache.set) as mock_set:
+            cookie_manager.sweep(now=time() + 3)
+            # The pack, the jar version, the usage record of the site and the jar totals
+            self.assertEqual(mock_set.call_count, 4)
+        self.assertEqual(self.get_packed_names(lookup_key), set(['d']))
+        self.assertEqual(cookie_manager.get_stats(), {'test.com': (2, 12)})
+
+        cookie_manager.sweep(now=time() + 3)
+        self.assertEqual(cookie_manager.get_stats(), {'test.com': (1, 5)})
+
+        # 'a' is set again before it is swept, so it stays
+        response.headers = {'Set-Cookie': 'a=apricot; Max-Age=1;'}
+        cookie_manager.process_response(None, response)
+        response.headers = {'Set-Cookie': 'a=avocado; Max-Age=10;'}
+        cookie_manager.process_response(None, response)
+        cookie_manager.sweep(now=time() + 5)
+        self.assertEqual(self.get_packed_names(lookup_key), set(['a', 'd']))
+        self.assertEqual(cookie_manager.get_stats(), {'test.com': (2, 13)})
+
+    def test_hosts_with_ports(self):
+        """
+        Test that the port of a host is ignored when cookies are matched to domains and counted against sites
+        """
+        response = Response()
+        for url in ('http://127.0.0.1:8000/', 'http://10.0.0.1:8000/'):
+            response.headers = {'Set-Cookie': 'a=apple;'}
+            response.url = url
+            self.cookie_manager.process_response(None, response)
+        self.assertEqual(sorted(self.cookie_manager.get_stats()), ['10.0.0.1', '127.0.0.1'])
+
+        response.headers = {'Set-Cookie': 'b=banana; Domain=test.com;'}
+        response.url = 'http://www.test.com:8000/'
+        self.cookie_manager.process_response(None, response)
+        request = Request('http://www.test.com:8000/path')
+        self.cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'b': 'banana'})
+        self.assertTrue('test.com' in self.cookie_manager.get_stats())
+
+    def test_empty_labels(self):
+        """
+        Test that a Domain attribute or host with an empty label is not taken for a domain that can hold cookies
+        """
+        response = Response()
+        response.url = 'http://x..com/'
+        response.headers = {'Set-Cookie': 'a=apple; Domain=x..com;'}
+        self.cookie_manager.process_response(None, response)
+        self.assertEqual(self.cookie_manager.get_cookies('http://x..com/'), {})
+        response.headers = {'Set-Cookie': 'b=banana;'}
+        self.cookie_manager.process_response(None, response)
+        self.assertEqual(self.cookie_manager.get_cookies('http://x..com/'), {'b': 'banana'})
+
+    def test_domain_of_another_site(self):
+        """
+        Test that a host cannot set cookies for a domain it does not belong to, nor evict the cookies of another site
+        """
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=self.cookie_cache, max_cookies_per_domain=3)
+        response = Response()
+        response.url = 'http://www.bank.com/'
+        response.headers = {'Set-Cookie': 'session=abc; Domain=bank.com;, sid=def;'}
+        cookie_manager.process_response(None, response)
+
+        response.url = 'http://evil.com:8000/'
+        response.headers = {'Set-Cookie': ', '.join('x%d=y; Domain=bank.com;' % i for i in xrange(5))}
+        cookie_manager.process_response(None, response)
+        response.url = 'http://bank.com.evil.com/'
+        cookie_manager.process_response(None, response)
+        response.url = 'http://127.0.0.1/'
+        response.headers = {'Set-Cookie': 'ip=1; Domain=0.0.1;'}
+        cookie_manager.process_response(None, response)
+        self.assertEqual(cookie_manager.get_cookies('http://www.bank.com/'), {'session': 'abc', 'sid': 'def'})
+        self.assertEqual(cookie_manager.get_stats().keys(), ['bank.com'])
+
+    def test_sweep_heap_bounded(self):
+        """
+        Test that setting the same cookie again and again keeps a single expiry deadline for it
+        """
+        lookup_key = self.cookie_manager.get_origin_cookie_lookup_key('www.test.com')
+        response = Response()
+        response.url = 'http://www.test.com/path'
+        for i in xrange(1000):
+            response.headers = {'Set-Cookie': '_ga=%d; Max-Age=%d;' % (i, 31536000 - i % 2)}
+            self.cookie_manager.process_response(None, response)
+        self.assertTrue(len(self.cookie_manager._expiry_heap) <= 2 + 64 + 1)
+
+        # The cookie is still swept once it expires
+        self.cookie_manager.sweep(now=time() + 31536000)
+        self.assertEqual(self.get_packed_names(lookup_key), set())
+        self.assertEqual(self.cookie_manager._expiry_heap, [])
+
+
+    def test_delete_cookie(self):
+        """
+        Test that a cookie set with Max-Age=0 leaves the index
+        """
+        lookup_key = self.cookie_manager.get_origin_cookie_lookup_key('www.test.com')
+
+        response = Response()
+        response.headers = {'Set-Cookie': 'a=apple;, b=banana;'}
+        response.url = 'http://www.test.com/path'
+        self.cookie_manager.process_response(None, response)
+        self.assertEqual(self.get_index(lookup_key), {'/': set(['a', 'b'])})
+
+        response.headers = {'Set-Cookie': 'a=; Max-Age=0;'}
+        self.cookie_manager.process_response(None, response)
+        self.assertEqual(self.get_index(lookup_key), {'/': set(['b'])})
+
+        request = Request('http://www.test.com/path')
+        self.cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'b': 'banana'})
+
+    def test_public_suffix_cookies(self):
+        """
+        Test that cookies for a public suffix are rejected, and that public suffixes are not looked up
+        """
+        response = Response()
+        response.headers = {
+            'Set-Cookie': 'a=apple; Domain=.com;, ' +           # Supercookie should be ignored
+                          'b=banana; Domain=co.uk;, ' +         # Supercookie should be ignored
+                          'c=cherry; Domain=test.co.uk;'
+        }
+        response.url = 'http://www.test.co.uk/path'
+        self.cookie_manager.process_response(None, response)
+        self.assertIsNone(self.get_index(self.cookie_manager.get_domain_cookie_lookup_key('com')))
+        self.assertIsNone(self.get_index(self.cookie_manager.get_domain_cookie_lookup_key('co.uk')))
+
+        request = Request('http://www.test.co.uk/path')
+        self.cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'c': 'cherry'})
+
+        # Only the registrable domain and the host itself are looked up, besides the origin cookies
+        with patch.object(self.cookie_cache, 'get', wraps=self.cookie_cache.get) as mock_get:
+            self.cookie_manager.get_cookies('http://www.other.co.uk/path')
+            looked_up = [args[0] for args, kwargs in mock_get.call_args_list]
+        self.assertIn(self.cookie_manager.get_domain_cookie_lookup_key('other.co.uk'), looked_up)
+        self.assertIn(self.cookie_manager.get_domain_cookie_lookup_key('www.other.co.uk'), looked_up)
+        self.assertNotIn(self.cookie_manager.get_domain_cookie_lookup_key('co.uk'), looked_up)
+        self.assertNotIn(self.cookie_manager.get_domain_cookie_lookup_key('uk'), looked_up)
+
+        # A public suffix host may set a cookie for itself, which is kept as an origin cookie
+        response.headers = {'Set-Cookie': 'd=durian; Domain=github.io;'}
+        response.url = 'http://github.io/'
+        self.cookie_manager.process_response(None, response)
+        request = Request('http://github.io/')
+        self.cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'d': 'durian'})
+        request = Request('http://test.github.io/')
+        self.cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {})
+
+    def test_cookie_limits(self):
+        """
+        Test that the least recently used cookies are evicted when a site or the jar holds too many
+        """
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=self.cookie_cache,
+                                       max_cookies_per_domain=3, max_cookies=5, max_cookie_size=20)
+        response = Response()
+
+        def set_cookies(url, header):
+            response.url = url
+            response.headers = {'Set-Cookie': header}
+            cookie_manager.process_response(None, response)
+
+        def get_cookies(url):
+            request = Request(url)
+            cookie_manager.process_request(request)
+            return request.cookies
+
+        with patch('dogbutler.cookie.time') as mock_time:
+            mock_time.return_value = 1000
+            set_cookies('http://www.test.com/', 'a=apple;, b=banana; Domain=test.com;')
+            mock_time.return_value = 1001
+            set_cookies('http://www.test.com/', 'c=cherry;')
+            self.assertEqual(cookie_manager.get_stats(), {'test.com': (3, 28)})
+
+            # Only 'b' is sent, so 'a' and then 'c' are the least recently used
+            mock_time.return_value = 1002
+            self.assertEqual(get_cookies('http://test.com/'), {'b': 'banana'})
+
+            # Setting an existing cookie again counts as a use, and does not evict anything
+            mock_time.return_value = 1003
+            set_cookies('http://www.test.com/', 'a=apricot;')
+            self.assertEqual(cookie_manager.get_stats(), {'test.com': (3, 30)})
+
+            # A fourth cookie for test.com evicts the least recently used one
+            mock_time.return_value = 1004
+            set_cookies('http://www.test.com/', 'd=durian; Domain=www.test.com;')
+            self.assertEqual(get_cookies('http://www.test.com/'), {'a': 'apricot', 'b': 'banana', 'd': 'durian'})
+            self.assertEqual(cookie_manager.get_stats(), {'test.com': (3, 42)})
+
+            # 'd' is now the least recently used
+            mock_time.return_value = 1005
+            get_cookies('http://test.com/')
+            set_cookies('http://www.test.com/', 'a=apricot;')
+
+            # The jar is full with 5 cookies, so the sixth evicts one from test.com, which holds the most
+            mock_time.return_value = 1006
+            set_cookies('http://other.com/', 'e=elderberry;, f=fig;')
+            set_cookies('http://another.com/', 'g=grape;')
+            self.assertEqual(get_cookies('http://www.test.com/'), {'a': 'apricot', 'b': 'banana'})
+            self.assertEqual(get_cookies('http://other.com/'), {'e': 'elderberry', 'f': 'fig'})
+            self.assertEqual(get_cookies('http://another.com/'), {'g': 'grape'})
+            self.assertEqual(sorted(cookie_manager.get_stats()), ['another.com', 'other.com', 'test.com'])
+            self.assertEqual(sum(count for count, size in cookie_manager.get_stats().values()), 5)
+
+            # A cookie that is too large is ignored
+            set_cookies('http://another.com/', 'h=' + 'huckleberry' * 2)
+            self.assertEqual(get_cookies('http://another.com/'), {'g': 'grape'})
+
+            # Deleting a cookie frees its place
+            set_cookies('http://another.com/', 'g=; Max-Age=0;')
+            self.assertEqual(get_cookies('http://another.com/'), {})
+            self.assertNotIn('another.com', cookie_manager.get_stats())
+
+    def test_expired_cookies_are_evicted_first(self):
+        """
+        Test that expired cookies are evicted before the least recently used ones
+        """
+        cookie_manager = CookieManager(key_prefix='test_cookie', cache=self.cookie_cache, max_cookies_per_domain=2)
+        response = Response()
+        response.url = 'http://www.test.com/'
+        response.headers = {'Set-Cookie': 'a=apple;, b=banana; Max-Age=3;'}
+        cookie_manager.process_response(None, response)
+
+        # 3 seconds pass by
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=3)
+        response.headers = {'Set-Cookie': 'c=cherry;'}
+        cookie_manager.process_response(None, response)
+
+        request = Request('http://www.test.com/')
+        cookie_manager.process_request(request)
+        self.assertEqual(request.cookies, {'a': 'apple', 'c': 'cherry'})
+        self.assertEqual(cookie_manager.get_stats(), {'test.com': (2, 13)})
+
+    def test_concurrent_writers(self):
+        """
+        Test that no cookie is lost when hundreds of threads set cookies for the same site at once
+        """
+        cache = PicklingCache()
+        cookie_managers = [
+            CookieManager(key_prefix='test_cookie', cache=cache, max_cookies_per_domain=1000),
+            CookieManager(key_prefix='test_cookie', cache=cache, max_cookies_per_domain=1000),
+        ]
+        n_writers = 200
+        start = Event()
+
+        def write(i):
+            response = Response()
+            response.url = 'http://www.test.com/'
+            if i % 2:
+                response.headers = {'Set-Cookie': 'c%d=v%d; Domain=test.com;' % (i, i)}
+            else:
+                response.headers = {'Set-Cookie': 'c%d=v%d;' % (i, i)}
+            start.wait()
+            cookie_managers[i % 2].process_response(None, response)
+
+        threads = [Thread(target=write, args=(i,)) for i in xrange(n_writers)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+
+        request = Request('http://www.test.com/')
+        cookie_managers[0].process_request(request)
+        self.assertEqual(request.cookies, dict(('c%d' % i, 'v%d' % i) for i in xrange(n_writers)))
+        self.assertEqual(cookie_managers[1].get_stats(), {'test.com': (n_writers, sum(
+            len('c%dv%d' % (i, i)) + (8 if i % 2 else 0) for i in xrange(n_writers)))})
+
+
+class PicklingCache(Cache):
+    """
+    A cache that stores copies of values, like cache backends that serialize
+    them, and yields to other threads on every call.
+    """
+
+    def get(self, key, default=None):
+        sleep(0.0001)
+        value = super(PicklingCache, self).get(key)
+        return default if value is None else pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        sleep(0.0001)
+        super(PicklingCache, self).set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), timeout)
+
+
+class TestPublicSuffixList(TestCase):
+
+    def test_registrable_domain(self):
+        self.assertEqual(get_registrable_domain('www.test.com'), 'test.com')
+        self.assertEqual(get_registrable_domain('test.com'), 'test.com')
+        self.assertEqual(get_registrable_domain('a.b.test.co.uk'), 'test.co.uk')
+        self.assertEqual(get_registrable_domain('WWW.Test.CO.UK'), 'test.co.uk')
+        self.assertEqual(get_registrable_domain('me.github.io'), 'me.github.io')
+        self.assertEqual(get_registrable_domain('www.test.unknowntld'), 'test.unknowntld')
+        self.assertIsNone(get_registrable_domain('co.uk'))
+        self.assertIsNone(get_registrable_domain('localhost'))
+        self.assertIsNone(get_registrable_domain('x..com'))
+        self.assertIsNone(get_registrable_domain('.com'))
+        self.assertEqual(domain_suffixes('x..com'), [])
+
+    def test_wildcard_and_exception_rules(self):
+        public_suffix_list = PublicSuffixList('*.ck\n!www.ck\n')
+        self.assertEqual(public_suffix_list.get_public_suffix('a.test.ck'), 'test.ck')
+        self.assertEqual(public_suffix_list.get_registrable_domain('a.test.ck'), 'a.test.ck')
+        self.assertEqual(public_suffix_list.get_registrable_domain('www.ck'), 'www.ck')
+        self.assertTrue(public_suffix_list.is_public_suffix('test.ck'))
+        self.assertFalse(public_suffix_list.is_public_suffix('www.ck'))
+
+    def test_load_from_file(self):
+        f = NamedTemporaryFile(suffix='.dat', delete=False)
+        try:
+            f.write('// comment\n\ncom\nexample.com  trailing text is ignored\n')
+            f.close()
+            public_suffix_list = PublicSuffixList.from_file(f.name)
+        finally:
+            os.remove(f.name)
+        self.assertTrue(public_suffix_list.is_public_suffix('example.com'))
+        self.assertEqual(public_suffix_list.get_registrable_domain('www.test.example.com'), 'test.example.com')
+
+        default = get_default_public_suffix_list()
+        set_default_public_suffix_list(public_suffix_list)
+        try:
+            self.assertEqual(domain_suffixes('www.test.example.com'), ['test.example.com', 'www.test.example.com'])
+            self.assertEqual(domain_suffixes('www.test.co.uk'), ['co.uk', 'test.co.uk', 'www.test.co.uk'])
+        finally:
+            set_default_public_suffix_list(default)
+        self.assertEqual(domain_suffixes('www.test.co.uk'), ['test.co.uk', 'www.test.co.uk'])
+        self.assertEqual(domain_suffixes('127.0.0.1'), ['127.0.0.1'])
+        self.assertEqual(domain_suffixes('127.0.0.1:8000'), ['127.0.0.1'])
+        self.assertEqual(domain_suffixes('[::1]:8000'), ['[::1]'])
+        self.assertEqual(domain_suffixes('www.test.co.uk:8000'), ['test.co.uk', 'www.test.co.uk'])
+
+
+class TestSetCookieParser(TestCase):
+
+    def test_parse_http_date(self):
+        """
+        Test the date formats allowed by RFC 6265
+        """
+        expected = timegm((2040, 1, 12, 12, 34, 22))
+        self.assertEqual(parse_http_date('Thu, 12 Jan 2040 12:34:22 GMT'), expected)          # RFC 1123
+        self.assertEqual(parse_http_date('Thu, 12-Jan-2040 12:34:22 GMT'), expected)          # Netscape
+        self.assertEqual(parse_http_date('Thursday, 12-Jan-40 12:34:22 GMT'), expected)       # RFC 850
+        self.assertEqual(parse_http_date('Thu Jan 12 12:34:22 2040'), expected)               # asctime
+        self.assertEqual(parse_http_date('12 jan 2040 12:34:22'), expected)
+        self.assertEqual(parse_http_date('Fri, 01 Jan 1999 00:00:00 GMT'), timegm((1999, 1, 1, 0, 0, 0)))
+        self.assertIsNone(parse_http_date('Fri, 02 Jan 2021 GMT'))                           # No time
+        self.assertIsNone(parse_http_date('Fri, 32 Jan 2021 00:00:00 GMT'))                  # No such day
+        self.assertIsNone(parse_http_date(''))
+
+    def test_parse_set_cookie(self):
+        cookie = parse_set_cookie('a=apple; Domain=.test.com; Path=/help; Max-Age=60; Secure; HttpOnly')
+        self.assertEqual((cookie.name, cookie.value), ('a', 'apple'))
+        self.assertEqual(cookie.domain, '.test.com')
+        self.assertEqual(cookie.path, '/help')
+        self.assertEqual(cookie.max_age, 60)
+        self.assertTrue(cookie.secure)
+        self.assertTrue(cookie.httponly)
+        self.assertIsNone(cookie.expires)
+
+        cookie = parse_set_cookie('b = "banana split" ; expires=Thu, 12 Jan 2040 12:34:22 GMT')
+        self.assertEqual((cookie.name, cookie.value), ('b', '"banana split"'))
+        self.assertEqual(cookie['expires'], 'Thu, 12-Jan-2040 12:34:22 GMT')
+        self.assertFalse(cookie.secure)
+
+        self.assertEqual(parse_set_cookie('a=apple; Max-Age=-5').max_age, -5)
+        for max_age in ('--5', '-', '5-', '5s', '1e3', ''):
+            self.assertIsNone(parse_set_cookie('a=apple; Max-Age=%s' % max_age).max_age)
+
+        self.assertEqual(parse_set_cookie('c=').value, '')
+        self.assertIsNone(parse_set_cookie('no equals sign'))
+        self.assertIsNone(parse_set_cookie('=value'))
+
+    def test_folded_headers_with_commas_in_dates(self):
+        """
+        Test that Set-Cookie headers folded into one by requests are split on cookie boundaries only
+        """
+        response = Response()
+        response.headers = {
+            'Set-Cookie': 'a=apple; expires=Thu, 12 Jan 2040 12:34:22 GMT, ' +
+                          'b=banana; expires=Thursday, 12-Jan-40 12:34:22 GMT; Path=/, ' +
+                          'c=cherry,pie'
+        }
+        cookies = parse_cookies(response)
+        self.assertEqual([(c.name, c.value) for c in cookies], [('a', 'apple'), ('b', 'banana'), ('c', 'cherry,pie')])
+        self.assertEqual(cookies[0].expires, cookies[1].expires)
+
+    def test_raw_headers(self):
+        """
+        Test that Set-Cookie headers are read one by one from the raw response when available
+        """
+        response = Response()
+        response.headers = {'Set-Cookie': 'folded=ignored'}
+        response.raw = Mock()
+        response.raw._original_response.msg.getheaders.return_value = [
+            'a=apple; expires=Thu, 12 Jan 2040 12:34:22 GMT',
+            'b=banana',
+        ]
+        cookies = parse_cookies(response)
+        response.raw._original_response.msg.getheaders.assert_called_with('set-cookie')
+        self.assertEqual([(c.name, c.value) for c in cookies], [('a', 'apple'), ('b', 'banana')])
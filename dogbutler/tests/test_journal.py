@@ -0,0 +1,203 @@
+import os
+from datetime import datetime, timedelta
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from dummycache import cache as dummycache_cache
+from mock import patch
+from requests.models import Response
+
+from dogbutler import Session
+from dogbutler.cookie import CookieManager
+from dogbutler.journal import CookieJournal, get_cookie_journal, get_journal_path
+from dogbutler.models import Request
+from dogbutler.tests.base import BaseTestCase, dummycache_time
+
+
+class TestCookieJournal(BaseTestCase):
+
+    def setUp(self):
+        super(TestCookieJournal, self).setUp()
+        self.directory = mkdtemp()
+        self.path = get_journal_path(self.directory, 'test_journal')
+        self.journals = []
+
+    def tearDown(self):
+        for journal in self.journals:
+            journal.close()
+        rmtree(self.directory)
+        super(TestCookieJournal, self).tearDown()
+
+    def open_journal(self, **kwargs):
+        journal = CookieJournal(self.path, **kwargs)
+        self.journals.append(journal)
+        return journal
+
+    def restart(self, **kwargs):
+        """
+        Close the journal, empty the cookie cache, and return a new manager restored from the journal
+        """
+        for journal in self.journals:
+            journal.close()
+        self.cookie_cache.clear()
+        return CookieManager(key_prefix='test_journal', cache=self.cookie_cache, journal=self.open_journal(**kwargs))
+
+    def set_cookies(self, cookie_manager, url, header):
+        response = Response()
+        response.headers = {'Set-Cookie': header}
+        response.url = url
+        cookie_manager.process_response(None, response)
+
+    def get_cookies(self, cookie_manager, url):
+        request = Request(url)
+        cookie_manager.process_request(request)
+        return request.cookies
+
+    def count_lines(self):
+        with open(self.path) as f:
+            return len(f.readlines())
+
+    def test_restore(self):
+        """
+        Test that the cookies of a manager are restored from its journal after a restart
+        """
+        cookie_manager = CookieManager(key_prefix='test_journal', cache=self.cookie_cache, journal=self.open_journal())
+        self.set_cookies(cookie_manager, 'http://www.test.com/path',
+                         'a=apple;, b=banana; Domain=.test.com;, c=cherry; Max-Age=10;, d=date; Path=/path;')
+        self.set_cookies(cookie_manager, 'http://www.test.com/path', 'a=avocado;, e=eggplant; Max-Age=0;')
+
+        cookie_manager = self.restart()
+        self.assertEqual(self.get_cookies(cookie_manager, 'http://www.test.com/path'),
+                         {'a': 'avocado', 'b': 'banana', 'c': 'cherry', 'd': 'date'})
+        self.assertEqual(self.get_cookies(cookie_manager, 'http://sweet.test.com/'), {'b': 'banana'})
+        self.assertEqual(cookie_manager.get_stats(), {'test.com': (4, 41)})
+
+        # The restored cookies still expire, and are swept
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=11)
+        self.assertEqual(self.get_cookies(cookie_manager, 'http://www.test.com/path'),
+                         {'a': 'avocado', 'b': 'banana', 'd': 'date'})
+        cookie_manager.sweep()
+        self.assertEqual(cookie_manager.get_stats(), {'test.com': (3, 34)})
+
+        # Cookies that expired while the process was down are not restored
+        self.set_cookies(cookie_manager, 'http://www.test.com/path', 'f=fig; Max-Age=5;')
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=20)
+        cookie_manager = self.restart()
+        self.assertEqual(self.get_cookies(cookie_manager, 'http://www.test.com/path'),
+                         {'a': 'avocado', 'b': 'banana', 'd': 'date'})
+        self.assertEqual(cookie_manager.get_stats(), {'test.com': (3, 34)})
+
+    def test_compact(self):
+        """
+        Test that compaction leaves one line per live pack, and keeps lines appended meanwhile
+        """
+        journal = self.open_journal(compact_min_records=1000)
+        cookie_manager = CookieManager(key_prefix='test_journal', cache=self.cookie_cache, journal=journal)
+        for i in xrange(10):
+            self.set_cookies(cookie_manager, 'http://www.test.com/', 'a=apple%d;' % i)
+        self.set_cookies(cookie_manager, 'http://www.test.org/', 'b=banana; Max-Age=1;')
+        self.set_cookies(cookie_manager, 'http://www.test.net/', 'c=cherry;')
+        self.set_cookies(cookie_manager, 'http://www.test.net/', 'c=cherry; Max-Age=0;')
+        self.assertEqual(self.count_lines(), 13)
+
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=2)
+        real_items = journal.items
+
+        def items(now=None):
+            # A cookie set while the live packs are being written out
+            result = real_items(now)
+            self.set_cookies(cookie_manager, 'http://www.test.net/', 'd=date;')
+            return result
+
+        with patch.object(journal, 'items', items):
+            journal.compact(now=dummycache_time())
+        self.assertEqual(self.count_lines(), 2)
+
+        cookie_manager = self.restart()
+        self.assertEqual(self.get_cookies(cookie_manager, 'http://www.test.com/'), {'a': 'apple9'})
+        self.assertEqual(self.get_cookies(cookie_manager, 'http://www.test.org/'), {})
+        self.assertEqual(self.get_cookies(cookie_manager, 'http://www.test.net/'), {'d': 'date'})
+
+    def test_background_compaction(self):
+        """
+        Test that the journal is compacted in the background once it holds too many lines per live pack
+        """
+        journal = self.open_journal(compact_min_records=10, compact_ratio=2)
+        cookie_manager = CookieManager(key_prefix='test_journal', cache=self.cookie_cache, journal=journal)
+        for i in xrange(9):
+            self.set_cookies(cookie_manager, 'http://www.test.com/', 'a=apple%d;' % i)
+        self.assertEqual(journal._compactor, None)
+
+        self.set_cookies(cookie_manager, 'http://www.test.com/', 'a=apple9;')
+        journal._compactor.join()
+        self.assertEqual(self.count_lines(), 1)
+
+        cookie_manager = self.restart()
+        self.assertEqual(self.get_cookies(cookie_manager, 'http://www.test.com/'), {'a': 'apple9'})
+
+    def test_torn_line(self):
+        """
+        Test that a line torn by a crash is skipped, and does not corrupt the lines appended after it
+        """
+        cookie_manager = CookieManager(key_prefix='test_journal', cache=self.cookie_cache, journal=self.open_journal())
+        self.set_cookies(cookie_manager, 'http://www.test.com/', 'a=apple;')
+        self.journals[0].close()
+        with open(self.path, 'a') as f:
+            f.write("('ktest_journal/www.test.com', 'test.com', 1")
+
+        cookie_manager = self.restart()
+        self.assertEqual(self.get_cookies(cookie_manager, 'http://www.test.com/'), {'a': 'apple'})
+        self.set_cookies(cookie_manager, 'http://www.test.com/', 'b=banana;')
+
+        cookie_manager = self.restart()
+        self.assertEqual(self.get_cookies(cookie_manager, 'http://www.test.com/'), {'a': 'apple', 'b': 'banana'})
+        self.assertEqual(self.count_lines(), 2)
+
+    def test_migrate_keys(self):
+        """
+        Test that packs journaled under legacy keys are restored under compact keys, and journaled again under them
+        """
+        cookie_manager = CookieManager(key_prefix='test_journal', cache=self.cookie_cache, journal=self.open_journal(),
+                                       legacy_keys=True)
+        self.set_cookies(cookie_manager, 'http://www.test.com/', 'a=apple;, b=banana; Domain=.test.com;')
+        self.assertTrue(self.cookie_cache.get('test_journal.cookie.origin.www.test.com'))
+        self.assertTrue(self.cookie_cache.get('test_journal.cookie.test.com'))
+
+        cookie_manager = self.restart()
+        self.assertEqual(self.get_cookies(cookie_manager, 'http://www.test.com/'), {'a': 'apple', 'b': 'banana'})
+        self.assertEqual(sorted(key for key in self.cookie_cache._dict if not key.startswith('ktest_journal:')),
+                         ['ktest_journal.test.com', 'ktest_journal/www.test.com'])
+        self.assertEqual(sorted(lookup_key for lookup_key, site, written, pack in self.journals[-1].items()),
+                         ['ktest_journal.test.com', 'ktest_journal/www.test.com'])
+
+        cookie_manager = self.restart()
+        self.assertEqual(self.get_cookies(cookie_manager, 'http://www.test.com/'), {'a': 'apple', 'b': 'banana'})
+
+    @patch('requests.sessions.Session.request')
+    def test_sessions(self, mock_request):
+        """
+        Test that a session journals its cookies under its key prefix, and only that session's cookies are restored
+        """
+        response = Response()
+        response.status_code = 200
+        response.headers = {'Set-Cookie': 'a=apple;'}
+        response.url = 'http://www.test.com/'
+        mock_request.return_value = response
+        s0 = Session(key_prefix='s0', journal_dir=self.directory)
+        s0.get('http://www.test.com/')
+        response.headers = {'Set-Cookie': 'b=banana;'}
+        s1 = Session(key_prefix='s1', journal_dir=self.directory)
+        s1.get('http://www.test.com/')
+        self.assertTrue(os.path.exists(get_journal_path(self.directory, 's0')))
+        self.assertTrue(os.path.exists(get_journal_path(self.directory, 's1')))
+        self.assertTrue(get_cookie_journal(self.directory, 's0') is s0.get_managers()[1].journal)
+        get_cookie_journal(self.directory, 's0').close()
+        get_cookie_journal(self.directory, 's1').close()
+
+        # Restart
+        self.cookie_cache.clear()
+        response.headers = {}
+        s0 = Session(key_prefix='s0', journal_dir=self.directory)
+        s0.get('http://www.test.com/')
+        self.assertEqual(mock_request.call_args[1]['cookies'], {'a': 'apple'})
+        get_cookie_journal(self.directory, 's0').close()
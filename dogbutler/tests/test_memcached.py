@@ -0,0 +1,190 @@
+import socket
+from threading import Thread
+from time import time
+
+from mock import patch
+from requests.models import Response
+
+from dogbutler import Session
+from dogbutler.backends import MemcachedCache, ShardedCache
+from dogbutler.backends.memcached import Connection, FLAG_COMPRESSED, HASHED_KEY_TAG
+from dogbutler.cache import LONG_TERM_CACHE_SECONDS
+from dogbutler.defaults import get_default_cache, set_default_cache, get_default_cookie_cache, set_default_cookie_cache
+from dogbutler.tests.base import BaseTestCase
+from dogbutler.tests.memcachedstub import MemcachedStub
+
+
+class TestMemcachedCache(BaseTestCase):
+
+    def setUp(self):
+        super(TestMemcachedCache, self).setUp()
+        self.server = MemcachedStub()
+        self.server.start()
+        self.memcached = MemcachedCache(self.server.address)
+
+    def tearDown(self):
+        self.memcached.close()
+        self.server.stop()
+        super(TestMemcachedCache, self).tearDown()
+
+    def test_get_set_add_delete(self):
+        self.assertIsNone(self.memcached.get('key'))
+        self.assertEqual(self.memcached.get('key', 'default'), 'default')
+        self.memcached.set('key', {'value': [1, u'\u0e01']})
+        self.assertEqual(self.memcached.get('key'), {'value': [1, u'\u0e01']})
+        self.assertFalse(self.memcached.add('key', 'other'))
+        self.assertTrue(self.memcached.add('other', 'other'))
+        self.assertEqual(self.memcached.get('other'), 'other')
+        self.memcached.delete('key')
+        self.assertIsNone(self.memcached.get('key'))
+        self.memcached.clear()
+        self.assertEqual(self.server.items, {})
+
+    def test_timeout(self):
+        """
+        Test that timeouts are sent as memcached reads them, and that a timeout of 0 or less deletes the key.
+        """
+        self.memcached.set('never', 1)
+        self.memcached.set('short', 1, 10)
+        self.memcached.set('long', 1, LONG_TERM_CACHE_SECONDS)
+        self.assertEqual(self.server.items['never'][2], 0)
+        self.assertEqual(self.server.items['short'][2], 10)
+        self.memcached.set('fraction', 1, 0.25)
+        self.assertEqual(self.server.items['fraction'][2], 1)
+        self.assertTrue(abs(self.server.items['long'][2] - (time() + LONG_TERM_CACHE_SECONDS)) < 5)
+        self.memcached.set('short', 1, 0)
+        self.assertFalse('short' in self.server.items)
+        self.assertFalse(self.memcached.add('short', 1, -1))
+        self.assertFalse('short' in self.server.items)
+
+    def test_many(self):
+        """
+        Test that get_many, set_many and delete_many take one round trip each.
+        """
+        data = dict(('key-%d' % i, i) for i in xrange(1000))
+        sends = []
+        original_send = Connection.send
+        def send(connection, data):
+            sends.append(data)
+            original_send(connection, data)
+
+        with patch.object(Connection, 'send', send):
+            self.memcached.set_many(data, 10)
+            self.assertEqual(len(sends), 4)         # Pipelined in batches of 256
+            self.assertEqual(self.memcached.get_many(data.keys() + ['missing']), data)
+            self.assertEqual(len(sends), 5)
+            self.memcached.delete_many(data.keys()[:200])
+            self.assertEqual(len(sends), 6)
+        self.assertEqual(len(self.memcached.get_many(data.keys())), 800)
+        self.assertEqual(self.memcached.get_many([]), {})
+
+    def test_compression(self):
+        value = 'x' * 10000
+        self.memcached.set('plain', value)
+        self.assertFalse(self.server.items['plain'][0] & FLAG_COMPRESSED)
+
+        memcached = MemcachedCache(self.server.address, compress_min_length=1024)
+        memcached.set('small', 'x' * 10)
+        memcached.set('large', value)
+        self.assertFalse(self.server.items['small'][0] & FLAG_COMPRESSED)
+        self.assertTrue(self.server.items['large'][0] & FLAG_COMPRESSED)
+        self.assertTrue(len(self.server.items['large'][1]) < 1000)
+        self.assertEqual(memcached.get('large'), value)
+        self.assertEqual(self.memcached.get('large'), value)
+        memcached.close()
+
+    def test_raw_value(self):
+        """
+        Test that values stored by other clients without flags are read as strings.
+        """
+        self.server.items['raw'] = (0, 'value', 0)
+        self.assertEqual(self.memcached.get('raw'), 'value')
+
+    def test_invalid_keys(self):
+        """
+        Test that keys memcached would refuse are stored under their digest.
+        """
+        for key in ('x' * 300, 'key with spaces', u'\u0e01\u0e02 \u0e03'):
+            self.memcached.set(key, key)
+            self.assertEqual(self.memcached.get(key), key)
+            self.assertEqual(self.memcached.get_many([key, 'missing']), {key: key})
+        self.assertTrue(all(key.startswith(HASHED_KEY_TAG) and len(key) == 23 for key in self.server.items))
+
+    def test_pool(self):
+        """
+        Test that connections are reused, and that threads share at most pool_size of them.
+        """
+        for i in xrange(10):
+            self.memcached.set('key', i)
+            self.memcached.get('key')
+        self.assertEqual(self.server.connections, 1)
+
+        memcached = MemcachedCache(self.server.address, pool_size=3)
+        errors = []
+        def work(n):
+            try:
+                for i in xrange(50):
+                    memcached.set('key-%d' % n, i)
+                    self.assertEqual(memcached.get('key-%d' % n), i)
+            except Exception, e:
+                errors.append(e)
+        threads = [Thread(target=work, args=(n,)) for n in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        memcached.close()
+        self.assertEqual(errors, [])
+        self.assertTrue(self.server.connections <= 1 + 3)
+
+    def test_server_down(self):
+        """
+        Test that a cache whose server cannot be reached misses and stores nothing, rather than raising.
+        """
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        address = sock.getsockname()
+        sock.close()
+        memcached = MemcachedCache(address, timeout=1)
+        memcached.set('key', 'value')
+        self.assertFalse(memcached.add('key', 'value'))
+        self.assertIsNone(memcached.get('key'))
+        self.assertEqual(memcached.get_many(['key']), {})
+        memcached.delete_many(['key'])
+
+    @patch('requests.sessions.Session.request')
+    def test_session(self, mock_request):
+        """
+        Test that sessions cache responses and keep cookies in memcached, sharded over two servers.
+        """
+        response = Response()
+        response.url = 'http://www.test.com/path'
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {'Cache-Control': 'private, max-age=10', 'Set-Cookie': 'consent=yes'}
+        mock_request.return_value = response
+
+        server = MemcachedStub()
+        server.start()
+        memcached = MemcachedCache(server.address)
+        sharded_cache = ShardedCache({'cache-1': self.memcached, 'cache-2': memcached})
+        default_cache, default_cookie_cache = get_default_cache(), get_default_cookie_cache()
+        set_default_cache(sharded_cache)
+        set_default_cookie_cache(sharded_cache)
+        try:
+            s = Session()
+            s.get('http://www.test.com/path')
+            s.get('http://www.test.com/path')
+            self.assertEqual(mock_request.call_count, 1)
+            self.assertEqual(s.get('http://www.test.com/path').content, 'Mocked response content')
+            s.get('http://www.test.com/other')
+            mock_request.assert_called_with('GET', 'http://www.test.com/other', allow_redirects=True,
+                                            cookies={'consent': 'yes'})
+            s.close()
+            self.assertEqual(self.server.items, {})
+            self.assertEqual(server.items, {})
+        finally:
+            set_default_cookie_cache(default_cookie_cache)
+            set_default_cache(default_cache)
+            memcached.close()
+            server.stop()
@@ -0,0 +1,355 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from dummycache import cache as dummycache_cache
+from dummycache.cache import Cache
+from mock import patch
+from requests.exceptions import TooManyRedirects
+from requests.models import Response
+
+from dogbutler.models import Request
+from dogbutler.redirect import RedirectManager
+from dogbutler.tests.base import BaseTestCase, GetManyCache
+
+
+class TestRedirectManager(BaseTestCase):
+
+    def setUp(self):
+        super(TestRedirectManager, self).setUp()
+        self.redirect_cache = GetManyCache()
+        self.redirect_manager = RedirectManager(key_prefix='test_redirect', cache=self.redirect_cache)
+
+    @contextmanager
+    def count_round_trips(self):
+        """
+        Yield a function that returns the number of reads from the redirect cache so far
+        """
+        with patch.object(self.redirect_cache, 'get', wraps=self.redirect_cache.get) as mock_get:
+            with patch.object(self.redirect_cache, 'get_many', wraps=self.redirect_cache.get_many) as mock_get_many:
+                yield lambda: mock_get.call_count + mock_get_many.call_count
+
+    def respond(self, url, *redirects, **kwargs):
+        """
+        Run a response for url through the redirect manager, after redirects given as (status code, url, location)
+        or (status code, url, location, Cache-Control). The request is made without credentials, unless given.
+        """
+        response = Response()
+        response.status_code = kwargs.get('status_code', 200)
+        response.url = url
+        response.headers = kwargs.get('headers', {})
+        for redirect in redirects:
+            r = Response()
+            r.status_code, r.url, r.headers['Location'] = redirect[:3]
+            if len(redirect) > 3:
+                r.headers['Cache-Control'] = redirect[3]
+            response.history.append(r)
+        request = Request(url, **kwargs.get('request', {}))
+        kwargs.get('redirect_manager', self.redirect_manager).process_response(
+            request, response, allow_redirects=kwargs.get('allow_redirects', True))
+
+    def resolve(self, url, redirect_manager=None):
+        request = Request(url)
+        (redirect_manager or self.redirect_manager).process_request(request)
+        return request.url
+
+    def test_chain_is_compressed(self):
+        """
+        Test that every URL in a chain of 301s resolves to the final target with a single lookup
+        """
+        self.respond('http://test.com/d',
+                     (301, 'http://test.com/a', 'http://test.com/b'),
+                     (301, 'http://test.com/b', 'http://test.com/c'),
+                     (301, 'http://test.com/c', 'http://test.com/d'))
+
+        with self.count_round_trips() as round_trips:
+            for url in ('http://test.com/a', 'http://test.com/b', 'http://test.com/c'):
+                self.assertEqual(self.resolve(url), 'http://test.com/d')
+            self.assertEqual(round_trips(), 3)
+        self.assertEqual(self.resolve('http://test.com/d'), 'http://test.com/d')
+
+    def test_chain_changes(self):
+        """
+        Test that a chain extended by a later response is followed once, then compressed again
+        """
+        self.respond('http://test.com/b', (301, 'http://test.com/a', 'http://test.com/b'))
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/b')
+
+        # b now redirects too
+        self.respond('http://test.com/c', (301, 'http://test.com/b', 'http://test.com/c'))
+        with self.count_round_trips() as round_trips:
+            self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/c')
+            # The batch, then b, c and the rule of the origin of c
+            self.assertEqual(round_trips(), 4)
+        with self.count_round_trips() as round_trips:
+            self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/c')
+            self.assertEqual(round_trips(), 1)
+
+    def test_temporary_redirect_in_chain(self):
+        """
+        Test that a 301 is compressed only up to the next redirect that is not permanent
+        """
+        self.respond('http://test.com/d',
+                     (301, 'http://test.com/a', 'http://test.com/b'),
+                     (302, 'http://test.com/b', 'http://test.com/c'),
+                     (301, 'http://test.com/c', 'http://test.com/d'))
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/b')
+        self.assertEqual(self.resolve('http://test.com/b'), 'http://test.com/b')
+        self.assertEqual(self.resolve('http://test.com/c'), 'http://test.com/d')
+
+    def test_permanent_redirect(self):
+        """
+        Test that a 308 is cached like a 301, including one that was not followed
+        """
+        self.respond('http://test.com/c',
+                     (308, 'http://test.com/a', 'http://test.com/b'),
+                     (301, 'http://test.com/b', 'http://test.com/c'))
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/c')
+
+        self.respond('http://test.com/c', status_code=308, headers={'Location': 'http://test.com/d'})
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/d')
+
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(days=365)
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/d')
+
+    def test_redirect_not_followed_on_request(self):
+        """
+        Test that a redirect is not recorded if the caller asked for redirects not to be followed
+        """
+        self.respond('http://test.com/a', status_code=301, headers={'Location': 'http://test.com/b'},
+                     allow_redirects=False)
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/a')
+
+    def test_temporary_redirects(self):
+        """
+        Test that 302, 303 and 307 are cached for their max-age only
+        """
+        self.respond('http://test.com/home',
+                     (302, 'http://test.com/', 'http://test.com/login', 'max-age=10'),
+                     (303, 'http://test.com/login', 'http://test.com/home', 'max-age=20'))
+        self.respond('http://cdn.test.com/x', (307, 'http://test.com/x', 'http://cdn.test.com/x', 'max-age=30'))
+        self.respond('http://test.com/home', (302, 'http://test.com/y', 'http://test.com/home'))
+        self.respond('http://test.com/home', (302, 'http://test.com/z', 'http://test.com/home', 'max-age=10, no-cache'))
+        self.assertEqual(self.resolve('http://test.com/'), 'http://test.com/home')
+        self.assertEqual(self.resolve('http://test.com/login'), 'http://test.com/home')
+        self.assertEqual(self.resolve('http://test.com/x'), 'http://cdn.test.com/x')
+        self.assertEqual(self.resolve('http://test.com/y'), 'http://test.com/y')
+        self.assertEqual(self.resolve('http://test.com/z'), 'http://test.com/z')
+
+        # The chain from / is only valid until its 302 expires
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=11)
+        self.assertEqual(self.resolve('http://test.com/'), 'http://test.com/')
+        self.assertEqual(self.resolve('http://test.com/login'), 'http://test.com/home')
+        self.assertEqual(self.resolve('http://test.com/x'), 'http://cdn.test.com/x')
+
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=31)
+        self.assertEqual(self.resolve('http://test.com/login'), 'http://test.com/login')
+        self.assertEqual(self.resolve('http://test.com/x'), 'http://test.com/x')
+
+    def test_expired_entries(self):
+        """
+        Test that a temporary redirect is not followed once it expires, even if the cache still holds it
+        """
+        # A cache that keeps its entries for good
+        self.redirect_cache.set = lambda key, value, timeout=None: Cache.set(self.redirect_cache, key, value)
+        self.respond('http://test.com/home', (302, 'http://test.com/', 'http://test.com/home', 'max-age=10'))
+        self.respond('http://test.com/c',
+                     (301, 'http://test.com/a', 'http://test.com/b'),
+                     (307, 'http://test.com/b', 'http://test.com/c', 'max-age=10'))
+        self.assertEqual(self.resolve('http://test.com/'), 'http://test.com/home')
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/c')
+
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=11)
+        self.assertEqual(self.resolve('http://test.com/'), 'http://test.com/')
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/b')
+        self.assertEqual(self.resolve('http://test.com/b'), 'http://test.com/b')
+
+    def test_permanent_redirect_to_temporary_redirect(self):
+        """
+        Test that a 301 compressed through a temporary redirect is followed again once it expires
+        """
+        self.respond('http://test.com/c',
+                     (301, 'http://test.com/a', 'http://test.com/b'),
+                     (307, 'http://test.com/b', 'http://test.com/c', 'max-age=10'))
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/c')
+        with self.count_round_trips() as round_trips:
+            self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/c')
+            self.assertEqual(round_trips(), 1)
+
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=11)
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/b')
+        with self.count_round_trips() as round_trips:
+            self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/b')
+            self.assertEqual(round_trips(), 1)
+
+    def test_origin_rules(self):
+        """
+        Test that an origin seen moved for enough paths is rewritten before its other paths are requested
+        """
+        self.respond('https://www.test.com/a', (301, 'http://test.com/a', 'https://test.com/a'),
+                     (301, 'https://test.com/a', 'https://www.test.com/a'))
+        self.respond('https://www.test.com/b?q=1', (301, 'http://test.com/b?q=1', 'https://test.com/b?q=1'),
+                     (301, 'https://test.com/b?q=1', 'https://www.test.com/b?q=1'))
+        # The same path again, and a redirect that changes the path, do not count
+        self.respond('https://www.test.com/a', (301, 'http://test.com/a', 'https://test.com/a'))
+        self.respond('https://test.com/d', (301, 'http://test.com/c', 'https://test.com/d'))
+        self.assertEqual(self.resolve('http://test.com/new'), 'http://test.com/new')
+
+        self.respond('https://www.test.com/', (301, 'http://test.com', 'https://test.com'),
+                     (301, 'https://test.com/', 'https://www.test.com/'))
+        self.assertEqual(self.resolve('http://test.com/new'), 'https://www.test.com/new')
+        self.assertEqual(self.resolve('https://test.com/new?q=2'), 'https://www.test.com/new?q=2')
+        # URLs with an entry of their own are not rewritten
+        self.assertEqual(self.resolve('http://test.com/c'), 'https://www.test.com/d')
+        self.assertEqual(self.resolve('http://www.test.com/new'), 'http://www.test.com/new')
+
+        # The rewritten URL now has an entry of its own
+        with self.count_round_trips() as round_trips:
+            self.assertEqual(self.resolve('http://test.com/new'), 'https://www.test.com/new')
+            self.assertEqual(round_trips(), 1)
+
+        # A path moved to another origin starts the count again
+        self.respond('https://test.org/f', (301, 'https://test.com/f', 'https://test.org/f'))
+        self.assertEqual(self.resolve('https://test.com/g'), 'https://test.com/g')
+        self.assertEqual(self.resolve('http://test.com/g'), 'https://test.com/g')
+
+    def test_origin_rules_disabled(self):
+        """
+        Test that no rules are learned with a rule_confidence of 0
+        """
+        self.redirect_manager = RedirectManager(key_prefix='test_redirect', cache=self.redirect_cache,
+                                                rule_confidence=0)
+        for path in ('/a', '/b', '/c', '/d'):
+            self.respond('https://test.com' + path, (301, 'http://test.com' + path, 'https://test.com' + path))
+        self.assertEqual(self.resolve('http://test.com/new'), 'http://test.com/new')
+
+    def test_loop(self):
+        """
+        Test that a redirect loop made across responses is detected
+        """
+        self.respond('http://test.com/b', (301, 'http://test.com/a', 'http://test.com/b'))
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/b')
+        self.respond('http://test.com/c',
+                     (301, 'http://test.com/b', 'http://test.com/a'),
+                     (302, 'http://test.com/a', 'http://test.com/c'))
+        with self.assertRaises(TooManyRedirects):
+            self.resolve('http://test.com/a')
+        with self.assertRaises(TooManyRedirects):
+            self.resolve('http://test.com/b')
+
+    def test_redirect_removed(self):
+        """
+        Test that a URL that answers without redirecting no longer redirects
+        """
+        self.respond('http://test.com/b', (301, 'http://test.com/a', 'http://test.com/b'))
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/b')
+        self.respond('http://test.com/a', (302, 'http://test.com/x', 'http://test.com/a'))
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/a')
+
+    def test_uncompressed_entries(self):
+        """
+        Test that entries holding only the Location are still followed
+        """
+        self.redirect_cache.set(self.redirect_manager.get_cache_key('http://test.com/a'), 'http://test.com/b')
+        self.redirect_cache.set(self.redirect_manager.get_cache_key('http://test.com/b'), 'http://test.com/c')
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/c')
+        with self.count_round_trips() as round_trips:
+            self.assertEqual(self.resolve('http://test.com/b'), 'http://test.com/c')
+            self.assertEqual(round_trips(), 1)
+
+    def test_resolve(self):
+        """
+        Test that a batch of URLs is resolved in one round trip
+        """
+        self.respond('http://test.com/c',
+                     (301, 'http://test.com/a', 'http://test.com/b'),
+                     (301, 'http://test.com/b', 'http://test.com/c'))
+        self.respond('http://test.org/', (301, 'http://test.org/old', 'http://test.org/'))
+
+        urls = ['http://test.com/a', 'http://test.org/old', 'http://test.net/', 'http://test.com/b', 'http://test.com/a']
+        # The first chain was learned before the redirects last changed, so it is followed once
+        self.redirect_manager.resolve(urls)
+        with self.count_round_trips() as round_trips:
+            self.assertEqual(self.redirect_manager.resolve(urls), [
+                'http://test.com/c', 'http://test.org/', 'http://test.net/', 'http://test.com/c', 'http://test.com/c',
+            ])
+            self.assertEqual(round_trips(), 1)
+
+    def test_shared_redirects(self):
+        """
+        Test that permanent redirects seen without credentials are shared by managers with different key prefixes
+        """
+        self.respond('http://test.com/c',
+                     (301, 'http://test.com/a', 'http://test.com/b'),
+                     (301, 'http://test.com/b', 'http://test.com/c'))
+        other_manager = RedirectManager(key_prefix='other', cache=self.redirect_cache)
+        with self.count_round_trips() as round_trips:
+            self.assertEqual(self.resolve('http://test.com/a', other_manager), 'http://test.com/c')
+            self.assertEqual(round_trips(), 1)
+
+        # Not shared with a manager that opts out
+        private_manager = RedirectManager(key_prefix='private', cache=self.redirect_cache, shared_key_prefix=None)
+        self.assertEqual(self.resolve('http://test.com/a', private_manager), 'http://test.com/a')
+        self.respond('http://test.com/d', (301, 'http://test.com/a', 'http://test.com/d'),
+                     redirect_manager=private_manager)
+        self.assertEqual(self.resolve('http://test.com/a', private_manager), 'http://test.com/d')
+        self.assertEqual(self.resolve('http://test.com/a', other_manager), 'http://test.com/c')
+
+        # Nor followed by requests with credentials, and neither are shared rules
+        for path in ('/x', '/y', '/z'):
+            self.respond('https://test.com' + path, (301, 'http://test.com' + path, 'https://test.com' + path))
+        self.assertEqual(self.resolve('http://test.com/new', other_manager), 'https://test.com/new')
+        self.assertEqual(other_manager.resolve(['http://test.com/a', 'http://test.com/new'], credentials=True),
+                         ['http://test.com/a', 'http://test.com/new'])
+        request = Request('http://test.com/a', cookies={'session': 'abc'})
+        other_manager.process_request(request)
+        self.assertEqual(request.url, 'http://test.com/a')
+
+    def test_own_redirects(self):
+        """
+        Test that redirects seen with credentials, or setting cookies, are kept by their manager only and override
+        the shared ones
+        """
+        other_manager = RedirectManager(key_prefix='other', cache=self.redirect_cache)
+        self.respond('http://test.com/login',
+                     (301, 'http://test.com/account', 'http://test.com/login'),
+                     request={'cookies': {'session': 'expired'}})
+        self.assertEqual(self.resolve('http://test.com/account'), 'http://test.com/login')
+        self.assertEqual(self.resolve('http://test.com/account', other_manager), 'http://test.com/account')
+
+        # A redirect that sets a cookie
+        response = Response()
+        response.status_code = 200
+        response.url = 'http://test.com/b'
+        redirect = Response()
+        redirect.status_code = 301
+        redirect.url = 'http://test.com/a'
+        redirect.headers = {'Location': 'http://test.com/b', 'Set-Cookie': 'a=apple;'}
+        response.history.append(redirect)
+        self.redirect_manager.process_response(Request('http://test.com/a'), response)
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/b')
+        self.assertEqual(self.resolve('http://test.com/a', other_manager), 'http://test.com/a')
+
+        # An own redirect overrides a shared one
+        self.respond('http://test.com/start', (301, 'http://test.com/home', 'http://test.com/start'),
+                     redirect_manager=other_manager)
+        self.assertEqual(self.resolve('http://test.com/home'), 'http://test.com/start')
+        self.respond('http://test.com/dashboard', (301, 'http://test.com/home', 'http://test.com/dashboard'),
+                     request={'headers': {'Authorization': 'Basic dXNlcjpwYXNz'}})
+        self.assertEqual(self.resolve('http://test.com/home'), 'http://test.com/dashboard')
+        self.assertEqual(self.resolve('http://test.com/home', other_manager), 'http://test.com/start')
+
+    def test_legacy_keys(self):
+        """
+        Test that URLs are keyed by digest, unless legacy keys are asked for
+        """
+        legacy_manager = RedirectManager(key_prefix='test_redirect', cache=self.redirect_cache, legacy_keys=True)
+        self.assertEqual(self.redirect_manager.get_cache_key('http://test.com/a'),
+                         'rtest_redirect.GPtdlo5CNoeS1N_-SbQi8Q')
+        self.assertEqual(legacy_manager.get_cache_key('http://test.com/a'), 'test_redirect.redirect.http://test.com/a')
+        self.assertEqual(self.redirect_manager.get_rule_key('http://test.com/a'), 'rtest_redirect/http://test.com')
+        self.assertEqual(self.redirect_manager.get_version_key(shared=True), 'rshared:v')
+
+        self.respond('http://test.com/b', (301, 'http://test.com/a', 'http://test.com/b'),
+                     request={'cookies': {'a': 'apple'}}, redirect_manager=legacy_manager)
+        self.assertEqual(self.resolve('http://test.com/a', legacy_manager), 'http://test.com/b')
+        self.assertEqual(self.resolve('http://test.com/a'), 'http://test.com/a')
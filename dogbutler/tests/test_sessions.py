@@ -1,10 +1,12 @@
 from datetime import datetime, timedelta
+from itertools import count
 
 from dummycache import cache as dummycache_cache
 from mock import patch
 from requests.models import Response
 
-from dogbutler import Session
+from dogbutler import Session, sessions
+from dogbutler.models import Request
 from dogbutler.tests.base import BaseTestCase
 
 
@@ -13,12 +15,12 @@ class TestSessions(BaseTestCase):
 
     def test_cache(self, mock_request):
         """
-        Test that each session has its own cache "sandbox".
+        Test that each session has its own cache "sandbox" for private responses.
         """
         response = Response()
         response.status_code = 200
         response._content = 'Mocked response content'
-        response.headers = {'Cache-Control': 'max-age=10'}
+        response.headers = {'Cache-Control': 'private, max-age=10'}
 
         mock_request.return_value = response
 
@@ -67,6 +69,98 @@ class TestSessions(BaseTestCase):
         s1.get('http://www.test.com/path')
         self.assertEqual(mock_request.call_count, 4)
 
+    def test_shared_cache(self, mock_request):
+        """
+        Test that sessions share the responses any user could be given.
+        """
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {'Cache-Control': 'max-age=10'}
+
+        mock_request.return_value = response
+
+        s0 = Session()
+        s1 = Session()
+        s2 = Session()
+
+        # s0 makes a request without credentials. s1 gets it from cache.
+        s0.get('http://www.test.com/path')
+        self.assertEqual(mock_request.call_count, 1)
+        s1.get('http://www.test.com/path')
+        self.assertEqual(mock_request.call_count, 1)
+
+        # s2 makes a request with credentials. It may be given another page, so it is not answered from cache.
+        s2.get('http://www.test.com/path', cookies={'name': 'value'})
+        self.assertEqual(mock_request.call_count, 2)
+        s2.get('http://www.test.com/path', cookies={'name': 'value'})
+        self.assertEqual(mock_request.call_count, 2)
+
+        # A public response is shared, even if requested with credentials
+        response.headers = {'Cache-Control': 'public, max-age=10'}
+        s2.get('http://www.test.com/public', cookies={'name': 'value'})
+        self.assertEqual(mock_request.call_count, 3)
+        s0.get('http://www.test.com/public', cookies={'name': 'value'})
+        self.assertEqual(mock_request.call_count, 3)
+
+        # A response that varies on cookies or sets one is not
+        response.headers = {'Cache-Control': 'public, max-age=10', 'Vary': 'Accept-Encoding, Cookie'}
+        s0.get('http://www.test.com/vary')
+        self.assertEqual(mock_request.call_count, 4)
+        s1.get('http://www.test.com/vary')
+        self.assertEqual(mock_request.call_count, 5)
+        response.headers = {'Cache-Control': 'max-age=10', 'Set-Cookie': 'name=value'}
+        response.url = 'http://www.test.com/login'
+        s0.get('http://www.test.com/login')
+        self.assertEqual(mock_request.call_count, 6)
+        s1.get('http://www.test.com/login')
+        self.assertEqual(mock_request.call_count, 7)
+
+    def test_shared_cache_with_auth(self, mock_request):
+        """
+        Test that a response to a request sent with auth is neither shared nor answered from the shared cache.
+        """
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {'Cache-Control': 'max-age=600'}
+
+        mock_request.return_value = response
+
+        s0 = Session()
+        s1 = Session()
+
+        s0.get('http://www.test.com/path', auth=('alice', 'pw'))
+        self.assertEqual(mock_request.call_count, 1)
+        s1.get('http://www.test.com/path')
+        self.assertEqual(mock_request.call_count, 2)
+
+        # s0 still gets it from its own cache
+        s0.get('http://www.test.com/path', auth=('alice', 'pw'))
+        self.assertEqual(mock_request.call_count, 2)
+
+    def test_shared_cache_with_session_credentials(self, mock_request):
+        """
+        Test that a session with an Authorization header of its own does not share its responses.
+        """
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {'Cache-Control': 'max-age=600'}
+
+        mock_request.return_value = response
+
+        s0 = Session(headers={'Authorization': 'Basic YWxpY2U6cHc='})
+        s1 = Session()
+        s2 = Session(cookies={'name': 'value'})
+
+        s0.get('http://www.test.com/path')
+        self.assertEqual(mock_request.call_count, 1)
+        s1.get('http://www.test.com/path')
+        self.assertEqual(mock_request.call_count, 2)
+        s2.get('http://www.test.com/path')
+        self.assertEqual(mock_request.call_count, 3)
+
     def test_cookie(self, mock_request):
         """
         Test that each session has its own cookie "sandbox".
@@ -102,7 +196,7 @@ class TestSessions(BaseTestCase):
 
     def test_redirect(self, mock_request):
         """
-        Test that each session has its own redirect "sandbox".
+        Test that sessions share the permanent redirects learned without credentials.
         """
         response0 = Response()
         response0.url = 'http://www.test.com/neverseemeagain'
@@ -140,16 +234,133 @@ class TestSessions(BaseTestCase):
         mock_request.assert_called_with('GET', 'http://www.test.com/redirect_3', allow_redirects=True)
         self.assertEqual(r.status_code, 200)
 
-        # s1 make a request
-        r = s1.get('http://www.test.com/neverseemeagain')
-        mock_request.assert_called_with('GET', 'http://www.test.com/neverseemeagain', allow_redirects=True)
-        self.assertEqual(r.status_code, 200)
-
-        # s1 make a request again. Assert we not make request to 301 again.
+        # s1 make a request. Assert s1 not make request to 301 that s0 has seen.
         r = s1.get('http://www.test.com/neverseemeagain')
         mock_request.assert_called_with('GET', 'http://www.test.com/redirect_3', allow_redirects=True)
         self.assertEqual(r.status_code, 200)
 
+    def test_redirect_with_credentials(self, mock_request):
+        """
+        Test that a redirect seen with credentials stays in the "sandbox" of its session.
+        """
+        response0 = Response()
+        response0.url = 'http://www.test.com/account'
+        response0.status_code = 301
+        response0.headers = {'Location': 'http://www.test.com/account/1'}
+
+        response1 = Response()
+        response1.url = 'http://www.test.com/account/1'
+        response1.status_code = 200
+        response1._content = 'Mocked response content'
+        response1.history = [response0]
+
+        mock_request.return_value = response1
+
+        s0 = Session()
+        s1 = Session()
+
+        # s0 make a request with credentials
+        s0.get('http://www.test.com/account', headers={'Authorization': 'Basic dXNlcjpwYXNz'})
+        mock_request.assert_called_with('GET', 'http://www.test.com/account', allow_redirects=True,
+                                        headers={'Authorization': 'Basic dXNlcjpwYXNz'})
+
+        # s0 make a request again. Assert we not make request to 301 again.
+        s0.get('http://www.test.com/account', headers={'Authorization': 'Basic dXNlcjpwYXNz'})
+        mock_request.assert_called_with('GET', 'http://www.test.com/account/1', allow_redirects=True,
+                                        headers={'Authorization': 'Basic dXNlcjpwYXNz'})
+
+        # s1 make a request. Assert s1 make request to 301 itself.
+        s1.get('http://www.test.com/account')
+        mock_request.assert_called_with('GET', 'http://www.test.com/account', allow_redirects=True)
+
+    def test_redirect_not_followed(self, mock_request):
+        """
+        Test that a redirect asked not to be followed is neither followed nor recorded.
+        """
+        response = Response()
+        response.url = 'http://www.test.com/old'
+        response.status_code = 301
+        response.headers = {'Location': 'http://www.test.com/new'}
+
+        mock_request.return_value = response
+
+        s = Session()
+        for i in xrange(2):
+            self.assertEqual(s.get('http://www.test.com/old', allow_redirects=False).status_code, 301)
+            mock_request.assert_called_with('GET', 'http://www.test.com/old', allow_redirects=False)
+
+    def test_redirect_with_auth(self, mock_request):
+        """
+        Test that a redirect seen with auth, or by a session with credentials of its own, is not shared.
+        """
+        response0 = Response()
+        response0.url = 'http://www.test.com/account'
+        response0.status_code = 301
+        response0.headers = {'Location': 'http://www.test.com/account/1'}
+
+        response1 = Response()
+        response1.url = 'http://www.test.com/account/1'
+        response1.status_code = 200
+        response1._content = 'Mocked response content'
+        response1.history = [response0]
+
+        mock_request.return_value = response1
+
+        s0 = Session()
+        s1 = Session(headers={'Authorization': 'Basic dXNlcjpwYXNz'})
+        s2 = Session()
+
+        s0.get('http://www.test.com/account', auth=('user', 'pass'))
+        s1.get('http://www.test.com/account')
+
+        # s2 make a request. Assert s2 make request to 301 itself.
+        s2.get('http://www.test.com/account')
+        mock_request.assert_called_with('GET', 'http://www.test.com/account', allow_redirects=True)
+
+    def test_shared_redirect_with_credentials(self, mock_request):
+        """
+        Test that a redirect shared by anonymous sessions is not followed by requests with credentials.
+        """
+        response0 = Response()
+        response0.url = 'http://www.test.com/account'
+        response0.status_code = 301
+        response0.headers = {'Location': 'http://www.test.com/login'}
+
+        response1 = Response()
+        response1.url = 'http://www.test.com/login'
+        response1.status_code = 200
+        response1._content = 'Mocked response content'
+        response1.history = [response0]
+
+        mock_request.return_value = response1
+
+        s0 = Session()
+        s0.get('http://www.test.com/account')
+        s1 = Session()
+        s1.get('http://www.test.com/account')
+        mock_request.assert_called_with('GET', 'http://www.test.com/login', allow_redirects=True)
+
+        s1.get('http://www.test.com/account', cookies={'sessionid': 'abc'})
+        mock_request.assert_called_with('GET', 'http://www.test.com/account', allow_redirects=True,
+                                        cookies={'sessionid': 'abc'})
+        s2 = Session()
+        s2.get('http://www.test.com/account', headers={'Authorization': 'Basic dXNlcjpwYXNz'})
+        mock_request.assert_called_with('GET', 'http://www.test.com/account', allow_redirects=True,
+                                        headers={'Authorization': 'Basic dXNlcjpwYXNz'})
+
+        # Cookies of the jar count as well
+        response2 = Response()
+        response2.url = 'http://www.test.com/signin'
+        response2.status_code = 200
+        response2.headers = {'Set-Cookie': 'sessionid=abc'}
+        mock_request.return_value = response2
+        s3 = Session()
+        s3.get('http://www.test.com/signin')
+        mock_request.return_value = response1
+        s3.get('http://www.test.com/account')
+        mock_request.assert_called_with('GET', 'http://www.test.com/account', allow_redirects=True,
+                                        cookies={'sessionid': 'abc'})
+
     def test_post(self, mock_request):
         """
         Test that a session can call POST request
@@ -164,3 +375,226 @@ class TestSessions(BaseTestCase):
         s.post('http://www.test.com/path', data={'a': 'apple', 'b': 'banana'})
         self.assertEqual(mock_request.call_count, 1)
         mock_request.assert_called_with('POST', 'http://www.test.com/path', data={'a': 'apple', 'b': 'banana'})
+
+    def test_process_request_and_response(self, mock_request):
+        """
+        Test that the pipeline can be driven without Session.request making the call
+        """
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {'Cache-Control': 'max-age=10', 'Set-Cookie': 'name=value'}
+        response.url = 'http://www.test.com/login'
+        response.url = 'http://www.test.com/path'
+
+        s = Session()
+
+        request = Request('http://www.test.com/path')
+        self.assertIsNone(s.process_request(request))
+        self.assertEqual(s.process_response(request, response), response)
+
+        # The response handed to process_response is now cached ...
+        request = Request('http://www.test.com/path')
+        self.assertEqual(s.process_request(request).content, 'Mocked response content')
+        self.assertEqual(request.cookies, {'name': 'value'})
+        self.assertEqual(mock_request.call_count, 0)
+
+        # ... and seen by Session.request
+        r = s.get('http://www.test.com/path')
+        self.assertEqual(r.content, 'Mocked response content')
+        self.assertEqual(mock_request.call_count, 0)
+
+    def get_keys(self, session):
+        """
+        Return the keys the session keeps under its own key prefix in all caches.
+        """
+        return [key for cache in (self.cache, self.cookie_cache, self.redirect_cache)
+                for key in cache._dict if session.key_prefix in key]
+
+    def respond_with_everything(self, mock_request):
+        """
+        Make the mocked request return a private response, that sets a cookie, after a redirect seen with credentials.
+        """
+        redirect = Response()
+        redirect.url = 'http://www.test.com/account'
+        redirect.status_code = 301
+        redirect.headers = {'Location': 'http://www.test.com/account/1'}
+
+        response = Response()
+        response.url = 'http://www.test.com/account/1'
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {'Cache-Control': 'private, max-age=10', 'Set-Cookie': 'name=value', 'ETag': '"1"'}
+        response.history = [redirect]
+        mock_request.return_value = response
+
+    def test_close(self, mock_request):
+        """
+        Test that closing a session purges its cache entries, cookies and redirects, but not the shared ones.
+        """
+        self.respond_with_everything(mock_request)
+        s0 = Session()
+        s0.get('http://www.test.com/account', cookies={'a': 'apple'})
+        self.assertEqual(mock_request.call_count, 1)
+        s0.get('http://www.test.com/account', cookies={'a': 'apple'})
+        self.assertEqual(mock_request.call_count, 1)
+
+        response = Response()
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {'Cache-Control': 'max-age=10'}
+        mock_request.return_value = response
+        s0.get('http://www.example.com/public')
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertTrue(self.get_keys(s0))
+
+        poolmanager = s0.poolmanager
+        s0.close()
+        self.assertEqual(self.get_keys(s0), [])
+        self.assertFalse(s0.poolmanager is poolmanager)
+
+        # The shared response is still cached
+        Session().get('http://www.example.com/public')
+        self.assertEqual(mock_request.call_count, 2)
+
+        # The session starts afresh
+        s0.get('http://www.test.com/account')
+        mock_request.assert_called_with('GET', 'http://www.test.com/account', allow_redirects=True)
+
+    def test_context_manager(self, mock_request):
+        """
+        Test that a session is closed when its with block is left.
+        """
+        self.respond_with_everything(mock_request)
+        with Session() as s0:
+            s0.get('http://www.test.com/account', cookies={'a': 'apple'})
+            self.assertTrue(self.get_keys(s0))
+        self.assertEqual(self.get_keys(s0), [])
+
+    def test_idle_timeout(self, mock_request):
+        """
+        Test that the keyspace of a session is purged once it has been idle for longer than its idle timeout.
+        """
+        self.respond_with_everything(mock_request)
+        sessions.reap_idle_sessions()
+        s0 = Session(idle_timeout=120)
+        s0.get('http://www.test.com/account', cookies={'a': 'apple'})
+        s1 = Session(idle_timeout=300)
+        s1.get('http://www.test.com/account', cookies={'a': 'apple'})
+        del s1      # Discarded without being closed
+        s2 = Session()
+
+        # T=100: s2 is used. No session has been idle for long enough.
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=100)
+        s2.get('http://www.test.com/')
+        self.assertTrue(self.get_keys(s0))
+
+        # T=200: s0 has been idle for too long, and is purged when s2 is used again
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=200)
+        s2.get('http://www.test.com/')
+        self.assertEqual(self.get_keys(s0), [])
+        self.assertEqual(len(sessions._idle_sessions), 1)
+
+        # T=400: the discarded s1 is purged too
+        dummycache_cache.datetime.now = lambda: datetime.now() + timedelta(seconds=400)
+        self.assertEqual(sessions.reap_idle_sessions(), 1)
+        self.assertEqual(sessions._idle_sessions, {})
+
+    def test_fork(self, mock_request):
+        """
+        Test that a fork starts with the cache and cookies of its parent, and that its own writes are its own.
+        """
+        response = Response()
+        response.url = 'http://www.test.com/path'
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {'Cache-Control': 'private, max-age=10', 'Set-Cookie': 'consent=yes, theme=dark'}
+        mock_request.return_value = response
+
+        parent = Session()
+        parent.get('http://www.test.com/path')
+        self.assertEqual(mock_request.call_count, 1)
+        child = parent.fork()
+        self.assertTrue(child.poolmanager is parent.poolmanager)
+
+        # The child gets the response cached by its parent, and sends the cookies of its parent
+        child.get('http://www.test.com/path')
+        self.assertEqual(mock_request.call_count, 1)
+        child.get('http://www.test.com/other')
+        mock_request.assert_called_with('GET', 'http://www.test.com/other', allow_redirects=True,
+                                        cookies={'consent': 'yes', 'theme': 'dark'})
+
+        # The cookies the child sets and removes are its own
+        response.headers = {'Set-Cookie': 'theme=light, consent=yes; Max-Age=0, session=1'}
+        child.get('http://www.test.com/login')
+        child.get('http://www.test.com/child')
+        mock_request.assert_called_with('GET', 'http://www.test.com/child', allow_redirects=True,
+                                        cookies={'theme': 'light', 'session': '1'})
+        parent.get('http://www.test.com/parent')
+        mock_request.assert_called_with('GET', 'http://www.test.com/parent', allow_redirects=True,
+                                        cookies={'consent': 'yes', 'theme': 'dark'})
+
+        # The responses the child caches are its own
+        response.headers = {'Cache-Control': 'private, max-age=10'}
+        count = mock_request.call_count
+        child.get('http://www.test.com/private')
+        child.get('http://www.test.com/private')
+        self.assertEqual(mock_request.call_count, count + 1)
+        parent.get('http://www.test.com/private')
+        self.assertEqual(mock_request.call_count, count + 2)
+
+        # Closing the child leaves its parent alone
+        child.close()
+        parent.get('http://www.test.com/path')
+        self.assertEqual(mock_request.call_count, count + 2)
+        self.assertTrue(self.get_keys(parent))
+
+    def test_fork_clear_cookies(self, mock_request):
+        """
+        Test that clearing a fork deletes the packs it copied from its parent, so the parent's cookies show again.
+        """
+        response = Response()
+        response.url = 'http://www.test.com/path'
+        response.status_code = 200
+        response.headers = {'Set-Cookie': 'consent=yes, theme=dark'}
+        mock_request.return_value = response
+
+        parent = Session()
+        parent.get('http://www.test.com/path')
+        child = parent.fork()
+        response.headers = {'Set-Cookie': 'theme=dark; Max-Age=0'}
+        child.get('http://www.test.com/path')
+        cookie_manager = child.get_managers()[1]
+        lookup_key = cookie_manager.get_origin_cookie_lookup_key('www.test.com')
+        self.assertIsNotNone(self.cookie_cache.get(lookup_key))
+        self.assertEqual(cookie_manager.get_cookies('http://www.test.com/'), {'consent': 'yes'})
+
+        cookie_manager.clear()
+        self.assertIsNone(self.cookie_cache.get(lookup_key))
+        self.assertEqual(cookie_manager.get_cookies('http://www.test.com/'), {'consent': 'yes', 'theme': 'dark'})
+
+    @patch('dogbutler.sessions.random_string')
+    @patch('requests.sessions.Session.init_poolmanager')
+    def test_fork_is_cheap(self, mock_init_poolmanager, mock_random_string, mock_request):
+        """
+        Test that forking a session makes neither a new key prefix nor a new pool of connections.
+        """
+        parent = Session(key_prefix='parent')
+        mock_init_poolmanager.reset_mock()
+        children = [parent.fork() for i in xrange(1000)]
+        self.assertEqual(len(set(child.key_prefix for child in children)), 1000)
+        self.assertFalse(mock_init_poolmanager.called)
+        self.assertFalse(mock_random_string.called)
+
+    def test_fork_key_prefix(self, mock_request):
+        """
+        Test that the forks of a parent with a fixed key prefix get other key prefixes in every process.
+        """
+        parent = Session(key_prefix='account-1')
+        runs = []
+        for run in xrange(2):
+            # Each run starts with the counters of a new process
+            with patch('dogbutler.sessions._session_ids', count()):
+                runs.append(set(parent.fork().key_prefix for i in xrange(3)))
+        self.assertFalse(runs[0] & runs[1])
+        self.assertTrue(all(key_prefix.startswith('account-1-') for key_prefix in runs[0]))
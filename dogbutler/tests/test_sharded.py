@@ -0,0 +1,170 @@
+from dummycache.cache import Cache
+from mock import patch
+from requests.models import Response
+
+from dogbutler import Session
+from dogbutler.backends import ShardedCache
+from dogbutler.cache import CacheManager
+from dogbutler.cookie import CookieManager
+from dogbutler.defaults import get_default_cache, set_default_cache, get_default_cookie_cache, set_default_cookie_cache
+from dogbutler.models import Request
+from dogbutler.redirect import RedirectManager
+from dogbutler.tests.base import BaseTestCase, GetManyCache
+
+
+class TestShardedCache(BaseTestCase):
+
+    def setUp(self):
+        super(TestShardedCache, self).setUp()
+        self.shards = dict(('cache-%d' % i, GetManyCache()) for i in xrange(4))
+        self.sharded_cache = ShardedCache(self.shards)
+
+    def get_shards_of(self, keys):
+        return set(name for name, cache in self.shards.items() for key in keys if key in cache._dict)
+
+    def test_get_set_delete(self):
+        self.assertIsNone(self.sharded_cache.get('key'))
+        self.sharded_cache.set('key', 'value')
+        self.assertEqual(self.sharded_cache.get('key'), 'value')
+        self.assertEqual(self.get_shards_of(['key']), set([self.sharded_cache.get_cache_name('key')]))
+        self.assertFalse(self.sharded_cache.add('key', 'other'))
+        self.assertEqual(self.sharded_cache.get('key'), 'value')
+        self.sharded_cache.delete('key')
+        self.assertIsNone(self.sharded_cache.get('key'))
+        self.assertRaises(ValueError, ShardedCache({}).get, 'key')
+
+    def test_spread(self):
+        """
+        Test that keys are spread evenly over the caches.
+        """
+        for i in xrange(4000):
+            self.sharded_cache.set('key-%d' % i, i)
+        for cache in self.shards.values():
+            self.assertTrue(600 < len(cache._dict) < 1400)
+        self.sharded_cache.clear()
+        self.assertEqual(sum(len(cache._dict) for cache in self.shards.values()), 0)
+
+    def test_add_remove_cache(self):
+        """
+        Test that adding a cache only moves the keys it takes over, and removing a cache only moves its own keys.
+        """
+        keys = ['key-%d' % i for i in xrange(4000)]
+        before = dict((key, self.sharded_cache.get_cache_name(key)) for key in keys)
+
+        self.sharded_cache.add_cache('cache-4', Cache())
+        after = dict((key, self.sharded_cache.get_cache_name(key)) for key in keys)
+        moved = [key for key in keys if before[key] != after[key]]
+        self.assertTrue(500 < len(moved) < 1100)
+        self.assertTrue(all(after[key] == 'cache-4' for key in moved))
+
+        self.sharded_cache.remove_cache('cache-0')
+        removed = dict((key, self.sharded_cache.get_cache_name(key)) for key in keys)
+        self.assertTrue(all(removed[key] == after[key] for key in keys if after[key] != 'cache-0'))
+        self.assertFalse('cache-0' in removed.values())
+
+    def test_many(self):
+        """
+        Test that get_many, set_many and delete_many make one call per cache.
+        """
+        data = dict(('key-%d' % i, i) for i in xrange(100))
+        self.sharded_cache.set_many(data)
+        self.assertEqual(self.sharded_cache.get_many(data.keys() + ['missing']), data)
+        self.assertTrue(all(cache.reads == 1 for cache in self.shards.values()))
+        self.sharded_cache.delete_many(data.keys())
+        self.assertEqual(self.sharded_cache.get_many(data.keys()), {})
+
+    def test_cache_keys_grouped(self):
+        """
+        Test that a response, its long term copy and the lists of headers they vary on are stored together.
+        """
+        cache_manager = CacheManager(key_prefix='test_sharded', cache=self.sharded_cache)
+        for i in xrange(20):
+            request = Request('http://www.test.com/path/%d' % i)
+            cache_manager.process_request(request)
+            response = Response()
+            response.status_code = 200
+            response.url = request.url
+            response._content = 'Mocked response content'
+            response.headers = {'Cache-Control': 'private, max-age=10', 'Vary': 'Accept-Encoding'}
+            cache_manager.process_response(request, response)
+        for cache in self.shards.values():
+            # Either all four keys of a path or none
+            self.assertEqual(len(cache._dict) % 4, 0)
+        self.assertEqual(sum(len(cache._dict) for cache in self.shards.values()), 80)
+
+    def test_cookie_keys_grouped(self):
+        """
+        Test that the cookies of a site are stored in one cache, and that the sites of a jar are spread over the caches.
+        """
+        cookie_manager = CookieManager(key_prefix='test_sharded', cache=self.sharded_cache)
+        for i in xrange(20):
+            for host in ('www.test%d.com' % i, 'blog.test%d.com:8000' % i):
+                request = Request('http://%s/path' % host)
+                response = Response()
+                response.url = request.url
+                response.headers = {'Set-Cookie': 'session=%s, theme=dark; Domain=test%d.com' % (host, i)}
+                cookie_manager.process_response(request, response)
+        for i in xrange(20):
+            keys = [cookie_manager.get_origin_cookie_lookup_key('www.test%d.com' % i),
+                    cookie_manager.get_origin_cookie_lookup_key('blog.test%d.com:8000' % i),
+                    cookie_manager.get_domain_cookie_lookup_key('test%d.com' % i),
+                    cookie_manager.get_usage_key('test%d.com' % i)]
+            self.assertEqual(len(self.get_shards_of(keys)), 1)
+        self.assertEqual(len([cache for cache in self.shards.values() if cache._dict]), 4)
+
+        # The cookies of a URL take one read besides the jar version
+        reads = sum(cache.reads for cache in self.shards.values())
+        self.assertEqual(cookie_manager.get_cookies('http://blog.test3.com:8000/path'),
+                         {'session': 'blog.test3.com:8000', 'theme': 'dark'})
+        self.assertEqual(sum(cache.reads for cache in self.shards.values()), reads + 2)
+
+    def test_shared_redirect_keys_spread(self):
+        """
+        Test that the redirects shared by all sessions are spread over the caches, apart from their version.
+        """
+        redirect_manager = RedirectManager(key_prefix='test_sharded', cache=self.sharded_cache)
+        for i in xrange(40):
+            request = Request('http://www.test.com/old/%d' % i)
+            redirect = Response()
+            redirect.status_code = 301
+            redirect.url = request.url
+            redirect.headers = {'Location': 'http://www.test.com/new/%d' % i}
+            response = Response()
+            response.status_code = 200
+            response.url = 'http://www.test.com/new/%d' % i
+            response.history = [redirect]
+            redirect_manager.process_response(request, response)
+        self.assertEqual(len([cache for cache in self.shards.values() if cache._dict]), 4)
+        version_key = redirect_manager.get_version_key(shared=True)
+        self.assertEqual(self.sharded_cache.get_group(version_key), redirect_manager.shared_key_prefix)
+        self.assertEqual(self.sharded_cache.get_group(redirect_manager.get_version_key()),
+                         self.sharded_cache.get_group(redirect_manager.get_cache_key('http://www.test.com/old/0')))
+
+    @patch('requests.sessions.Session.request')
+    def test_session(self, mock_request):
+        """
+        Test that sessions cache responses and keep cookies in a sharded cache.
+        """
+        response = Response()
+        response.url = 'http://www.test.com/path'
+        response.status_code = 200
+        response._content = 'Mocked response content'
+        response.headers = {'Cache-Control': 'private, max-age=10', 'Set-Cookie': 'consent=yes'}
+        mock_request.return_value = response
+
+        default_cache, default_cookie_cache = get_default_cache(), get_default_cookie_cache()
+        set_default_cache(self.sharded_cache)
+        set_default_cookie_cache(self.sharded_cache)
+        try:
+            s = Session()
+            s.get('http://www.test.com/path')
+            s.get('http://www.test.com/path')
+            self.assertEqual(mock_request.call_count, 1)
+            s.get('http://www.test.com/other')
+            mock_request.assert_called_with('GET', 'http://www.test.com/other', allow_redirects=True,
+                                            cookies={'consent': 'yes'})
+            s.close()
+            self.assertEqual(sum(len(cache._dict) for cache in self.shards.values()), 0)
+        finally:
+            set_default_cookie_cache(default_cookie_cache)
+            set_default_cache(default_cache)
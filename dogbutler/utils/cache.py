@@ -21,6 +21,7 @@ import re
 
 from .encoding import iri_to_uri
 from .hashcompat import md5_constructor
+from .keys import encode_digest
 
 cc_delim_re = re.compile(r'\s*,\s*')
 
@@ -45,6 +46,50 @@ def get_max_age(response):
         except (ValueError, TypeError):
             pass
 
+def get_cache_control(response):
+    """
+    Returns the directives of the response Cache-Control header as a dict.
+    """
+    if not response.has_header('Cache-Control'):
+        return {}
+    return dict([_to_tuple(el) for el in
+                 cc_delim_re.split(response['Cache-Control'])])
+
+def has_credentials(request):
+    """
+    Return True if request may be answered differently for other users,
+    i.e. if it carries cookies, an Authorization header or auth, or its
+    session adds credentials of its own (see Session.has_credentials). A
+    missing request is assumed to.
+    """
+    if request is None:
+        return True
+    if getattr(request, 'credentials', False) or getattr(request, 'auth', None):
+        return True
+    if getattr(request, 'cookies', None):
+        return True
+    headers = getattr(request, 'headers', None) or {}
+    return any(header.lower() in ('authorization', 'cookie') for header in headers)
+
+def is_public(response):
+    return 'public' in get_cache_control(response)
+
+def is_shareable(request, response):
+    """
+    Returns True if the response to request may be stored by a cache shared
+    between users: it is not private, sets no cookies and does not vary on
+    credentials, and it is either public or the answer to a request without
+    credentials.
+    """
+    cache_control = get_cache_control(response)
+    if 'private' in cache_control or response.has_header('Set-Cookie'):
+        return False
+    if response.has_header('Vary'):
+        vary = [header.lower() for header in cc_delim_re.split(response['Vary'])]
+        if '*' in vary or 'cookie' in vary or 'authorization' in vary:
+            return False
+    return 'public' in cache_control or not has_credentials(request)
+
 #def _i18n_cache_key_suffix(request, cache_key):
 #    """If enabled, returns the cache key ending with a locale."""
 #    if settings.USE_I18N:
@@ -54,8 +99,12 @@ def get_max_age(response):
 #        cache_key += '.%s' % getattr(request, 'LANGUAGE_CODE', get_language())
 #    return cache_key
 
-def _generate_cache_key(request, method, headerlist, key_prefix):
-    """Returns a cache key from the headers given in the header list."""
+def _generate_cache_key(request, method, headerlist, key_prefix, compact=False):
+    """
+    Returns a cache key from the headers given in the header list. A compact
+    key is the key prefix, the method and the compact digests of the path and
+    headers (see dogbutler.utils.keys).
+    """
     ctx = md5_constructor()
     for header in headerlist:
 #        value = request.META.get(header, None)
@@ -63,20 +112,24 @@ def _generate_cache_key(request, method, headerlist, key_prefix):
         if value is not None:
             ctx.update(value)
     path = md5_constructor(iri_to_uri(request.get_full_path()))
+    if compact:
+        return '%s.%s.%s%s' % (key_prefix, request.method, encode_digest(path.digest()), encode_digest(ctx.digest()))
     cache_key = 'views.decorators.cache.cache_page.%s.%s.%s.%s' % (
         key_prefix, request.method, path.hexdigest(), ctx.hexdigest())
 #    return _i18n_cache_key_suffix(request, cache_key)
     return cache_key
 
-def _generate_cache_header_key(key_prefix, request):
+def _generate_cache_header_key(key_prefix, request, compact=False):
     """Returns a cache key for the header cache."""
     path = md5_constructor(iri_to_uri(request.get_full_path()))
+    if compact:
+        return '%s.%s' % (key_prefix, encode_digest(path.digest()))
     cache_key = 'views.decorators.cache.cache_header.%s.%s' % (
         key_prefix, path.hexdigest())
 #    return _i18n_cache_key_suffix(request, cache_key)
     return cache_key
 
-def get_cache_key(request, key_prefix, method, cache):
+def get_cache_key(request, key_prefix, method, cache, compact=False):
     """
     Returns a cache key based on the request path and query. It can be used
     in the request phase because it pulls the list of headers to take into
@@ -86,16 +139,16 @@ def get_cache_key(request, key_prefix, method, cache):
     If there is no headerlist stored, the page needs to be rebuilt, so this
     function returns None.
     """
-    cache_key = _generate_cache_header_key(key_prefix, request)
+    cache_key = _generate_cache_header_key(key_prefix, request, compact)
 #    if cache is None:
 #        cache = get_cache(settings.CACHE_MIDDLEWARE_ALIAS)
     headerlist = cache.get(cache_key, None)
     if headerlist is not None:
-        return _generate_cache_key(request, method, headerlist, key_prefix)
+        return _generate_cache_key(request, method, headerlist, key_prefix, compact)
     else:
         return None
 
-def learn_cache_key(request, response, cache_timeout, key_prefix, cache):
+def learn_cache_key(request, response, cache_timeout, key_prefix, cache, compact=False):
     """
     Learns what headers to take into account for some request path from the
     response object. It stores those headers in a global path registry so that
@@ -112,7 +165,7 @@ def learn_cache_key(request, response, cache_timeout, key_prefix, cache):
 #        key_prefix = settings.CACHE_MIDDLEWARE_KEY_PREFIX
 #    if cache_timeout is None:
 #        cache_timeout = settings.CACHE_MIDDLEWARE_SECONDS
-    cache_key = _generate_cache_header_key(key_prefix, request)
+    cache_key = _generate_cache_header_key(key_prefix, request, compact)
 #    if cache is None:
 #        cache = get_cache(settings.CACHE_MIDDLEWARE_ALIAS)
     if response.has_header('Vary'):
@@ -120,12 +173,12 @@ def learn_cache_key(request, response, cache_timeout, key_prefix, cache):
 #                      for header in cc_delim_re.split(response['Vary'])]
         headerlist = [header for header in cc_delim_re.split(response['Vary'])]
         cache.set(cache_key, headerlist, cache_timeout)
-        return _generate_cache_key(request, request.method, headerlist, key_prefix)
+        return _generate_cache_key(request, request.method, headerlist, key_prefix, compact)
     else:
         # if there is no Vary header, we still need a cache key
         # for the request.get_full_path()
         cache.set(cache_key, [], cache_timeout)
-        return _generate_cache_key(request, request.method, [], key_prefix)
+        return _generate_cache_key(request, request.method, [], key_prefix, compact)
 
 
 def _to_tuple(s):
@@ -0,0 +1,235 @@
+"""
+This module parses Set-Cookie headers into :class:`Cookie` records.
+
+Each Set-Cookie header is parsed on its own, as described in RFC 6265:
+
+    http://tools.ietf.org/html/rfc6265#section-5.2
+
+The Expires attribute is read with the lenient date algorithm of RFC 6265
+section 5.1.1, which accepts the RFC 1123, RFC 850 and asctime formats and
+the many variations of them found in the wild.
+
+It also finds the site, i.e. registrable domain, of the domain or host a
+cookie is for, which the jar limits and cache keys of cookies go by.
+"""
+
+import re
+from calendar import timegm
+from collections import namedtuple
+from time import gmtime, strftime
+
+from .publicsuffix import get_registrable_domain
+
+# A comma that starts a new cookie, rather than one inside an Expires date
+set_cookie_split_re = re.compile(r',\s*(?=[^;,=\s]+=)')
+date_delimiter_re = re.compile(r'[\x09\x20-\x2f\x3b-\x40\x5b-\x60\x7b-\x7e]+')
+date_time_re = re.compile(r'^(\d{1,2}):(\d{1,2}):(\d{1,2})(?:\D|$)')
+date_day_re = re.compile(r'^(\d{1,2})(?:\D|$)')
+date_year_re = re.compile(r'^(\d{2,4})(?:\D|$)')
+max_age_re = re.compile(r'^-?\d+$')                    # RFC 6265 section 5.2.2
+
+_months = {
+    'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+    'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12,
+}
+
+# Sites send the same few Expires strings over and over, so parsed dates are
+# memoized. The memo is simply emptied when it grows past its limit.
+_date_cache = {}
+DATE_CACHE_SIZE = 1024
+
+SECURE = 1
+HTTPONLY = 2
+
+
+class Cookie(namedtuple('Cookie', 'name value domain path expires max_age secure httponly')):
+    """
+    An immutable cookie record, parsed from a Set-Cookie header or read back
+    from the cookie jar.
+
+    expires is a UTC timestamp, or None if the cookie had no valid Expires
+    attribute. Attributes can also be read by name, as with a
+    Cookie.Morsel, e.g. cookie['domain'].
+    """
+
+    __slots__ = ()
+
+    _attributes = {
+        'domain': 'domain',
+        'path': 'path',
+        'max-age': 'max_age',
+        'secure': 'secure',
+        'httponly': 'httponly',
+    }
+
+    def __new__(cls, name, value, domain='', path='', expires=None, max_age=None, secure=False, httponly=False):
+        return super(Cookie, cls).__new__(cls, name, value, domain, path, expires, max_age, secure, httponly)
+
+    @property
+    def key(self):
+        return self.name
+
+    def __getitem__(self, attribute):
+        if not isinstance(attribute, basestring):
+            return tuple.__getitem__(self, attribute)
+        attribute = attribute.lower()
+        if attribute == 'expires':
+            return format_http_date(self.expires) if self.expires is not None else ''
+        return getattr(self, self._attributes[attribute])
+
+    def __repr__(self):
+        return '<Cookie %s=%s>' % (self.name, self.value)
+
+
+def pack_cookie(cookie):
+    """
+    Return the compact tuple of (name, value, domain, path, expires, flags) a
+    cookie is stored as. Max-Age is not kept, so expires should already be
+    the time the cookie expires.
+    """
+    flags = (SECURE if cookie.secure else 0) | (HTTPONLY if cookie.httponly else 0)
+    return (cookie.name, cookie.value, cookie.domain, cookie.path, cookie.expires, flags)
+
+def unpack_cookie(packed):
+    name, value, domain, path, expires, flags = packed
+    return Cookie(name, value, domain, path, expires, None, bool(flags & SECURE), bool(flags & HTTPONLY))
+
+
+def normalize_domain(domain):
+    return domain.lstrip('.')
+
+def strip_port(host):
+    """
+    Return host without the port it may have, e.g. 'www.test.com' for
+    'www.test.com:8000'.
+    """
+    if host.startswith('['):
+        return host[:host.find(']') + 1] or host
+    return host.split(':', 1)[0]
+
+def is_ip_address(host):
+    return host.startswith('[') or host.split('.')[-1].isdigit()
+
+def get_cookie_site(host):
+    """
+    Return the site a cookie for host counts against, i.e. the registrable
+    domain of host, or host itself if it has none, without its port.
+    """
+    host = strip_port(normalize_domain(host).lower())
+    if is_ip_address(host):
+        return host
+    return get_registrable_domain(host) or host
+
+
+def parse_http_date(value):
+    """
+    Return the UTC timestamp of a cookie date, or None if it is not a valid
+    date.
+    """
+    try:
+        return _date_cache[value]
+    except KeyError:
+        pass
+    timestamp = _parse_http_date(value)
+    if len(_date_cache) >= DATE_CACHE_SIZE:
+        _date_cache.clear()
+    _date_cache[value] = timestamp
+    return timestamp
+
+def _parse_http_date(value):
+    time = day = month = year = None
+    for token in date_delimiter_re.split(value):
+        if not token:
+            continue
+        if time is None:
+            match = date_time_re.match(token)
+            if match:
+                time = [int(n) for n in match.groups()]
+                continue
+        if day is None:
+            match = date_day_re.match(token)
+            if match:
+                day = int(match.group(1))
+                continue
+        if month is None and token[:3].lower() in _months:
+            month = _months[token[:3].lower()]
+            continue
+        if year is None:
+            match = date_year_re.match(token)
+            if match:
+                year = int(match.group(1))
+                continue
+
+    if None in (time, day, month, year):
+        return None
+    if 70 <= year <= 99:
+        year += 1900
+    elif 0 <= year <= 69:
+        year += 2000
+    hour, minute, second = time
+    if not 1 <= day <= 31 or year < 1601 or hour > 23 or minute > 59 or second > 59:
+        return None
+    return timegm((year, month, day, hour, minute, second))
+
+def format_http_date(timestamp):
+    return strftime('%a, %d-%b-%Y %H:%M:%S GMT', gmtime(timestamp))
+
+
+def parse_set_cookie(header):
+    """
+    Return a :class:`Cookie` parsed from one Set-Cookie header, or None if
+    the header does not hold a cookie.
+    """
+    parts = header.split(';')
+    name, sep, cookie_value = parts[0].partition('=')
+    name = name.strip()
+    if not sep or not name:
+        return None
+    domain = path = ''
+    expires = max_age = None
+    secure = httponly = False
+    for part in parts[1:]:
+        attribute, sep, value = part.partition('=')
+        attribute = attribute.strip().lower()
+        value = value.strip()
+        if attribute == 'expires':
+            expires = parse_http_date(value)
+        elif attribute == 'max-age':
+            if max_age_re.match(value):
+                max_age = int(value)
+        elif attribute == 'domain':
+            domain = value
+        elif attribute == 'path':
+            path = value
+        elif attribute == 'secure':
+            secure = True
+        elif attribute == 'httponly':
+            httponly = True
+    return Cookie(name, cookie_value.strip(), domain, path, expires, max_age, secure, httponly)
+
+def get_set_cookie_headers(response):
+    """
+    Return the Set-Cookie headers of a response as a list.
+
+    The headers are read one by one from the raw HTTP response when it is
+    available. Otherwise the folded Set-Cookie header that requests exposes
+    is split back into separate headers.
+    """
+    original = getattr(response.raw, '_original_response', None)
+    if original is not None:
+        return original.msg.getheaders('set-cookie')
+    header = response.headers.get('Set-Cookie')
+    if not header:
+        return []
+    return set_cookie_split_re.split(header)
+
+def parse_cookies(response):
+    """
+    Return the list of :class:`Cookie` records set by a response.
+    """
+    cookies = []
+    for header in get_set_cookie_headers(response):
+        cookie = parse_set_cookie(header)
+        if cookie is not None:
+            cookies.append(cookie)
+    return cookies
@@ -0,0 +1,87 @@
+"""
+Compact cache keys.
+
+A compact key starts with a one byte tag for the kind of data it holds,
+followed by the key prefix of its session, e.g. 'cW3F1K0PZ7QJ2H9XB' for the
+responses of a session. What follows depends on the kind of data, but
+digests are always the raw 16 bytes of an MD5, base64 encoded with the URL
+safe alphabet and without padding, so 22 bytes rather than 32 in hex. Keys
+stay printable and free of spaces, as memcached requires.
+
+Legacy keys are the ones of earlier versions, which name the kind of data
+in full, e.g. 'views.decorators.cache.cache_page.<key prefix>.dogbutler'.
+Managers still make them when created with legacy_keys=True, or when
+set_default_legacy_keys(True) was called before their session was created,
+so that the entries already in a cache can be found while it is migrated.
+"""
+
+from base64 import urlsafe_b64encode
+
+from dogbutler.defaults import DEFAULT_SHARED_KEY_PREFIX
+
+from .cookie import get_cookie_site
+from .hashcompat import md5_constructor
+
+
+CACHE_TAG = 'c'                 # Responses and the lists of headers they vary on
+LONG_TERM_CACHE_TAG = 'l'       # The same, kept for revalidation
+COOKIE_TAG = 'k'                # Cookie packs, usage records and jar version
+REDIRECT_TAG = 'r'              # Redirects, origin rules and redirect versions
+DIGEST_LENGTH = 22              # Of an encoded digest
+SHARED_REDIRECT_KEY_PREFIX = REDIRECT_TAG + DEFAULT_SHARED_KEY_PREFIX
+
+
+def make_key_prefix(tag, key_prefix):
+    return tag + key_prefix
+
+def encode_digest(digest):
+    return urlsafe_b64encode(digest).rstrip('=')
+
+def get_digest(value):
+    """
+    Return the compact digest of value, a string.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return encode_digest(md5_constructor(value).digest())
+
+def get_key_group(key):
+    """
+    Return the group of key, i.e. the part of it that decides where a
+    sharded cache stores it, so that keys read together are stored together.
+
+    The cookie packs and usage records of a session are grouped by its key
+    prefix and their site, i.e. registrable domain, so that the cookies of
+    a URL are read in one round trip, while a jar, even one that many
+    sessions share such as that of the api functions, is spread by site.
+    The version and totals of a jar are grouped by its key prefix. The
+    redirect keys of a session form one group, so that its redirects are
+    read in one round trip. The redirects shared by all sessions are not
+    grouped, as every session reads them: each of their keys is its own
+    group, apart from their version, which is read along with every batch
+    of them and stays in the group of the default shared key prefix. A
+    response, its long term copy and the lists of headers they vary on are
+    grouped by the key prefix of their session and the digest of their
+    path. Any other key, including a legacy key, is its own group.
+    """
+    tag = key[:1]
+    if tag in (COOKIE_TAG, REDIRECT_TAG):
+        end = min(i for i in (key.find('.'), key.find('/'), key.find(':'), len(key)) if i >= 0)
+        if key[:end] == SHARED_REDIRECT_KEY_PREFIX and key[end:end + 1] not in ('', ':'):
+            return key
+        if tag == COOKIE_TAG:
+            # A pack is keyed by domain or origin, a usage record by site
+            if key[end:end + 1] in ('.', '/'):
+                return '.'.join([key[:end], get_cookie_site(key[end + 1:])])
+            if key[end:end + 3] == ':u.':
+                return '.'.join([key[:end], key[end + 3:]])
+        return key[:end]
+    if tag in (CACHE_TAG, LONG_TERM_CACHE_TAG):
+        if key[-DIGEST_LENGTH - 1:-DIGEST_LENGTH] == '.':
+            # A list of headers: the key prefix, then the digest of the path
+            return key[1:]
+        if key[-2 * DIGEST_LENGTH - 1:-2 * DIGEST_LENGTH] == '.':
+            # A response: the key prefix, the method, then the digests of the path and headers
+            key_prefix = key[1:-2 * DIGEST_LENGTH - 1].rsplit('.', 1)[0]
+            return '.'.join([key_prefix, key[-2 * DIGEST_LENGTH:-DIGEST_LENGTH]])
+    return key
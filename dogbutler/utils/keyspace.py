@@ -0,0 +1,37 @@
+from threading import Lock
+
+
+class Keyspace(object):
+    """
+    The keys a manager has written to its cache under its own key prefix, so
+    that they can be deleted together when its session is closed. Keys are
+    only remembered, never read back, so a key deleted or expired meanwhile
+    is simply deleted again.
+    """
+
+    def __init__(self):
+        self._keys = set()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        with self._lock:
+            self._keys.add(key)
+
+    def purge(self, cache):
+        """
+        Delete every key remembered from cache, with a single delete_many if
+        the cache supports it, and forget them.
+        """
+        with self._lock:
+            keys, self._keys = self._keys, set()
+        if not keys or cache is None:
+            return
+        delete_many = getattr(cache, 'delete_many', None)
+        if delete_many is not None:
+            delete_many(list(keys))
+        else:
+            for key in keys:
+                cache.delete(key)
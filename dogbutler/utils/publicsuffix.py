@@ -0,0 +1,429 @@
+"""
+This module finds the public suffix and the registrable domain of a host,
+following the rules of the Public Suffix List:
+
+    https://publicsuffix.org/list/
+
+A subset of the list, covering the generic top-level domains and the most
+common country-code registries, is embedded below and compiled once into a
+trie. To use the full list, or a newer one, load a local copy of
+public_suffix_list.dat:
+
+    set_default_public_suffix_list(PublicSuffixList.from_file('public_suffix_list.dat'))
+"""
+
+import codecs
+
+
+RULE = 1                    # Flags a trie node where a rule ends
+EXCEPTION = 2               # Flags a trie node where an exception rule ends
+WILDCARD = '*'
+
+EMBEDDED_RULES = u"""
+// Generic top-level domains
+aero
+app
+asia
+biz
+blog
+cat
+cloud
+com
+coop
+dev
+edu
+gov
+info
+int
+io
+jobs
+mil
+mobi
+museum
+name
+net
+online
+org
+pro
+shop
+site
+tech
+tel
+travel
+xxx
+xyz
+
+// Country-code top-level domains and their registries
+ac
+ad
+ae
+co.ae
+ac.ae
+gov.ae
+net.ae
+org.ae
+af
+ag
+ai
+al
+am
+ar
+com.ar
+edu.ar
+gob.ar
+net.ar
+org.ar
+at
+ac.at
+co.at
+gv.at
+or.at
+au
+com.au
+net.au
+org.au
+edu.au
+gov.au
+asn.au
+id.au
+az
+ba
+bd
+com.bd
+be
+bg
+bh
+br
+com.br
+net.br
+org.br
+gov.br
+edu.br
+by
+bz
+ca
+cc
+ch
+cl
+cn
+com.cn
+net.cn
+org.cn
+gov.cn
+edu.cn
+ac.cn
+co
+com.co
+net.co
+org.co
+cr
+cu
+cy
+cz
+de
+dk
+do
+dz
+ec
+ee
+eg
+com.eg
+es
+com.es
+org.es
+eu
+fi
+fm
+fr
+ge
+gg
+gl
+gr
+com.gr
+hk
+com.hk
+edu.hk
+gov.hk
+net.hk
+org.hk
+hr
+hu
+id
+ac.id
+co.id
+go.id
+or.id
+web.id
+ie
+il
+ac.il
+co.il
+gov.il
+org.il
+im
+in
+co.in
+net.in
+org.in
+ac.in
+gov.in
+ir
+is
+it
+je
+jp
+ac.jp
+ad.jp
+co.jp
+ed.jp
+go.jp
+gr.jp
+lg.jp
+ne.jp
+or.jp
+ke
+co.ke
+kh
+com.kh
+kr
+ac.kr
+co.kr
+go.kr
+ne.kr
+or.kr
+kz
+la
+li
+lk
+lt
+lu
+lv
+ly
+ma
+md
+me
+mk
+mm
+mn
+mx
+com.mx
+org.mx
+gob.mx
+edu.mx
+my
+com.my
+net.my
+org.my
+gov.my
+edu.my
+ng
+com.ng
+nl
+no
+np
+nz
+ac.nz
+co.nz
+geek.nz
+gen.nz
+govt.nz
+net.nz
+org.nz
+om
+pa
+pe
+com.pe
+ph
+com.ph
+pk
+com.pk
+pl
+com.pl
+net.pl
+org.pl
+pr
+pt
+com.pt
+py
+qa
+ro
+rs
+ru
+com.ru
+sa
+com.sa
+se
+sg
+com.sg
+edu.sg
+gov.sg
+net.sg
+org.sg
+si
+sk
+su
+th
+ac.th
+co.th
+go.th
+in.th
+mi.th
+net.th
+or.th
+tk
+tn
+to
+tr
+com.tr
+net.tr
+org.tr
+gov.tr
+edu.tr
+tv
+tw
+com.tw
+net.tw
+org.tw
+edu.tw
+gov.tw
+ua
+com.ua
+ug
+uk
+ac.uk
+co.uk
+gov.uk
+ltd.uk
+me.uk
+net.uk
+nhs.uk
+org.uk
+plc.uk
+sch.uk
+us
+uy
+com.uy
+uz
+ve
+com.ve
+vn
+com.vn
+net.vn
+org.vn
+edu.vn
+gov.vn
+ws
+za
+ac.za
+co.za
+gov.za
+org.za
+web.za
+*.ck
+!www.ck
+*.bn
+*.kw
+*.np
+
+// Private registries
+appspot.com
+blogspot.com
+cloudfront.net
+github.io
+herokuapp.com
+netlify.app
+pages.dev
+vercel.app
+"""
+
+
+class PublicSuffixList(object):
+    """
+    A set of public suffix rules, compiled into a trie of labels read from
+    right to left. Each node is a list of [flags, children], so that no
+    label can be mistaken for a flag. e.g. the rules 'uk' and 'co.uk'
+    compile to:
+
+        [0, {'uk': [RULE, {'co': [RULE, {}]}]}]
+    """
+
+    def __init__(self, rules):
+        self.trie = [0, {}]
+        for line in rules.splitlines():
+            # Only the text up to the first whitespace is the rule
+            line = line.strip()
+            if not line or line.startswith('//'):
+                continue
+            rule = line.split()[0].lower()
+            mark = RULE
+            if rule.startswith('!'):
+                rule = rule[1:]
+                mark = EXCEPTION
+            node = self.trie
+            for label in reversed(rule.split('.')):
+                node = node[1].setdefault(label, [0, {}])
+            node[0] |= mark
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Return the rules in a local copy of public_suffix_list.dat.
+        """
+        with codecs.open(filename, encoding='utf-8') as f:
+            return cls(f.read())
+
+    def get_public_suffix_length(self, labels):
+        """
+        Return the number of labels, read from the right, that make up the
+        public suffix of a host split into labels.
+        """
+        # A host that matches no rule has its top-level domain as public suffix
+        length = 1
+        node = self.trie
+        for depth, label in enumerate(reversed(labels), 1):
+            wildcard = node[1].get(WILDCARD)
+            node = node[1].get(label)
+            if node is not None and node[0] & EXCEPTION:
+                return depth - 1
+            if (node is not None and node[0] & RULE) or (wildcard is not None and wildcard[0] & RULE):
+                length = depth
+            if node is None:
+                break
+        return min(length, len(labels))
+
+    def get_public_suffix(self, host):
+        labels = host.lower().split('.')
+        return '.'.join(labels[len(labels) - self.get_public_suffix_length(labels):])
+
+    def get_registrable_domain(self, host):
+        """
+        Return the public suffix of host plus one label, or None if host is
+        itself a public suffix, or has an empty label, e.g. 'x..com'.
+        """
+        labels = host.lower().split('.')
+        if '' in labels:
+            return None
+        length = self.get_public_suffix_length(labels)
+        if length >= len(labels):
+            return None
+        return '.'.join(labels[len(labels) - length - 1:])
+
+    def is_public_suffix(self, domain):
+        labels = domain.lower().split('.')
+        return self.get_public_suffix_length(labels) >= len(labels)
+
+
+DEFAULT_PUBLIC_SUFFIX_LIST = PublicSuffixList(EMBEDDED_RULES)
+
+def get_default_public_suffix_list():
+    return DEFAULT_PUBLIC_SUFFIX_LIST
+
+def set_default_public_suffix_list(public_suffix_list):
+    global DEFAULT_PUBLIC_SUFFIX_LIST
+    DEFAULT_PUBLIC_SUFFIX_LIST = public_suffix_list
+
+def get_registrable_domain(host):
+    return DEFAULT_PUBLIC_SUFFIX_LIST.get_registrable_domain(host)
+
+def is_public_suffix(domain):
+    return DEFAULT_PUBLIC_SUFFIX_LIST.is_public_suffix(domain)
@@ -22,6 +22,6 @@ setup(
     ],
     license = "GPL-3.0",
     keywords = "HTTP HTTPS request python cache cookie redirect",
-    packages = ['dogbutler', 'dogbutler.utils'],
+    packages = ['dogbutler', 'dogbutler.backends', 'dogbutler.utils'],
     install_requires = ['dummycache', 'requests'],
 )